@@ -0,0 +1,94 @@
+"""
+Flashcard JSON acceptance with and without constrained decoding.
+
+Replays a fixed mix of model-like replies (clean, with reasoning first,
+and with the breakages we see in practice) through the fake backend and
+reports how many parse into an `LlmOutput` with a non-empty answer. A card
+whose `back` is empty or whitespace counts as a failure, and
+`empty_answer_rate` tells how many failed that way.
+
+    python -m benchmarks.constrained_decoding
+"""
+
+import json
+import random
+
+from example import SOURCE_INPUT_JAVA
+from lfm import FakeBackend, Llm
+from lfm.backend import default_responder
+
+QUESTIONS = [
+    "Compared to C and C++, what issues does Java avoid?",
+    "What are applets?",
+    "When was Java 1.0 released?",
+    "Why did Sun create Java?",
+    "What did Java evolve into?",
+]
+
+
+def _card(question: str) -> str:
+    reply = default_responder(
+        [
+            {"role": "system", "content": "Anki flashcard JSON"},
+            {"role": "user", "content": f"Source:\n{SOURCE_INPUT_JAVA}\n\nQuestion:\n{question}"},
+        ]
+    )
+    return reply.removeprefix("```json\n").removesuffix("\n```")
+
+
+BREAKAGES = {
+    "clean": lambda card: card,
+    "fenced": lambda card: f"```json\n{card}\n```",
+    "reasoning first": lambda card: "The source answers this in one sentence, "
+    "so I restate it.\n\n" + card,
+    "trailing comma": lambda card: card[:-1] + ",}",
+    "single quotes": lambda card: card.replace('"', "'"),
+    "unescaped quote": lambda card: card.replace('"back": "', '"back": "The "source" says ', 1),
+    "prose only": lambda card: "Java avoids memory errors through automatic memory management.",
+    "truncated": lambda card: card[: len(card) // 2],
+}
+
+
+def build_replies(count: int, seed: int = 0) -> list[tuple[str, str]]:
+    rng = random.Random(seed)
+    names = sorted(BREAKAGES)
+    replies = []
+    for i in range(count):
+        name = rng.choice(names)
+        replies.append((name, BREAKAGES[name](_card(QUESTIONS[i % len(QUESTIONS)]))))
+    return replies
+
+
+def measure(replies: list[tuple[str, str]], constrained: bool) -> dict:
+    llm = Llm(
+        backend=FakeBackend(responses=[reply for _, reply in replies]),
+        max_batch_size=1,
+        constrained=constrained,
+    )
+    by_kind: dict[str, list[int]] = {}
+    accepted = 0
+    empty = 0
+    for i, (kind, _) in enumerate(replies):
+        prompt = QUESTIONS[i % len(QUESTIONS)]
+        try:
+            card = llm.generate(SOURCE_INPUT_JAVA, prompt)
+            ok = int(bool(card.back.strip()))
+            empty += not ok
+        except Exception:
+            ok = 0
+        accepted += ok
+        by_kind.setdefault(kind, []).append(ok)
+    return {
+        "constrained": constrained,
+        "total": len(replies),
+        "acceptance_rate": accepted / len(replies),
+        "failure_rate": 1 - accepted / len(replies),
+        "empty_answer_rate": empty / len(replies),
+        "by_kind": {k: sum(v) / len(v) for k, v in sorted(by_kind.items())},
+    }
+
+
+if __name__ == "__main__":
+    replies = build_replies(400)
+    report = [measure(replies, constrained=False), measure(replies, constrained=True)]
+    print(json.dumps(report, indent=2))
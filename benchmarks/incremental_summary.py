@@ -0,0 +1,89 @@
+"""
+Summary cache reuse after editing one sentence of a long text.
+
+Summarizes a long text built from the example source on the fake backend,
+then adds about ten words to the first sentence of one paragraph (at the
+start and in the middle) and summarizes it again with the same cache. Only the chunk holding
+the edit should go through the model again: chunk boundaries are placed by
+the text around them, not by a running token count that every later chunk
+would shift with. Reports the chunk summaries decoded again per edit and
+exits with status 1 if an edit changed any chunk but its own.
+
+    python -m benchmarks.incremental_summary
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+
+from example import SOURCE_INPUT_JAVA
+from lfm import FakeBackend, Llm
+from lfm.backend import default_responder
+from lfm.cache import GenerationCache
+from lfm.retrieval import chunk_source
+
+EDIT = "In a version edited to be about ten words longer, "
+
+
+def build_text(paragraphs: int, seed: int) -> str:
+    sentences = re.split(r"(?<=[.!?])\s+", " ".join(SOURCE_INPUT_JAVA.split()))
+    rng = random.Random(seed)
+    return "\n\n".join(
+        " ".join(f"{s[:-1]} (part {n})." for s in rng.sample(sentences, rng.randint(2, 6)))
+        for n in range(paragraphs)
+    )
+
+
+def summarize(text: str, cache: GenerationCache, budget: int) -> tuple[list[str], list[str]]:
+    """
+    Summarizes `text`; returns its chunks and those that reached the model.
+    """
+    seen = []
+
+    def respond(messages: list[dict]) -> str:
+        seen.append(messages[-1]["content"])
+        return default_responder(messages)
+
+    backend = FakeBackend(responses=respond)
+    Llm(backend=backend, cache=cache, source_token_budget=budget).summarize(text)
+    chunks = [p.text for p in chunk_source(text, lambda t: len(backend.encode(t)), budget)]
+    return chunks, [content for content in seen if content in chunks]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark summary cache reuse after an edit")
+    parser.add_argument("--paragraphs", type=int, default=120, help="paragraphs in the text")
+    parser.add_argument("--budget", type=int, default=256, help="source token budget")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    text = build_text(args.paragraphs, args.seed)
+    paragraphs = text.split("\n\n")
+    edits = {}
+    for name, n in (("first", 0), ("middle", args.paragraphs // 2)):
+        edited = list(paragraphs)
+        edited[n] = EDIT + edited[n]
+        edits[name] = "\n\n".join(edited)
+    report = {"budget": args.budget}
+    with tempfile.TemporaryDirectory() as directory:
+        cache = GenerationCache(os.path.join(directory, "cache.db"))
+        chunks, _ = summarize(text, cache, args.budget)
+        report["chunks"] = len(chunks)
+        for name, edited in edits.items():
+            edited_chunks, resummarized = summarize(edited, cache, args.budget)
+            # the chunk holding the edit is replaced, possibly by two if it
+            # no longer fits in one; any other chunk lost means boundaries moved
+            report[f"{name}_edit_chunks_changed"] = len(set(chunks) - set(edited_chunks))
+            report[f"{name}_edit_resummarized"] = len(resummarized)
+    print(json.dumps(report, indent=2))
+
+    if any(report[f"{name}_edit_chunks_changed"] > 1 for name in edits):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
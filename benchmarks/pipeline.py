@@ -0,0 +1,347 @@
+"""
+Throughput and latency of the generation pipeline on the fake backend.
+
+Measures `Llm.generate_batch` cards/s across batch sizes and source lengths,
+JSON post-processing throughput, `Flashcard` insert rate, and the latency of
+`/generate-batch`, `/summarize` and `/create-questions` under concurrent
+requests. Everything runs on `FakeBackend`, so runs are reproducible on any
+machine; with the default `--tps 0` the model itself costs nothing and the
+numbers are the pipeline's own overhead.
+
+The report is JSON. Pass an earlier report to `--compare` to list the
+metrics that got worse by more than `--tolerance` (exit status 1 if any):
+
+    python -m benchmarks.pipeline --output baseline.json
+    python -m benchmarks.pipeline --compare baseline.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from example import SOURCE_INPUT_JAVA
+from lfm import FakeBackend, Llm, LlmOutput
+from lfm.llm import CARD_KEYS
+from lfm.backend import default_responder
+from lfm.parsing import JsonStreamParser
+
+QUESTIONS = [
+    "Compared to C and C++, what issues does Java avoid?",
+    "What are applets?",
+    "When was Java 1.0 released?",
+    "Why did Sun create Java?",
+    "What did Java evolve into?",
+    "Which company released Java?",
+    "What does automatic memory management prevent?",
+    "What kind of programs did Java first target?",
+]
+
+BATCH_SIZES = [1, 4, 8]
+# the example source repeated, so retrieval has more passages to choose from
+SOURCE_REPEATS = [1, 4, 16]
+CONCURRENCY = [1, 4, 16]
+
+# a vocabulary large enough that random cards are not near-duplicates
+_rng = random.Random(1331)
+_WORDS = [
+    "".join(_rng.choice("bcdfghjklmnprstvz") + _rng.choice("aeiou") for _ in range(3))
+    for _ in range(5000)
+]
+
+
+def _timed(fn, repeat: int) -> float:
+    """
+    Best wall time of `repeat` calls, the least disturbed by other processes.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_generation(tps: float | None, repeat: int) -> list[dict]:
+    results = []
+    for repeats in SOURCE_REPEATS:
+        source = SOURCE_INPUT_JAVA * repeats
+        for batch_size in BATCH_SIZES:
+            backend = FakeBackend(tokens_per_second=tps)
+            llm = Llm(backend=backend, max_batch_size=batch_size)
+            cards = len(llm.generate_batch(source, QUESTIONS))
+            tokens = llm.generated_tokens
+            seconds = _timed(lambda: llm.generate_batch(source, QUESTIONS), repeat)
+            results.append(
+                {
+                    "batch_size": batch_size,
+                    "source_tokens": len(backend.encode(source)),
+                    "cards": cards,
+                    "seconds": seconds,
+                    "cards_per_second": cards / seconds,
+                    "tokens_per_second": tokens / seconds,
+                }
+            )
+    return results
+
+
+def _replies() -> list[str]:
+    return [
+        default_responder(
+            [
+                {"role": "system", "content": "Anki flashcard JSON"},
+                {"role": "user", "content": f"Source:\n{SOURCE_INPUT_JAVA}\n\nQuestion:\n{q}"},
+            ]
+        )
+        for q in QUESTIONS
+    ]
+
+
+def bench_parsing(repeat: int, rounds: int = 200) -> dict:
+    # replies split the way the model streams them, one token per chunk
+    backend = FakeBackend()
+    replies = [
+        (question, [backend.decode([t]) for t in backend.encode(reply)])
+        for question, reply in zip(QUESTIONS, _replies())
+    ]
+    characters = sum(len(c) for _, chunks in replies for c in chunks)
+
+    def parse_all():
+        for _ in range(rounds):
+            for question, chunks in replies:
+                # built the way Llm builds it, required keys and all
+                parser = JsonStreamParser(CARD_KEYS)
+                for chunk in chunks:
+                    if parser.feed(chunk):
+                        break
+                parser.finish()
+                data = parser.result()
+                data["front"] = question
+                data.setdefault("references", [])
+                data.setdefault("examples", [])
+                LlmOutput.model_validate(data)
+
+    seconds = _timed(parse_all, repeat)
+    count = rounds * len(replies)
+    return {
+        "replies": count,
+        "seconds": seconds,
+        "replies_per_second": count / seconds,
+        "characters_per_second": rounds * characters / seconds,
+    }
+
+
+def _random_card(rng: random.Random) -> LlmOutput:
+    def sentence(n: int) -> str:
+        return " ".join(rng.choice(_WORDS) for _ in range(n))
+
+    return LlmOutput(
+        front=sentence(8) + "?",
+        back=sentence(20) + ".",
+        references=["source, sentence 1"],
+        examples=[],
+    )
+
+
+def bench_db_insert(count: int, commit_every: int = 500) -> dict:
+    # lazy import, the other benchmarks do not need a database
+    from sqlmodel import Session
+
+    from lfm.db import add_flashcard, create_db_and_tables, make_engine
+
+    rng = random.Random(0)
+    cards = [_random_card(rng) for _ in range(count)]
+    with tempfile.TemporaryDirectory() as workdir:
+        engine = make_engine(os.path.join(workdir, "bench.db"))
+        create_db_and_tables(engine)
+        created = 0
+        start = time.perf_counter()
+        with Session(engine) as session:
+            for n, card in enumerate(cards, 1):
+                created += add_flashcard(session, card, batch_id="bench")[1]
+                if n % commit_every == 0:
+                    session.commit()
+            session.commit()
+        seconds = time.perf_counter() - start
+        engine.dispose()
+    return {
+        "cards": count,
+        "created": created,
+        "seconds": seconds,
+        "cards_per_second": count / seconds,
+    }
+
+
+def _load_app(workdir: str):
+    """
+    Imports the FastAPI app on the fake backend, storing cards in `workdir`.
+    """
+    os.environ["LFM_BACKEND"] = "fake"
+    os.environ["LFM_CACHE"] = "0"
+    import main
+    from lfm.db import create_db_and_tables, make_engine
+
+    main.engine = make_engine(os.path.join(workdir, "bench.db"))
+    create_db_and_tables(main.engine)
+    return main
+
+
+def _percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def _load(app, endpoint: str, concurrency: int, requests: int) -> dict:
+    import httpx
+
+    def form(i: int) -> dict:
+        # a distinct source per request, so the scheduler cannot coalesce them
+        data = {"source_text": f"{SOURCE_INPUT_JAVA}\nRequest {i}."}
+        if endpoint == "/generate-batch":
+            data["questions"] = "\n".join(QUESTIONS[:4])
+        return data
+
+    latencies: list[float] = []
+    statuses: dict[str, int] = {}
+    counter = iter(range(requests))
+
+    async def client_loop(client):
+        for i in counter:
+            start = time.perf_counter()
+            response = await client.post(endpoint, data=form(i))
+            latencies.append(time.perf_counter() - start)
+            statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+        seconds = time.perf_counter() - start
+    return {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": requests,
+        "statuses": statuses,
+        "requests_per_second": requests / seconds,
+        "latency_p50": statistics.median(latencies),
+        "latency_p95": _percentile(latencies, 0.95),
+        "latency_max": max(latencies),
+    }
+
+
+def bench_endpoints(requests: int) -> list[dict]:
+    with tempfile.TemporaryDirectory() as workdir:
+        main = _load_app(workdir)
+        results = []
+        for endpoint in ("/generate-batch", "/summarize", "/create-questions"):
+            for concurrency in CONCURRENCY:
+                results.append(asyncio.run(_load(main.app, endpoint, concurrency, requests)))
+        main.engine.dispose()
+    return results
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _metrics(report: dict) -> dict[str, float]:
+    """
+    Flattens a report into "section[params].metric" -> value.
+    """
+    flat = {}
+    for section, value in report.items():
+        if section == "meta":
+            continue
+        rows = value if isinstance(value, list) else [value]
+        for row in rows:
+            params = ",".join(
+                f"{k}={row[k]}"
+                for k in ("endpoint", "concurrency", "batch_size", "source_tokens")
+                if k in row
+            )
+            for name, metric in row.items():
+                if name.endswith("_per_second") or name.startswith("latency_"):
+                    flat[f"{section}[{params}].{name}"] = metric
+    return flat
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Metrics that are more than `tolerance` (a fraction) worse than in `baseline`.
+    """
+    current, previous = _metrics(report), _metrics(baseline)
+    regressions = []
+    for name, before in sorted(previous.items()):
+        after = current.get(name)
+        if after is None or not before:
+            continue
+        # throughputs should not drop, latencies should not grow
+        change = (after - before) / before
+        worse = -change if name.rsplit(".", 1)[1].endswith("_per_second") else change
+        if worse > tolerance:
+            regressions.append(f"{name}: {before:.4g} -> {after:.4g} ({change:+.0%})")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the generation pipeline")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="earlier JSON report to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="default: 0.2 (20%%)")
+    parser.add_argument(
+        "--tps", type=float, default=0, help="simulated decode tokens/s, 0 for no delay"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement")
+    parser.add_argument("--db-cards", type=int, default=2000)
+    parser.add_argument("--requests", type=int, default=32, help="requests per load level")
+    args = parser.parse_args()
+
+    if args.tps:
+        # the app builds its own backend from the environment
+        os.environ["LFM_FAKE_TPS"] = str(args.tps)
+    report = {
+        "meta": {
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "tps": args.tps,
+            "repeat": args.repeat,
+        },
+        "generation": bench_generation(args.tps or None, args.repeat),
+        "parsing": bench_parsing(args.repeat),
+        "db_insert": bench_db_insert(args.db_cards),
+        "endpoints": bench_endpoints(args.requests),
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"regression: {line}", file=sys.stderr)
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Prompt lookup speculative decoding against plain decoding.
+
+Generates the same flashcards and summary with and without
+`speculative=True` on the fake backend, checks the outputs are identical,
+and reports the draft acceptance rate, tokens per forward pass and the
+wall-clock speed-up at a simulated decode speed. The fake model spends one
+step per forward pass whatever the number of tokens verified in it, which
+is what makes drafting pay off on a memory-bound GPU too.
+
+    python -m benchmarks.speculative
+"""
+
+import argparse
+import json
+import time
+
+from example import SOURCE_INPUT_JAVA
+from lfm import FakeBackend, Llm
+
+QUESTIONS = [
+    "Compared to C and C++, what issues does Java avoid?",
+    "What are applets?",
+    "When was Java 1.0 released?",
+    "Why did Sun create Java?",
+    "What did Java evolve into?",
+]
+
+
+def run(speculative: bool, tps: float) -> dict:
+    llm = Llm(
+        backend=FakeBackend(tokens_per_second=tps),
+        max_batch_size=1,
+        speculative=speculative,
+    )
+    start = time.perf_counter()
+    cards = [llm.generate(SOURCE_INPUT_JAVA, q, use_cache=False) for q in QUESTIONS]
+    summary = llm.summarize(SOURCE_INPUT_JAVA, use_cache=False)
+    return {
+        "seconds": time.perf_counter() - start,
+        "tokens": llm.generated_tokens,
+        "drafted": llm.drafted_tokens,
+        "accepted": llm.accepted_tokens,
+        "outputs": [c.model_dump() for c in cards] + [summary],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark prompt lookup decoding")
+    parser.add_argument("--tps", type=float, default=200, help="simulated decode tokens/s")
+    args = parser.parse_args()
+
+    baseline = run(speculative=False, tps=args.tps)
+    speculative = run(speculative=True, tps=args.tps)
+    # each forward pass adds one token of its own on top of the accepted draft
+    steps = speculative["tokens"] - speculative["accepted"]
+
+    report = {
+        "tps": args.tps,
+        "identical_output": baseline["outputs"] == speculative["outputs"],
+        "tokens": speculative["tokens"],
+        "drafted_tokens": speculative["drafted"],
+        "accepted_tokens": speculative["accepted"],
+        "acceptance_rate": speculative["accepted"] / max(speculative["drafted"], 1),
+        "tokens_per_step": speculative["tokens"] / max(steps, 1),
+        "baseline_seconds": baseline["seconds"],
+        "speculative_seconds": speculative["seconds"],
+        "speedup": baseline["seconds"] / speculative["seconds"],
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+from .backend import Backend, FakeBackend, MlxBackend, get_backend
 from .llm import Llm, LlmOutput
 
-__all__ = ["Llm", "LlmOutput"]
\ No newline at end of file
+__all__ = ["Backend", "FakeBackend", "Llm", "LlmOutput", "MlxBackend", "get_backend"]
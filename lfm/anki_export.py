@@ -0,0 +1,118 @@
+"""
+Anki package (.apkg) export of stored flashcards.
+"""
+
+import copy
+import html
+import os
+import shutil
+import tempfile
+from typing import TYPE_CHECKING, Iterable
+
+if TYPE_CHECKING:
+    from sqlalchemy import Row
+
+NOTETYPE_NAME = "LLM Flashcard"
+FIELDS = ["Front", "Back", "References", "Examples"]
+
+_ANSWER_TEMPLATE = """{{FrontSide}}
+
+<hr id=answer>
+
+{{Back}}
+{{#Examples}}<div class="examples"><b>Examples</b>{{Examples}}</div>{{/Examples}}
+{{#References}}<div class="references">{{References}}</div>{{/References}}"""
+
+_CSS = """.card { font-family: sans-serif; font-size: 20px; text-align: left; }
+.references { margin-top: 1em; font-size: 14px; color: #666; }"""
+
+
+def _list_html(items: list[str]) -> str:
+    if not items:
+        return ""
+    return "<ul>" + "".join(f"<li>{html.escape(item)}</li>" for item in items) + "</ul>"
+
+
+def _notetype(col) -> dict:
+    notetype = col.models.by_name(NOTETYPE_NAME)
+    if notetype is not None:
+        return notetype
+
+    models = col.models
+    notetype = models.new(NOTETYPE_NAME)
+    for name in FIELDS:
+        models.add_field(notetype, models.new_field(name))
+    template = models.new_template("Card 1")
+    template["qfmt"] = "{{Front}}"
+    template["afmt"] = _ANSWER_TEMPLATE
+    models.add_template(notetype, template)
+    notetype["css"] = _CSS
+    models.add(notetype)
+    return models.by_name(NOTETYPE_NAME)
+
+
+def write_apkg(
+    flashcards: Iterable["Row"],
+    out_path: str,
+    deck_name: str = "LLM Flashcards",
+    chunk_size: int = 1000,
+) -> int:
+    """
+    Writes flashcards (rows from `iter_flashcards`, or anything with the
+    same attributes) to an .apkg file at `out_path` and returns how many
+    notes it holds. Cards are consumed as they come and added `chunk_size`
+    notes per transaction. Note guids are the flashcard ids, so importing a
+    newer export of the same cards updates them instead of duplicating.
+    """
+    # lazy import
+    from anki.collection import (  # type: ignore
+        AddNoteRequest,
+        Collection,
+        DeckIdLimit,
+        ExportAnkiPackageOptions,
+    )
+
+    workdir = tempfile.mkdtemp(prefix="lfm-apkg-")
+    col = Collection(os.path.join(workdir, "collection.anki2"))
+    try:
+        notetype = _notetype(col)
+        deck_id = col.decks.id(deck_name)
+        # copying a blank note avoids a backend round trip per card
+        blank = col.new_note(notetype)
+
+        count = 0
+        requests = []
+        for flashcard in flashcards:
+            note = copy.copy(blank)
+            note.guid = flashcard.id.hex
+            note.fields = [
+                html.escape(flashcard.front),
+                html.escape(flashcard.back),
+                _list_html(flashcard.references),
+                _list_html(flashcard.examples),
+            ]
+            requests.append(AddNoteRequest(note, deck_id))
+            if len(requests) == chunk_size:
+                col.add_notes(requests)
+                count += len(requests)
+                requests = []
+        if requests:
+            col.add_notes(requests)
+            count += len(requests)
+
+        col.export_anki_package(
+            out_path=out_path,
+            options=ExportAnkiPackageOptions(
+                with_scheduling=False,
+                with_deck_configs=False,
+                with_media=False,
+                legacy=False,
+            ),
+            limit=DeckIdLimit(deck_id),
+        )
+        return count
+    except Exception as e:
+        raise RuntimeError(f"Error exporting Anki package: {str(e)}")
+    finally:
+        col.close()
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,1021 @@
+import copy
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Iterator
+
+from .constrain import CardConstraint, TokenIndex
+from .speculative import PromptLookup
+
+END_OF_TURN = "<end_of_turn>"
+START_OF_TURN = "<start_of_turn>"
+BOS = "<bos>"
+PAD = "<pad>"
+
+
+@dataclass
+class GenerationResponse:
+    """
+    One streamed step, mirroring the fields of `mlx_lm.generate.GenerationResponse`.
+    """
+
+    text: str
+    token: int | None
+    prompt_tokens: int = 0
+    prompt_tps: float = 0.0
+    generation_tokens: int = 0
+    generation_tps: float = 0.0
+    peak_memory: float = 0.0
+    finish_reason: str | None = None
+    from_draft: bool = False
+
+
+class Backend:
+    """
+    Inference runtime used by `Llm`.
+
+    A backend owns the model weights and tokenizer. Prompts are passed around
+    as token id lists so that callers can cache and slice them.
+    """
+
+    name = "base"
+
+    def __init__(self):
+        self._is_loaded = False
+
+    def load(self, repo: str) -> None:
+        raise NotImplementedError
+
+    def load_tokenizer(self, repo: str) -> None:
+        """
+        Loads only what `apply_chat_template`, `encode` and `decode` need,
+        for processes that count tokens but never run the model.
+        """
+        self.load(repo)
+
+    def apply_chat_template(
+        self, messages: list[dict], add_generation_prompt: bool = True
+    ) -> list[int]:
+        raise NotImplementedError
+
+    def encode(self, text: str) -> list[int]:
+        raise NotImplementedError
+
+    def decode(self, tokens: list[int]) -> str:
+        raise NotImplementedError
+
+    def make_prompt_cache(self, prefix: list[int]) -> object:
+        """
+        Returns a cache holding the model state after `prefix`. Pass a copy
+        of it as `prompt_cache` to `stream` with only the remaining tokens.
+        """
+        raise NotImplementedError
+
+    def copy_prompt_cache(self, cache: object) -> object:
+        return copy.deepcopy(cache)
+
+    def cached_tokens(self, cache: object) -> int:
+        """
+        How many tokens of context `cache` holds.
+        """
+        raise NotImplementedError
+
+    def trim_prompt_cache(self, cache: object, count: int) -> bool:
+        """
+        Drops the last `count` tokens from `cache`; False if it cannot.
+        """
+        return False
+
+    def resume(
+        self,
+        context: list[int],
+        max_tokens: int = 512,
+        prompt_cache: object | None = None,
+        constraint: CardConstraint | None = None,
+    ) -> Iterator[GenerationResponse]:
+        """
+        Continues a reply that stopped at its token limit. `context` is the
+        prompt followed by the reply so far and `prompt_cache` the cache the
+        reply was decoded into, if any; only the tokens it does not hold yet
+        are fed again. Without a usable cache the context is prefilled anew,
+        which still spares decoding the reply a second time.
+        """
+        covered = self.cached_tokens(prompt_cache) if prompt_cache is not None else 0
+        # the last token has to go through the model to predict the next one
+        if covered >= len(context) and not self.trim_prompt_cache(
+            prompt_cache, covered - len(context) + 1
+        ):
+            covered = 0
+        covered = min(covered, len(context) - 1)
+        if not covered:
+            prompt_cache = self.make_prompt_cache(context[:-1])
+            covered = len(context) - 1
+        return self.stream(
+            context[covered:], max_tokens, prompt_cache=prompt_cache, constraint=constraint
+        )
+
+    def stream(
+        self,
+        prompt: list[int],
+        max_tokens: int = 512,
+        prompt_cache: object | None = None,
+        constraint: CardConstraint | None = None,
+        lookup: PromptLookup | None = None,
+    ) -> Iterator[GenerationResponse]:
+        """
+        Streams a reply to `prompt`. With a `constraint`, tokens that would
+        break it are masked out, so the reply always matches its grammar.
+        With a `lookup`, drafts from it are verified several tokens per
+        forward pass (ignored together with a constraint); the reply is the
+        same, and tokens taken from a draft have `from_draft` set.
+        """
+        raise NotImplementedError
+
+    def stream_batch(
+        self,
+        prompts: list[list[int]],
+        max_tokens: int = 512,
+        prefix: list[int] | None = None,
+        stop: set[int] | None = None,
+        constraints: list[CardConstraint] | None = None,
+        incoming: Callable[[], list[list[int]]] | None = None,
+    ) -> Iterator[tuple[int, GenerationResponse]]:
+        """
+        Decodes every prompt together, one forward pass per step, yielding
+        (row, response) pairs. Each row ends with a response carrying its
+        finish_reason. `prefix` is prepended to every row and prefilled once.
+        Rows the caller adds to `stop` are dropped without a final response.
+        `constraints` holds one constraint per row, as in `stream`.
+
+        `incoming` is called between steps; the prompts it returns join the
+        batch as new rows, numbered on from the rows before them, and the
+        caller appends their constraints to `constraints` first. The batch
+        ends once every row has finished and `incoming` returns nothing.
+        """
+        raise NotImplementedError
+
+    @property
+    def supports_batch(self) -> bool:
+        return type(self).stream_batch is not Backend.stream_batch
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._is_loaded
+
+
+class MlxBackend(Backend):
+    """
+    Apple silicon backend built on `mlx_lm`.
+    """
+
+    name = "mlx"
+
+    def __init__(self):
+        super().__init__()
+        self._model = None
+        self._tokenizer = None
+        self._stream_generate = None
+        self._batch_prefix: tuple[tuple[int, ...], list] | None = None
+        self._token_index: TokenIndex | None = None
+        self._string_safe_mask = None
+
+    def load(self, repo: str) -> None:
+        # lazy import
+        from mlx_lm import load, stream_generate  # type: ignore
+
+        self._stream_generate = stream_generate  # cache function ref
+        self._model, self._tokenizer = load(
+            repo, tokenizer_config={"eos_token": END_OF_TURN}
+        )
+        # self._model, self._tokenizer = load(repo, adapter_path="../data_anomaly_adapters")
+        self._is_loaded = True
+
+    def load_tokenizer(self, repo: str) -> None:
+        # lazy import, transformers comes with mlx_lm
+        from transformers import AutoTokenizer  # type: ignore
+
+        self._tokenizer = AutoTokenizer.from_pretrained(repo)
+
+    def apply_chat_template(
+        self, messages: list[dict], add_generation_prompt: bool = True
+    ) -> list[int]:
+        return self._tokenizer.apply_chat_template(
+            messages, add_generation_prompt=add_generation_prompt
+        )
+
+    def encode(self, text: str) -> list[int]:
+        return self._tokenizer.encode(text, add_special_tokens=False)
+
+    def decode(self, tokens: list[int]) -> str:
+        return self._tokenizer.decode(tokens)
+
+    def make_prompt_cache(self, prefix: list[int]) -> object:
+        import mlx.core as mx  # type: ignore
+        from mlx_lm.models.cache import make_prompt_cache  # type: ignore
+
+        cache = make_prompt_cache(self._model)
+        tokens = mx.array(prefix)
+        step = 2048
+        while tokens.size > 0:
+            self._model(tokens[:step][None], cache=cache)
+            mx.eval([c.state for c in cache])
+            tokens = tokens[step:]
+        return cache
+
+    def cached_tokens(self, cache: list) -> int:
+        return cache[0].offset if cache else 0
+
+    def trim_prompt_cache(self, cache: list, count: int) -> bool:
+        from mlx_lm.models.cache import can_trim_prompt_cache, trim_prompt_cache  # type: ignore
+
+        if not can_trim_prompt_cache(cache):
+            return False
+        return trim_prompt_cache(cache, count) == count
+
+    def _index(self) -> TokenIndex:
+        if self._token_index is None:
+            tokenizer = self._tokenizer
+            special = set(tokenizer.all_special_ids) | set(tokenizer.added_tokens_decoder)
+            texts = []
+            for token, piece in enumerate(
+                tokenizer.convert_ids_to_tokens(list(range(len(tokenizer.get_vocab()))))
+            ):
+                if token in special or piece is None:
+                    texts.append("")
+                elif piece.startswith("<0x") and piece.endswith(">"):
+                    # byte fallback; bytes of multi-byte characters are plain text
+                    byte = int(piece[3:-1], 16)
+                    texts.append(chr(byte) if byte < 0x80 else "\u00ff")
+                else:
+                    texts.append(
+                        piece.replace("\u2581", " ").replace("\u0120", " ").replace("\u010a", "\n")
+                    )
+            self._token_index = TokenIndex(texts, tokenizer.eos_token_ids)
+        return self._token_index
+
+    def _constraint_bias(self, constraint: CardConstraint, size: int):
+        import mlx.core as mx  # type: ignore
+
+        index = self._index()
+        if self._string_safe_mask is None or self._string_safe_mask.size != size:
+            mask = mx.zeros((size,), dtype=mx.bool_)
+            mask[mx.array(index.string_safe)] = True
+            self._string_safe_mask = mask
+
+        use_safe, extra = constraint.allowed_tokens(index)
+        if use_safe:
+            allowed = mx.array(self._string_safe_mask)
+        else:
+            allowed = mx.zeros((size,), dtype=mx.bool_)
+        if extra:
+            allowed[mx.array(extra)] = True
+        return mx.where(allowed, 0.0, -mx.inf)
+
+    def _constraint_processor(self, constraint: CardConstraint) -> Callable:
+        index = self._index()
+        seen = None
+
+        def processor(tokens, logits):
+            nonlocal seen
+            # the first call only sees the prompt, later ones one new token each
+            if seen is not None:
+                for token in tokens[seen:].tolist():
+                    constraint.advance(index.texts[token])
+            seen = tokens.size
+            return logits + self._constraint_bias(constraint, logits.shape[-1])
+
+        return processor
+
+    def stream(
+        self,
+        prompt: list[int],
+        max_tokens: int = 512,
+        prompt_cache: object | None = None,
+        constraint: CardConstraint | None = None,
+        lookup: PromptLookup | None = None,
+    ) -> Iterator[GenerationResponse]:
+        if lookup is not None and constraint is None:
+            yield from self._stream_lookup(prompt, max_tokens, prompt_cache, lookup)
+            return
+        kwargs = {"prompt_cache": prompt_cache} if prompt_cache is not None else {}
+        if constraint is not None:
+            kwargs["logits_processors"] = [self._constraint_processor(constraint)]
+        yield from self._stream_generate(
+            model=self._model,
+            tokenizer=self._tokenizer,
+            prompt=prompt,
+            max_tokens=max_tokens,
+            **kwargs,
+        )
+
+    def _stream_lookup(
+        self,
+        prompt: list[int],
+        max_tokens: int,
+        prompt_cache: list | None,
+        lookup: PromptLookup,
+    ) -> Iterator[GenerationResponse]:
+        """
+        Greedy decoding that verifies prompt lookup drafts: the last token
+        and its draft go through the model in one pass, and the draft is
+        kept up to the first token the model would not have picked.
+
+        Rejected draft tokens are trimmed off the KV cache. Sliding-window
+        caches that have wrapped around cannot be trimmed, so their state
+        is saved before the pass and the accepted tokens are fed again.
+        """
+        import mlx.core as mx  # type: ignore
+        from mlx_lm.models.cache import (  # type: ignore
+            can_trim_prompt_cache,
+            make_prompt_cache,
+            trim_prompt_cache,
+        )
+
+        model = self._model
+        cache = prompt_cache if prompt_cache is not None else make_prompt_cache(model)
+        eos = self._tokenizer.eos_token_ids
+        detokenizer = copy.copy(self._tokenizer.detokenizer)
+        detokenizer.reset()
+
+        tic = time.perf_counter()
+        tokens = mx.array(prompt)
+        step = 2048
+        while tokens.size > step:
+            model(tokens[:step][None], cache=cache)
+            mx.eval([c.state for c in cache])
+            tokens = tokens[step:]
+        pending = [mx.argmax(model(tokens[None], cache=cache)[0, -1]).item()]
+        prompt_tps = len(prompt) / (time.perf_counter() - tic)
+        tic = time.perf_counter()
+
+        generated: list[int] = []
+        drafted = 0  # how many tokens at the start of `pending` came from a draft
+
+        def response(token, finish_reason=None, from_draft=False):
+            return GenerationResponse(
+                text=detokenizer.last_segment,
+                token=token,
+                prompt_tokens=len(prompt),
+                prompt_tps=prompt_tps,
+                generation_tokens=len(generated),
+                generation_tps=len(generated) / (time.perf_counter() - tic),
+                peak_memory=mx.get_peak_memory() / 1e9,
+                finish_reason=finish_reason,
+                from_draft=from_draft,
+            )
+
+        while True:
+            # every pending token but the last is already in the cache
+            for i, token in enumerate(pending):
+                if token in eos:
+                    detokenizer.finalize()
+                    yield response(token, "stop")
+                    return
+                detokenizer.add_token(token)
+                generated.append(token)
+                if len(generated) == max_tokens:
+                    detokenizer.finalize()
+                    yield response(token, "length")
+                    return
+                yield response(token, from_draft=i < drafted)
+
+            last = pending[-1]
+            draft = lookup.draft(generated, max_tokens - len(generated) - 1)
+            trimmable = can_trim_prompt_cache(cache)
+            saved = None
+            if draft and not trimmable:
+                saved = [(c.state, c.meta_state) for c in cache]
+
+            logits = model(mx.array([last] + draft)[None], cache=cache)[0]
+            predicted = mx.argmax(logits, axis=-1).tolist()
+            accepted = 0
+            while accepted < len(draft) and draft[accepted] == predicted[accepted]:
+                accepted += 1
+            lookup.record(len(draft), accepted)
+
+            rejected = len(draft) - accepted
+            if rejected and trimmable:
+                trim_prompt_cache(cache, rejected)
+            elif rejected:
+                for c, (state, meta_state) in zip(cache, saved):
+                    c.state, c.meta_state = state, meta_state
+                model(mx.array([last] + draft[:accepted])[None], cache=cache)
+                mx.eval([c.state for c in cache])
+            pending = draft[:accepted] + [predicted[accepted]]
+            drafted = accepted
+
+    def _batch_cache(self, prefix: list[int], size: int) -> list:
+        import mlx.core as mx  # type: ignore
+        from mlx_lm.models.cache import KVCache  # type: ignore
+
+        # plain KV caches on every layer: rotating caches cannot carry a padding mask
+        cache = [KVCache() for _ in self._model.layers]
+        if not prefix:
+            return cache
+
+        if self._batch_prefix is None or self._batch_prefix[0] != tuple(prefix):
+            prefix_cache = [KVCache() for _ in self._model.layers]
+            self._model(mx.array(prefix)[None], cache=prefix_cache)
+            mx.eval([c.state for c in prefix_cache])
+            self._batch_prefix = (tuple(prefix), prefix_cache)
+
+        for c, p in zip(cache, self._batch_prefix[1]):
+            keys, values = p.state
+            c.update_and_fetch(
+                mx.repeat(keys, size, axis=0), mx.repeat(values, size, axis=0)
+            )
+        return cache
+
+    def stream_batch(
+        self,
+        prompts: list[list[int]],
+        max_tokens: int = 512,
+        prefix: list[int] | None = None,
+        stop: set[int] | None = None,
+        constraints: list[CardConstraint] | None = None,
+        incoming: Callable[[], list[list[int]]] | None = None,
+    ) -> Iterator[tuple[int, GenerationResponse]]:
+        """
+        Greedy batched decoding with left padding.
+
+        Every layer keeps a full KV cache here, so sliding-window layers see
+        the whole context and long prompts can decode slightly differently
+        than with `stream`. Rows joining a running batch are prefilled on
+        their own, padded so that their prompt ends where the running rows
+        stand, and stacked onto its cache; a prompt too long for that pads
+        the running rows after the prefix instead.
+        """
+        import mlx.core as mx  # type: ignore
+
+        prefix = prefix or []
+        prompts = list(prompts)
+        pad = self._tokenizer.pad_token_id or 0
+        eos = self._tokenizer.eos_token_ids
+        stop = stop if stop is not None else set()
+
+        cache: list | None = None
+        # which cache positions of each batch row hold real tokens
+        valid = None
+        y = None
+        rows: list[int] = []  # batch position -> row
+        active: set[int] = set()
+        detokenizers = []
+        counts: list[int] = []
+        prompt_tps: list[float] = []
+        started: list[float] = []
+
+        def constrain(logits, rows):
+            if constraints is None:
+                return logits
+            bias = [self._constraint_bias(constraints[r], logits.shape[-1]) for r in rows]
+            return logits + mx.stack(bias)
+
+        def join(new: list[int]) -> None:
+            nonlocal cache, valid, y, rows
+            tic = time.perf_counter()
+            width = max(len(prompts[r]) for r in new)
+            offset = len(prefix)
+            current = cache[0].offset if cache else offset
+            end = max(current, offset + width)
+            if cache and end > current:
+                # padding between prefix and prompt, as for shorter prompts
+                gap = end - current
+                for c in cache:
+                    keys, values = c.state
+                    c.state = tuple(
+                        mx.concatenate(
+                            [
+                                a[..., :offset, :],
+                                mx.zeros((*a.shape[:2], gap, a.shape[3]), dtype=a.dtype),
+                                a[..., offset:, :],
+                            ],
+                            axis=2,
+                        )
+                        for a in (keys, values)
+                    )
+                padding = mx.zeros((len(rows), gap), dtype=mx.bool_)
+                valid = mx.concatenate([valid[:, :offset], padding, valid[:, offset:]], axis=1)
+
+            joined = self._batch_cache(prefix, len(new))
+            start = end - width
+            if start > offset:
+                # masked positions the running rows have already decoded
+                for c, running in zip(joined, cache):
+                    keys, values = running.state
+                    shape = (len(new), keys.shape[1], start - offset, keys.shape[3])
+                    c.update_and_fetch(
+                        mx.zeros(shape, dtype=keys.dtype), mx.zeros(shape, dtype=values.dtype)
+                    )
+            tokens = mx.array([[pad] * (width - len(prompts[r])) + prompts[r] for r in new])
+            new_valid = mx.array(
+                [
+                    [True] * offset
+                    + [False] * (end - offset - len(prompts[r]))
+                    + [True] * len(prompts[r])
+                    for r in new
+                ]
+            )
+            # padded positions still see themselves so that no row attends to nothing
+            queries = mx.arange(start, end)[:, None]
+            keys = mx.arange(end)[None]
+            mask = ((keys <= queries)[None] & new_valid[:, None, :]) | (keys == queries)[None]
+            logits = self._model(tokens, cache=joined, mask=mask[:, None])[:, -1, :]
+            new_y = mx.argmax(constrain(logits, new), axis=-1)
+            mx.eval(new_y)
+            now = time.perf_counter()
+            tps = len(new) * width / (now - tic)
+
+            if cache:
+                for c, j in zip(cache, joined):
+                    c.state = tuple(
+                        mx.concatenate([a, b], axis=0) for a, b in zip(c.state, j.state)
+                    )
+                valid = mx.concatenate([valid, new_valid], axis=0)
+                y = mx.concatenate([y, new_y])
+            else:
+                cache, valid, y, rows = joined, new_valid, new_y, []
+            rows += new
+            active.update(new)
+            for _ in new:
+                detokenizer = copy.copy(self._tokenizer.detokenizer)
+                detokenizer.reset()
+                detokenizers.append(detokenizer)
+                counts.append(0)
+                prompt_tps.append(tps)
+                started.append(now)
+
+        def arrivals() -> list[int]:
+            new = incoming() if incoming is not None else []
+            prompts.extend(new)
+            return list(range(len(prompts) - len(new), len(prompts)))
+
+        join(list(range(len(prompts))))
+
+        def response(row, token, finish_reason=None):
+            return GenerationResponse(
+                text=detokenizers[row].last_segment,
+                token=token,
+                prompt_tokens=len(prefix) + len(prompts[row]),
+                prompt_tps=prompt_tps[row],
+                generation_tokens=counts[row],
+                generation_tps=counts[row] / (time.perf_counter() - started[row]),
+                peak_memory=mx.get_peak_memory() / 1e9,
+                finish_reason=finish_reason,
+            )
+
+        while True:
+            for position, token in enumerate(y.tolist()):
+                row = rows[position]
+                if row not in active or row in stop:
+                    continue
+                if token in eos:
+                    detokenizers[row].finalize()
+                    active.discard(row)
+                    yield row, response(row, token, "stop")
+                    continue
+                detokenizers[row].add_token(token)
+                counts[row] += 1
+                if constraints is not None:
+                    constraints[row].advance(self._index().texts[token])
+                yield row, response(row, token)
+                if counts[row] == max_tokens:
+                    detokenizers[row].finalize()
+                    active.discard(row)
+                    yield row, response(row, token, "length")
+            active -= stop
+            new = arrivals()
+            if not active:
+                if not new:
+                    break
+                # nothing left to decode, the new rows start a batch of their own
+                cache = None
+                join(new)
+                continue
+
+            keep = [position for position, row in enumerate(rows) if row in active]
+            if len(keep) < len(rows):
+                # drop finished rows so they stop costing compute
+                index = mx.array(keep)
+                for c in cache:
+                    c.keys, c.values = c.keys[index], c.values[index]
+                valid, y = valid[index], y[index]
+                rows = [rows[position] for position in keep]
+
+            valid = mx.concatenate(
+                [valid, mx.ones((len(rows), 1), dtype=mx.bool_)], axis=1
+            )
+            logits = self._model(y[:, None], cache=cache, mask=valid[:, None, None, :])
+            y = mx.argmax(constrain(logits[:, -1, :], rows), axis=-1)
+            mx.eval(y)
+            if new:
+                join(new)
+
+
+_TOKEN_PATTERN = re.compile(
+    "|".join(re.escape(s) for s in (START_OF_TURN, END_OF_TURN, BOS, PAD))
+    + r"|\s+|\w+|`+|[^\w\s]"
+)
+_SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+")
+_PASSAGE_PATTERN = re.compile(r"^\[(\d+)\] (.*)$", re.MULTILINE)
+
+
+def _sentences(text: str) -> list[str]:
+    return [s.strip() for s in _SENTENCE_PATTERN.split(text) if s.strip()]
+
+
+def _words(text: str) -> set[str]:
+    return {w.lower() for w in re.findall(r"\w+", text) if len(w) > 3}
+
+
+def default_responder(messages: list[dict]) -> str:
+    """
+    Scripted answers for the three system prompts used by `Llm`.
+
+    Flashcard answers quote the source sentence that shares the most words
+    with the question, wrapped in a json fence the way the real model tends
+    to reply.
+    """
+    system = next((m["content"] for m in messages if m["role"] == "system"), "")
+    text = "\n".join(m["content"] for m in messages if m["role"] != "system")
+
+    if "Anki flashcard JSON" in system:
+        source, _, question = text.rpartition("Question:\n")
+        source = source.removeprefix("Source:\n").strip()
+        # retrieved passages come one per line as "[id] text"
+        passages = _PASSAGE_PATTERN.findall(source)
+        if passages:
+            sentences = [
+                (f"[{label}]", s) for label, text in passages for s in _sentences(text)
+            ]
+        else:
+            sentences = [
+                (f"source, sentence {i}", s)
+                for i, s in enumerate(_sentences(source) or [source.strip()], 1)
+            ]
+        wanted = _words(question)
+        best = max(
+            range(len(sentences)),
+            key=lambda i: (len(wanted & _words(sentences[i][1])), -i),
+        )
+        reference, sentence = sentences[best]
+        back = sentence.replace('"', "'")
+        card = (
+            '{"back": "' + back + '", '
+            '"references": ["' + reference + '"], '
+            '"examples": []}'
+        )
+        return "```json\n" + card + "\n```"
+
+    if "study questions" in system:
+        lines = []
+        for i, sentence in enumerate(_sentences(text)[:10], 1):
+            topic = " ".join(sentence.split()[:6]).rstrip(",.;:")
+            lines.append(f"{i}. What does the source say about {topic}?")
+        return "\n".join(lines)
+
+    return "\n".join(f"- {s}" for s in _sentences(text))
+
+
+@dataclass
+class FakePromptCache:
+    tokens: list[int]
+
+
+class FakeBackend(Backend):
+    """
+    Deterministic CPU stand-in for a real model.
+
+    Responses come from `responses`: a list of strings replayed in order, a
+    callable receiving the chat messages, or None for `default_responder`.
+    Tokens are streamed at `tokens_per_second` after a simulated prefill at
+    `prompt_tokens_per_second`; either left as None means no delay.
+    """
+
+    name = "fake"
+
+    def __init__(
+        self,
+        responses: list[str] | Callable[[list[dict]], str] | None = None,
+        tokens_per_second: float | None = None,
+        prompt_tokens_per_second: float | None = None,
+    ):
+        super().__init__()
+        self._responses = responses
+        self._response_index = 0
+        self.tokens_per_second = tokens_per_second
+        self.prompt_tokens_per_second = prompt_tokens_per_second
+
+        self._batch_prefix: tuple[int, ...] | None = None
+        # recent replies by prompt, for resuming them
+        self._replies: dict[tuple[int, ...], list[int]] = {}
+
+        self._lock = threading.Lock()
+        self._vocab: dict[str, int] = {}
+        self._id_to_text: list[str] = []
+        for special in (PAD, BOS, START_OF_TURN, END_OF_TURN):
+            self._token_id(special)
+
+    def _token_id(self, text: str) -> int:
+        with self._lock:
+            token = self._vocab.get(text)
+            if token is None:
+                token = len(self._id_to_text)
+                self._vocab[text] = token
+                self._id_to_text.append(text)
+            return token
+
+    def load(self, repo: str) -> None:
+        self._is_loaded = True
+
+    def apply_chat_template(
+        self, messages: list[dict], add_generation_prompt: bool = True
+    ) -> list[int]:
+        text = BOS
+        for message in messages:
+            text += f"{START_OF_TURN}{message['role']}\n{message['content']}{END_OF_TURN}\n"
+        if add_generation_prompt:
+            text += f"{START_OF_TURN}model\n"
+        return self.encode(text)
+
+    def encode(self, text: str) -> list[int]:
+        return [self._token_id(t) for t in _TOKEN_PATTERN.findall(text)]
+
+    def decode(self, tokens: list[int]) -> str:
+        return "".join(self._id_to_text[t] for t in tokens)
+
+    def _messages(self, prompt: list[int]) -> list[dict]:
+        messages = []
+        for turn in self.decode(prompt).split(START_OF_TURN)[1:]:
+            role, _, content = turn.partition("\n")
+            content = content.rsplit(END_OF_TURN, 1)[0]
+            if role != "model" or content:
+                messages.append({"role": role, "content": content})
+        return messages
+
+    def _reply(self, context: list[int]) -> list[int]:
+        """
+        Reply tokens for `context`. A context that ends inside the model's
+        turn is a resumed reply and gets the rest of the reply to its prompt.
+        """
+        turn = self.encode(f"{START_OF_TURN}model\n")
+        for start in range(len(context) - len(turn), -1, -1):
+            if context[start : start + len(turn)] == turn:
+                break
+        else:
+            return self.encode(self._respond(context))
+        prompt, partial = context[: start + len(turn)], context[start + len(turn) :]
+        if not partial:
+            return self.encode(self._respond(context))
+        with self._lock:
+            reply = self._replies.get(tuple(prompt))
+        if reply is None:
+            reply = self.encode(self._respond(prompt))
+        return reply[len(partial) :] if reply[: len(partial)] == partial else []
+
+    def _respond(self, prompt: list[int]) -> str:
+        if callable(self._responses):
+            return self._responses(self._messages(prompt))
+        if self._responses:
+            with self._lock:
+                response = self._responses[
+                    self._response_index % len(self._responses)
+                ]
+                self._response_index += 1
+            return response
+        return default_responder(self._messages(prompt))
+
+    def _remember(self, context: list[int], reply: list[int]) -> None:
+        with self._lock:
+            if len(self._replies) >= 256:
+                self._replies.pop(next(iter(self._replies)))
+            self._replies[tuple(context)] = reply
+
+    @staticmethod
+    def _wait_until(deadline: float) -> None:
+        delay = deadline - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _prefill(self, count: int) -> float:
+        start = time.perf_counter()
+        if self.prompt_tokens_per_second:
+            self._wait_until(start + count / self.prompt_tokens_per_second)
+        prompt_time = time.perf_counter() - start
+        return count / prompt_time if prompt_time > 0 else 0.0
+
+    def make_prompt_cache(self, prefix: list[int]) -> FakePromptCache:
+        self._prefill(len(prefix))
+        return FakePromptCache(tokens=list(prefix))
+
+    def copy_prompt_cache(self, cache: FakePromptCache) -> FakePromptCache:
+        return FakePromptCache(tokens=list(cache.tokens))
+
+    def cached_tokens(self, cache: FakePromptCache) -> int:
+        return len(cache.tokens)
+
+    def trim_prompt_cache(self, cache: FakePromptCache, count: int) -> bool:
+        del cache.tokens[len(cache.tokens) - count :]
+        return True
+
+    def _response(
+        self, token: int, prompt_tokens: int, prompt_tps: float, n: int, start: float
+    ) -> GenerationResponse:
+        elapsed = time.perf_counter() - start
+        return GenerationResponse(
+            text=self._id_to_text[token],
+            token=token,
+            prompt_tokens=prompt_tokens,
+            prompt_tps=prompt_tps,
+            generation_tokens=n,
+            generation_tps=n / elapsed if elapsed > 0 else 0.0,
+        )
+
+    def _constrained(
+        self, tokens: list[int], constraint: CardConstraint, max_tokens: int
+    ) -> list[int]:
+        """
+        Emulates logit masking: a masked-out token gives way to the next
+        scripted token the constraint allows, and once the script runs out
+        the mask can only close the object. An answer that is still empty
+        at that point is written from the masked-out tokens, which is where
+        the model's probability goes when it may not close the string.
+        """
+        out = []
+        skipped = []
+        refilled = False
+        i = 0
+        while not constraint.complete and len(out) < max_tokens:
+            while i < len(tokens) and not constraint.accepts(self._id_to_text[tokens[i]]):
+                skipped.append(tokens[i])
+                i += 1
+            if i == len(tokens):
+                for ch in constraint.completion():
+                    if constraint.needs_text and skipped and not refilled:
+                        break
+                    constraint.advance(ch)
+                    out.append(self._token_id(ch))
+                if constraint.complete:
+                    break
+                tokens, skipped, i, refilled = skipped, [], 0, True
+                continue
+            constraint.advance(self._id_to_text[tokens[i]])
+            out.append(tokens[i])
+            i += 1
+        return out
+
+    def stream(
+        self,
+        prompt: list[int],
+        max_tokens: int = 512,
+        prompt_cache: FakePromptCache | None = None,
+        constraint: CardConstraint | None = None,
+        lookup: PromptLookup | None = None,
+    ) -> Iterator[GenerationResponse]:
+        prompt_tps = self._prefill(len(prompt))
+        context = prompt_cache.tokens + prompt if prompt_cache else prompt
+
+        tokens = self._reply(context)
+        self._remember(context, tokens)
+        if constraint is not None:
+            tokens = self._constrained(tokens, constraint, max_tokens)
+        if prompt_cache is not None:
+            # like a KV cache, the cache now covers the prompt and the reply
+            prompt_cache.tokens = context + tokens[:max_tokens]
+
+        if constraint is not None:
+            lookup = None
+        start = time.perf_counter()
+        response = None
+        limit = min(len(tokens), max_tokens)
+        n = steps = 0
+        while n < limit:
+            # one forward pass: the accepted part of a draft plus one new token
+            steps += 1
+            count = 1
+            if lookup is not None and n:
+                draft = lookup.draft(tokens[:n], limit - n - 1)
+                accepted = 0
+                while accepted < len(draft) and draft[accepted] == tokens[n + accepted]:
+                    accepted += 1
+                lookup.record(len(draft), accepted)
+                count += accepted
+            if self.tokens_per_second:
+                self._wait_until(start + steps / self.tokens_per_second)
+            for i in range(count):
+                n += 1
+                response = self._response(tokens[n - 1], len(prompt), prompt_tps, n, start)
+                response.from_draft = i < count - 1
+                if n == max_tokens and len(tokens) > max_tokens:
+                    # like mlx_lm, the last token carries the finish reason
+                    response.finish_reason = "length"
+                yield response
+        if n == max_tokens and len(tokens) > max_tokens:
+            return
+
+        response = self._response(self._vocab[END_OF_TURN], len(prompt), prompt_tps, n, start)
+        response.text = ""
+        response.finish_reason = "stop"
+        yield response
+
+    def stream_batch(
+        self,
+        prompts: list[list[int]],
+        max_tokens: int = 512,
+        prefix: list[int] | None = None,
+        stop: set[int] | None = None,
+        constraints: list[CardConstraint] | None = None,
+        incoming: Callable[[], list[list[int]]] | None = None,
+    ) -> Iterator[tuple[int, GenerationResponse]]:
+        prefix = prefix or []
+        if prefix and tuple(prefix) != self._batch_prefix:
+            self._prefill(len(prefix))
+            self._batch_prefix = tuple(prefix)
+
+        prompts = list(prompts)
+        replies: list[list[int]] = []
+        prompt_tps: list[float] = []
+        counts: list[int] = []
+        started: list[float] = []
+        active: set[int] = set()
+
+        def join(new: list[list[int]]) -> None:
+            # left-padded prompts are prefilled together
+            tps = self._prefill(max(len(p) for p in new) * len(new))
+            for p in new:
+                row = len(replies)
+                reply = self._reply(prefix + p)
+                self._remember(prefix + p, reply)
+                if constraints is not None:
+                    reply = self._constrained(reply, constraints[row], max_tokens)
+                replies.append(reply)
+                prompt_tps.append(tps)
+                counts.append(0)
+                started.append(time.perf_counter())
+                active.add(row)
+
+        join(prompts)
+
+        # decoding is memory bound, so one step costs the same for every row
+        start = time.perf_counter()
+        stop = stop if stop is not None else set()
+        steps = 0
+        while True:
+            active -= stop
+            if not active:
+                break
+            steps += 1
+            if self.tokens_per_second:
+                self._wait_until(start + steps / self.tokens_per_second)
+            for row in sorted(active):
+                if row in stop:
+                    continue
+                tokens = replies[row]
+                n = counts[row]
+                if n == len(tokens):
+                    active.discard(row)
+                    response = self._response(
+                        self._vocab[END_OF_TURN],
+                        len(prompts[row]),
+                        prompt_tps[row],
+                        n,
+                        started[row],
+                    )
+                    response.text = ""
+                    response.finish_reason = "stop"
+                    yield row, response
+                    continue
+                counts[row] = n = n + 1
+                yield row, self._response(
+                    tokens[n - 1], len(prompts[row]), prompt_tps[row], n, started[row]
+                )
+                if n == max_tokens:
+                    active.discard(row)
+                    response = self._response(
+                        tokens[n - 1], len(prompts[row]), prompt_tps[row], n, started[row]
+                    )
+                    response.text = ""
+                    response.finish_reason = "stop" if len(tokens) <= max_tokens else "length"
+                    yield row, response
+            new = incoming() if incoming is not None else []
+            if new:
+                prompts.extend(new)
+                join(new)
+
+
+def get_backend(name: str | None = None) -> Backend:
+    """
+    Builds a backend by name, defaulting to the LFM_BACKEND environment variable.
+    """
+    name = name or os.environ.get("LFM_BACKEND", "mlx")
+    if name == "mlx":
+        return MlxBackend()
+    if name == "fake":
+        tps = os.environ.get("LFM_FAKE_TPS")
+        prompt_tps = os.environ.get("LFM_FAKE_PROMPT_TPS")
+        return FakeBackend(
+            tokens_per_second=float(tps) if tps else None,
+            prompt_tokens_per_second=float(prompt_tps) if prompt_tps else None,
+        )
+    raise ValueError(f"Unknown backend: {name}")
@@ -0,0 +1,276 @@
+"""
+Offline bulk generation from a JSONL file of sources and questions.
+
+Each input line is an object with a `source` text, its `questions` (a list,
+or one string with a question per line) and optionally an `id`; records
+without one are identified by their line number. Records are spread over
+worker processes that each load their own model, and finished records are
+appended to a checkpoint file, so running the same command again after a
+crash skips them:
+
+    python -m lfm.bulk chapters.jsonl --output database.db --workers 2
+    python -m lfm.bulk chapters.jsonl --output cards.jsonl
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Iterator
+
+from .cache import GenerationCache
+from .llm import Llm, LlmOutput
+
+# the model of the current worker process
+_llm: Llm | None = None
+
+
+def _init_worker(options: dict) -> None:
+    global _llm
+    cache = GenerationCache(options["cache"]) if options["cache"] else None
+    _llm = Llm(
+        repo=options["repo"],
+        max_batch_size=options["max_batch_size"],
+        constrained=options["constrained"],
+        cache=cache,
+        source_token_budget=options["source_token_budget"],
+        speculative=options["speculative"],
+    )
+
+
+def _generate(record_id: str, source: str, questions: list[str]) -> dict:
+    tokens = _llm.generated_tokens
+    repaired = _llm.repaired_cards
+    resumed = _llm.resumed_cards
+    saved = _llm.saved_tokens
+    cards = []
+    errors = []
+    for i, output in _llm.iter_batch(source, questions):
+        if isinstance(output, Exception):
+            errors.append({"index": i, "error": str(output)})
+        else:
+            cards.append(output.model_dump())
+    return {
+        "id": record_id,
+        "source": source,
+        "cards": cards,
+        "errors": errors,
+        "tokens": _llm.generated_tokens - tokens,
+        # cards saved by JSON repair or resumed decoding, and the decode
+        # tokens a rerun of them would have spent
+        "repaired": _llm.repaired_cards - repaired,
+        "resumed": _llm.resumed_cards - resumed,
+        "saved_tokens": _llm.saved_tokens - saved,
+    }
+
+
+def read_records(path: str) -> Iterator[tuple[str, str, list[str]]]:
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                source = record["source"]
+                questions = record["questions"]
+            except (ValueError, KeyError) as e:
+                raise ValueError(f"Invalid record on line {line_number}: {str(e)}")
+            if isinstance(questions, str):
+                questions = questions.split("\n")
+            questions = [q.strip() for q in questions if q.strip()]
+            yield str(record.get("id", line_number)), source, questions
+
+
+def read_checkpoint(path: str) -> set[str]:
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding="utf-8") as f:
+        return {line.rstrip("\n") for line in f if line.strip()}
+
+
+class JsonlWriter:
+    def __init__(self, path: str):
+        self._file = open(path, "a", encoding="utf-8")
+
+    def write(self, record_id: str, cards: list[dict], source: str) -> None:
+        # the record id leads back to the source in the input file
+        for card in cards:
+            self._file.write(json.dumps({"record": record_id, **card}, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class DatabaseWriter:
+    def __init__(self, path: str, batch_id: str):
+        # lazy import, the JSONL output does not need a database
+        from sqlmodel import Session
+
+        from .db import create_db_and_tables, make_engine
+
+        engine = make_engine(path)
+        create_db_and_tables(engine)
+        self._session = Session(engine)
+        self._batch_id = batch_id
+
+    def write(self, record_id: str, cards: list[dict], source: str) -> None:
+        from .db import add_flashcard
+
+        for card in cards:
+            add_flashcard(
+                self._session,
+                LlmOutput.model_validate(card),
+                batch_id=self._batch_id,
+                source=source,
+            )
+        self._session.commit()
+
+    def close(self) -> None:
+        self._session.close()
+
+
+def _format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class Progress:
+    def __init__(self, total: int):
+        self.total = total
+        self.records = 0
+        self.cards = 0
+        self.errors = 0
+        self.tokens = 0
+        self.repaired = 0
+        self.resumed = 0
+        self.saved_tokens = 0
+        self._start = time.time()
+
+    def update(self, result: dict) -> None:
+        self.records += 1
+        self.cards += len(result["cards"])
+        self.errors += len(result["errors"])
+        self.tokens += result["tokens"]
+        self.repaired += result["repaired"]
+        self.resumed += result["resumed"]
+        self.saved_tokens += result["saved_tokens"]
+
+    def line(self) -> str:
+        elapsed = max(time.time() - self._start, 1e-9)
+        remaining = self.total - self.records
+        eta = remaining * elapsed / self.records if self.records else 0.0
+        return (
+            f"{self.records}/{self.total} records, {self.cards} cards, "
+            f"{self.errors} errors, {self.repaired} repaired, {self.resumed} resumed "
+            f"({self.saved_tokens} tokens saved) | {self.cards / elapsed:.2f} cards/s, "
+            f"{self.tokens / elapsed:.1f} tok/s | "
+            f"elapsed {_format_duration(elapsed)}, ETA {_format_duration(eta)}"
+        )
+
+
+def run(args: argparse.Namespace) -> None:
+    checkpoint = args.checkpoint or f"{args.output}.checkpoint"
+    done = read_checkpoint(checkpoint)
+    total = sum(1 for record_id, _, _ in read_records(args.input) if record_id not in done)
+    if done:
+        print(f"resuming: {len(done)} record(s) already done, {total} left")
+    if not total:
+        return
+
+    if args.output.endswith(".jsonl"):
+        writer = JsonlWriter(args.output)
+    else:
+        batch_id = args.batch_id or os.path.splitext(os.path.basename(args.input))[0]
+        writer = DatabaseWriter(args.output, batch_id)
+
+    options = {
+        "repo": args.repo,
+        "max_batch_size": args.batch_size,
+        "constrained": args.constrained,
+        "cache": None if args.no_cache else args.cache,
+        "source_token_budget": args.source_tokens or None,
+        "speculative": args.speculative,
+    }
+    progress = Progress(total)
+    records = (r for r in read_records(args.input) if r[0] not in done)
+    pending: set[Future] = set()
+
+    # spawn, not fork: each worker loads its own model from scratch
+    with (
+        ProcessPoolExecutor(
+            max_workers=args.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(options,),
+        ) as pool,
+        open(checkpoint, "a", encoding="utf-8") as checkpoint_file,
+    ):
+        try:
+            while True:
+                # keep every worker busy without reading the whole input
+                for record in records:
+                    pending.add(pool.submit(_generate, *record))
+                    if len(pending) >= args.workers * 2:
+                        break
+                if not pending:
+                    break
+
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    result = future.result()
+                    # results are stored before the record is marked done
+                    writer.write(result["id"], result["cards"], result["source"])
+                    checkpoint_file.write(result["id"] + "\n")
+                    checkpoint_file.flush()
+                    progress.update(result)
+                    for error in result["errors"]:
+                        print(
+                            f"\nrecord {result['id']}, question {error['index'] + 1}: "
+                            f"{error['error']}",
+                            file=sys.stderr,
+                        )
+                print("\r" + progress.line(), end="", flush=True)
+        except KeyboardInterrupt:
+            pool.shutdown(wait=False, cancel_futures=True)
+            print("\ninterrupted, run the same command again to resume")
+            raise SystemExit(130)
+        finally:
+            writer.close()
+    print()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Generate flashcards offline from a JSONL file")
+    parser.add_argument("input", help="JSONL file with source, questions and optional id")
+    parser.add_argument(
+        "--output",
+        default="database.db",
+        help="SQLite database, or a .jsonl file to append cards to (default: database.db)",
+    )
+    parser.add_argument("--workers", type=int, default=1, help="worker processes, one model each")
+    parser.add_argument("--checkpoint", help="default: <output>.checkpoint")
+    parser.add_argument("--batch-id", help="batch id of stored cards (default: input file name)")
+    parser.add_argument("--repo", help="model repository")
+    parser.add_argument("--batch-size", type=int, default=8, help="questions decoded together")
+    parser.add_argument("--constrained", action="store_true", help="schema-constrained decoding")
+    parser.add_argument(
+        "--speculative", action="store_true", help="draft tokens from the source (same output)"
+    )
+    parser.add_argument("--cache", default="generation_cache.db", help="generation cache file")
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument(
+        "--source-tokens",
+        type=int,
+        default=1024,
+        help="source token budget per question, 0 sends the whole source",
+    )
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+
+from . import metrics
+
+
+def normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+_TOTALS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS generation_totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    entries INTEGER NOT NULL,
+    bytes INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS generation_totals_insert AFTER INSERT ON generation BEGIN
+    UPDATE generation_totals SET entries = entries + 1, bytes = bytes + new.size;
+END;
+CREATE TRIGGER IF NOT EXISTS generation_totals_delete AFTER DELETE ON generation BEGIN
+    UPDATE generation_totals SET entries = entries - 1, bytes = bytes - old.size;
+END;
+CREATE TRIGGER IF NOT EXISTS generation_totals_update AFTER UPDATE OF size ON generation BEGIN
+    UPDATE generation_totals SET bytes = bytes - old.size + new.size;
+END;
+"""
+
+
+class GenerationCache:
+    """
+    Persistent content-addressed cache of finished generations.
+
+    Entries live in a SQLite file and are evicted least-recently-used once
+    the cache holds more than `max_entries` rows or `max_bytes` of values,
+    and when they are older than `max_age_seconds`.
+    """
+
+    def __init__(
+        self,
+        path: str = "generation_cache.db",
+        max_entries: int = 50_000,
+        max_bytes: int = 256 * 1024 * 1024,
+        max_age_seconds: float = 30 * 24 * 3600,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS generation (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_generation_accessed_at ON generation (accessed_at)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_generation_created_at ON generation (created_at)"
+        )
+        # running entry count and size, kept by triggers so that a put does
+        # not have to scan the table, even with several processes writing
+        self._conn.executescript(_TOTALS_SCHEMA)
+        self._conn.execute(
+            "INSERT OR IGNORE INTO generation_totals "
+            "SELECT 0, COUNT(*), COALESCE(SUM(size), 0) FROM generation"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(
+        repo: str,
+        system_prompt: str,
+        source: str,
+        question: str | None,
+        max_tokens: int,
+        sampling: dict,
+    ) -> str:
+        parts = {
+            "repo": repo,
+            "system_prompt": text_hash(system_prompt),
+            "source": text_hash(normalize_text(source)),
+            "question": normalize_text(question) if question is not None else None,
+            "max_tokens": max_tokens,
+            "sampling": sampling,
+        }
+        return text_hash(json.dumps(parts, sort_keys=True))
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM generation WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.max_age_seconds:
+                self.misses += 1
+                metrics.CACHE_LOOKUPS.inc(result="miss")
+                return None
+            self._conn.execute(
+                "UPDATE generation SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            self.hits += 1
+            metrics.CACHE_LOOKUPS.inc(result="hit")
+            return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            # an upsert, not INSERT OR REPLACE, whose implicit delete would
+            # skip the totals trigger
+            self._conn.execute(
+                "INSERT INTO generation VALUES (?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET "
+                "value = excluded.value, size = excluded.size, "
+                "created_at = excluded.created_at, accessed_at = excluded.accessed_at",
+                (key, value, len(value.encode("utf-8")), now, now),
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now: float) -> None:
+        self._conn.execute(
+            "DELETE FROM generation WHERE created_at < ?", (now - self.max_age_seconds,)
+        )
+        count, size = self._totals()
+        if count <= self.max_entries and size <= self.max_bytes:
+            return
+
+        # walk from the least recently used entry until both limits hold
+        to_delete = []
+        for key, entry_size in self._conn.execute(
+            "SELECT key, size FROM generation ORDER BY accessed_at"
+        ):
+            if count <= self.max_entries and size <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            count -= 1
+            size -= entry_size
+        self._conn.executemany("DELETE FROM generation WHERE key = ?", to_delete)
+
+    def _totals(self) -> tuple[int, int]:
+        return self._conn.execute("SELECT entries, bytes FROM generation_totals").fetchone()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM generation")
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, size = self._totals()
+        total = self.hits + self.misses
+        return {
+            "entries": count,
+            "bytes": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
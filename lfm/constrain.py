@@ -0,0 +1,240 @@
+from pydantic import BaseModel
+
+_HEX = set("0123456789abcdefABCDEF")
+_ESCAPES = set('"\\/bfnrtu')
+# escapes that only add whitespace
+_BLANK_ESCAPES = set("bfnrt")
+
+
+def _is_string_safe(ch: str) -> bool:
+    return ch not in '"\\' and ch >= " "
+
+
+class TokenIndex:
+    """
+    Vocabulary lookups used to turn a `CardConstraint` into a token mask.
+
+    `texts[i]` is the text token `i` adds to the output; special tokens
+    other than end-of-sequence should map to "".
+    """
+
+    def __init__(self, texts: list[str], eos_ids: set[int]):
+        self.texts = texts
+        self.eos_ids = set(eos_ids)
+        # tokens that can appear anywhere inside a JSON string
+        self.string_safe: list[int] = []
+        # tokens that might be valid inside a string depending on state
+        self.string_special: list[int] = []
+        self.by_first_char: dict[str, list[int]] = {}
+
+        for token, text in enumerate(texts):
+            if not text or token in self.eos_ids:
+                continue
+            self.by_first_char.setdefault(text[0], []).append(token)
+            if all(_is_string_safe(ch) for ch in text):
+                self.string_safe.append(token)
+            elif ('"' in text or "\\" in text) and all(ch >= " " for ch in text):
+                self.string_special.append(token)
+
+
+class CardConstraint:
+    """
+    Character-level automaton for the JSON form of a flashcard.
+
+    Only the exact layout `{"back": "...", "references": ["..."], "examples": []}`
+    is accepted, with fields taken from a pydantic model, so a constrained
+    generation is always parseable and cannot start with prose. String
+    fields cannot be closed before they hold a non-whitespace character, so
+    the answer cannot be left empty either.
+    """
+
+    def __init__(self, fields: list[tuple[str, str]]):
+        segments: list[tuple[str, str]] = []
+        for i, (name, kind) in enumerate(fields):
+            opener = "{" if i == 0 else ", "
+            segments.append(("literal", f'{opener}"{name}": '))
+            segments.append((kind, ""))
+        segments.append(("literal", "}"))
+        self._segments = segments
+        self._state = (0, 0, "lit", 0)
+
+    @classmethod
+    def from_model(
+        cls, model: type[BaseModel], exclude: set[str] | None = None
+    ) -> "CardConstraint":
+        exclude = exclude or set()
+        schema = model.model_json_schema()
+        fields = []
+        for name, prop in schema["properties"].items():
+            if name in exclude:
+                continue
+            if prop.get("type") == "string":
+                fields.append((name, "string"))
+            elif prop.get("type") == "array" and prop.get("items", {}).get("type") == "string":
+                fields.append((name, "array"))
+            else:
+                raise ValueError(f"Unsupported field type for constrained decoding: {name}")
+        return cls(fields)
+
+    def copy(self) -> "CardConstraint":
+        other = CardConstraint.__new__(CardConstraint)
+        other._segments = self._segments
+        other._state = self._state
+        return other
+
+    @property
+    def complete(self) -> bool:
+        return self._state[0] == len(self._segments)
+
+    @property
+    def in_string(self) -> bool:
+        return self._state[2] in ("in", "blank")
+
+    @property
+    def needs_text(self) -> bool:
+        """
+        Inside a string field that has no visible character yet.
+        """
+        return self._state[2] in ("blank", "blank_esc")
+
+    def _start(self, seg: int) -> tuple:
+        if seg == len(self._segments):
+            return (seg, 0, "end", 0)
+        kind = self._segments[seg][0]
+        return (seg, 0, "lit" if kind == "literal" else "open", 0)
+
+    def _step(self, state: tuple, ch: str) -> tuple | None:
+        seg, pos, mode, hex_left = state
+        if mode == "end":
+            return None
+        kind, text = self._segments[seg]
+        array = kind == "array"
+
+        if mode == "lit":
+            if ch != text[pos]:
+                return None
+            if pos + 1 == len(text):
+                return self._start(seg + 1)
+            return (seg, pos + 1, mode, 0)
+        if mode == "blank":
+            if ch == "\\":
+                return (seg, 0, "blank_esc", 0)
+            if ch == " ":
+                return state
+            return (seg, 0, "in", 0) if ch >= " " and ch != '"' else None
+        if mode == "blank_esc":
+            if ch in _BLANK_ESCAPES:
+                return (seg, 0, "blank", 0)
+            mode = "esc"
+        if mode == "in":
+            if ch == '"':
+                return (seg, 0, "after", 0) if array else self._start(seg + 1)
+            if ch == "\\":
+                return (seg, 0, "esc", 0)
+            return state if ch >= " " else None
+        if mode == "esc":
+            if ch not in _ESCAPES:
+                return None
+            return (seg, 0, "hex", 4) if ch == "u" else (seg, 0, "in", 0)
+        if mode == "hex":
+            if ch not in _HEX:
+                return None
+            return (seg, 0, "hex", hex_left - 1) if hex_left > 1 else (seg, 0, "in", 0)
+        if mode == "open":
+            if array:
+                return (seg, 0, "first", 0) if ch == "[" else None
+            return (seg, 0, "blank", 0) if ch == '"' else None
+        if mode == "first":
+            if ch == '"':
+                return (seg, 0, "in", 0)
+            return self._start(seg + 1) if ch == "]" else None
+        if mode == "after":
+            if ch == ",":
+                return (seg, 0, "space", 0)
+            return self._start(seg + 1) if ch == "]" else None
+        if mode == "space":
+            return (seg, 0, "next", 0) if ch == " " else None
+        if mode == "next":
+            return (seg, 0, "in", 0) if ch == '"' else None
+        return None
+
+    def _walk(self, text: str) -> tuple | None:
+        state = self._state
+        for ch in text:
+            state = self._step(state, ch)
+            if state is None:
+                return None
+        return state
+
+    def accepts(self, text: str) -> bool:
+        return bool(text) and self._walk(text) is not None
+
+    def advance(self, text: str) -> bool:
+        """
+        Consumes `text` if it keeps the output valid; otherwise leaves the
+        state unchanged and returns False.
+        """
+        state = self._walk(text)
+        if state is None:
+            return False
+        self._state = state
+        return True
+
+    def _expected_chars(self) -> set[str]:
+        seg, pos, mode, _ = self._state
+        if mode == "lit":
+            return {self._segments[seg][1][pos]}
+        if mode == "open":
+            return {"["} if self._segments[seg][0] == "array" else {'"'}
+        return {
+            "first": {'"', "]"},
+            "after": {",", "]"},
+            "space": {" "},
+            "next": {'"'},
+            "esc": _ESCAPES,
+            "blank_esc": _ESCAPES,
+            "hex": _HEX,
+        }.get(mode, set())
+
+    def completion(self) -> str:
+        """
+        Shortest text that closes the object from the current state.
+        """
+        choices = {
+            "in": '"',
+            "blank": "-",
+            "blank_esc": "n",
+            "esc": "n",
+            "hex": "0",
+            "first": "]",
+            "after": "]",
+            "space": " ",
+            "next": '"',
+        }
+        state = self._state
+        out = []
+        while state[2] != "end":
+            seg, pos, mode, _ = state
+            if mode == "lit":
+                ch = self._segments[seg][1][pos]
+            elif mode == "open":
+                ch = "[" if self._segments[seg][0] == "array" else '"'
+            else:
+                ch = choices[mode]
+            out.append(ch)
+            state = self._step(state, ch)
+        return "".join(out)
+
+    def allowed_tokens(self, index: TokenIndex) -> tuple[bool, list[int]]:
+        """
+        Returns (whether every `index.string_safe` token is allowed, other
+        allowed token ids). End-of-sequence is only allowed once complete.
+        """
+        if self.complete:
+            return False, sorted(index.eos_ids)
+        if self.in_string:
+            return True, [t for t in index.string_special if self.accepts(index.texts[t])]
+        candidates = []
+        for ch in self._expected_chars():
+            candidates.extend(index.by_first_char.get(ch, ()))
+        return False, [t for t in candidates if self.accepts(index.texts[t])]
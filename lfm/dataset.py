@@ -0,0 +1,350 @@
+"""
+Fine-tuning data for `mlx_lm.lora` from the stored flashcards.
+
+Cards are read from the database in insertion order, a chunk at a time, and
+rendered in the chat format of `train.jsonl`: the messages `Llm` generates
+the card from (system prompt, then the stored source or the passages of it
+picked for the question, then the question) and the card JSON as the
+answer. Cards stored without their source are skipped unless
+`--without-source` is given. Cards whose front and back are the same up to
+case and whitespace are kept once; the hashes seen so far live in a
+temporary SQLite file rather than in memory. Prompts are built and tokens
+counted by worker processes that load only the tokenizer, and each example
+goes into the shard of the smallest length bucket it fits, so batches
+drawn from one shard pad little. Whether a card is in train or valid
+depends only on its content hash, so it stays on the same side when the
+dataset is rebuilt from a grown database:
+
+    python -m lfm.dataset database.db --output data --workers 4
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import sqlite3
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import TYPE_CHECKING, Iterator
+
+from .backend import Backend, get_backend
+from .llm import DEFAULT_REPO, SYSTEM_PROMPT, Llm
+from .retrieval import cite_passages
+
+if TYPE_CHECKING:
+    from sqlalchemy import Row
+
+# upper token bounds of the length buckets; longer examples are left out
+DEFAULT_BUCKETS = (256, 512, 1024, 2048)
+
+_SHARD_PATTERN = re.compile(r"^(train|valid)-\d+-\d+\.jsonl$")
+
+# the tokenizer of the current worker process, and the `Llm` around it that
+# builds card prompts without ever loading the model
+_backend: Backend | None = None
+_llm: Llm | None = None
+
+
+def render_example(
+    prompt: list[dict], back: str, references: list[str], examples: list[str]
+) -> dict:
+    """
+    A card as one chat in the `messages` format: the `prompt` messages it
+    was generated from and the card JSON as the answer.
+    """
+    answer = json.dumps(
+        {"back": back, "references": references, "examples": examples}, ensure_ascii=False
+    )
+    return {"messages": [*prompt, {"role": "assistant", "content": answer}]}
+
+
+def card_example(
+    llm: Llm,
+    front: str,
+    back: str,
+    references: list[str],
+    examples: list[str],
+    source: str | None,
+) -> dict:
+    """
+    A stored card as a training example with the prompt `llm` would
+    generate it from. If only some passages of the source fit the budget,
+    references to them are turned back into the "[n]" labels of the prompt.
+    Without a source the user turn holds only the question.
+    """
+    if source is None:
+        prompt = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"Question:\n{front}"},
+        ]
+    else:
+        prompt, passages = llm.card_prompt(source, front)
+        references = cite_passages(references, passages)
+    return render_example(prompt, back, references, examples)
+
+
+def content_hash(front: str, back: str) -> bytes:
+    text = " ".join(front.lower().split()) + "\0" + " ".join(back.lower().split())
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def is_valid(digest: bytes, valid_fraction: float, seed: int = 0) -> bool:
+    draw = hashlib.blake2b(seed.to_bytes(8, "big") + digest, digest_size=8).digest()
+    return int.from_bytes(draw, "big") < valid_fraction * 2**64
+
+
+def bucket_for(tokens: int, buckets: tuple[int, ...]) -> int | None:
+    for bound in buckets:
+        if tokens <= bound:
+            return bound
+    return None
+
+
+class SeenHashes:
+    """
+    Content hashes already written, in a temporary SQLite file so that
+    millions of them do not sit in memory.
+    """
+
+    def __init__(self):
+        self._dir = tempfile.TemporaryDirectory(prefix="lfm-dataset-")
+        self._conn = sqlite3.connect(os.path.join(self._dir.name, "seen.db"))
+        self._conn.execute("PRAGMA journal_mode=OFF")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        self._conn.execute("CREATE TABLE seen (hash BLOB PRIMARY KEY) WITHOUT ROWID")
+
+    def add(self, digests: list[bytes]) -> list[bool]:
+        """
+        Adds `digests` and tells for each whether it was new.
+        """
+        new = []
+        for digest in digests:
+            cursor = self._conn.execute("INSERT OR IGNORE INTO seen VALUES (?)", (digest,))
+            new.append(cursor.rowcount == 1)
+        self._conn.commit()
+        return new
+
+    def close(self) -> None:
+        self._conn.close()
+        self._dir.cleanup()
+
+
+class ShardWriter:
+    """
+    Appends examples to `<split>-<bucket>-<shard>.jsonl` files in `output`,
+    starting a new shard every `shard_size` examples. Only the current
+    shard of each split and bucket is open.
+    """
+
+    def __init__(self, output: str, shard_size: int):
+        self.output = output
+        self.shard_size = shard_size
+        # (split, bucket) -> examples, tokens, longest example and shards
+        self.stats: dict[tuple[str, int], dict] = {}
+        self._files = {}
+
+    def write(self, split: str, bucket: int, line: str, tokens: int) -> None:
+        key = (split, bucket)
+        stats = self.stats.setdefault(key, {"examples": 0, "tokens": 0, "longest": 0, "shards": 0})
+        if stats["examples"] % self.shard_size == 0:
+            if key in self._files:
+                self._files[key].close()
+            name = f"{split}-{bucket}-{stats['shards']:05d}.jsonl"
+            self._files[key] = open(os.path.join(self.output, name), "w", encoding="utf-8")
+            stats["shards"] += 1
+        self._files[key].write(line + "\n")
+        stats["examples"] += 1
+        stats["tokens"] += tokens
+        stats["longest"] = max(stats["longest"], tokens)
+
+    def close(self) -> None:
+        for file in self._files.values():
+            file.close()
+        self._files.clear()
+
+
+def _init_worker(backend: str, repo: str, source_token_budget: int | None) -> None:
+    global _backend, _llm
+    _backend = get_backend(backend)
+    _backend.load_tokenizer(repo)
+    _llm = Llm(repo=repo, backend=_backend, source_token_budget=source_token_budget)
+
+
+def _render(cards: list[tuple]) -> list[tuple[dict, int]]:
+    """
+    Examples for `cards` (front, back, references, examples and source
+    each) and their token counts.
+    """
+    rendered = []
+    for card in cards:
+        example = card_example(_llm, *card)
+        tokens = _backend.apply_chat_template(example["messages"], add_generation_prompt=False)
+        rendered.append((example, len(tokens)))
+    return rendered
+
+
+def _clear_shards(output: str) -> None:
+    # shards of an earlier run would otherwise be mixed into this one
+    for name in os.listdir(output):
+        if _SHARD_PATTERN.match(name):
+            os.remove(os.path.join(output, name))
+
+
+def _unique_chunks(
+    rows: Iterator["Row"], seen: SeenHashes, chunk_size: int, without_source: bool, totals: dict
+) -> Iterator[tuple[list[bytes], list[tuple]]]:
+    for chunk in itertools.batched(rows, chunk_size):
+        totals["cards"] += len(chunk)
+        if not without_source:
+            totals["no_source"] += sum(row.source is None for row in chunk)
+            chunk = [row for row in chunk if row.source is not None]
+        digests = [content_hash(row.front, row.back) for row in chunk]
+        digests_kept, cards = [], []
+        for row, digest, new in zip(chunk, digests, seen.add(digests)):
+            if not new:
+                totals["duplicates"] += 1
+                continue
+            digests_kept.append(digest)
+            cards.append(
+                (row.front, row.back, row.references or [], row.examples or [], row.source)
+            )
+        if cards:
+            yield digests_kept, cards
+
+
+def run(args: argparse.Namespace) -> dict:
+    # lazy import, the helpers above do not need a database
+    from sqlmodel import Session
+
+    from .db import iter_flashcards, make_engine
+
+    if not 0 <= args.valid_fraction < 1:
+        raise ValueError("--valid-fraction must be at least 0 and below 1")
+    buckets = tuple(sorted(int(b) for b in args.buckets.split(",")))
+    os.makedirs(args.output, exist_ok=True)
+    _clear_shards(args.output)
+
+    totals = {"cards": 0, "no_source": 0, "duplicates": 0, "too_long": 0, "train": 0, "valid": 0}
+    writer = ShardWriter(args.output, args.shard_size)
+    seen = SeenHashes()
+    engine = make_engine(args.database)
+    start = time.time()
+
+    def write(digests: list[bytes], rendered: list[tuple[dict, int]]) -> None:
+        for digest, (example, tokens) in zip(digests, rendered):
+            bucket = bucket_for(tokens, buckets)
+            if bucket is None:
+                totals["too_long"] += 1
+                continue
+            split = "valid" if is_valid(digest, args.valid_fraction, args.seed) else "train"
+            writer.write(split, bucket, json.dumps(example, ensure_ascii=False), tokens)
+            totals[split] += 1
+        elapsed = max(time.time() - start, 1e-9)
+        print(
+            f"\r{totals['cards']} cards, {totals['no_source']} without source, "
+            f"{totals['duplicates']} duplicates, "
+            f"{totals['too_long']} too long | {totals['train']} train, {totals['valid']} valid"
+            f" | {totals['cards'] / elapsed:.0f} cards/s",
+            end="",
+            flush=True,
+        )
+
+    repo = args.repo or DEFAULT_REPO
+    source_token_budget = args.source_tokens or None
+    try:
+        with Session(engine) as session:
+            rows = iter_flashcards(
+                session, batch_id=args.batch_id, chunk_size=args.chunk_size, with_source=True
+            )
+            chunks = _unique_chunks(rows, seen, args.chunk_size, args.without_source, totals)
+            if args.workers < 1:
+                _init_worker(args.backend, repo, source_token_budget)
+                for digests, cards in chunks:
+                    write(digests, _render(cards))
+            else:
+                # spawn, not fork: workers load only the tokenizer
+                with ProcessPoolExecutor(
+                    max_workers=args.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(args.backend, repo, source_token_budget),
+                ) as pool:
+                    # written in submission order, so the output does not
+                    # depend on the number of workers
+                    pending: deque[tuple[list[bytes], Future]] = deque()
+                    for digests, cards in chunks:
+                        pending.append((digests, pool.submit(_render, cards)))
+                        if len(pending) >= args.workers * 2:
+                            digests, future = pending.popleft()
+                            write(digests, future.result())
+                    while pending:
+                        digests, future = pending.popleft()
+                        write(digests, future.result())
+    finally:
+        writer.close()
+        seen.close()
+        engine.dispose()
+    print()
+
+    manifest = {
+        **totals,
+        "buckets": list(buckets),
+        "valid_fraction": args.valid_fraction,
+        "seed": args.seed,
+        "source_tokens": args.source_tokens,
+        "without_source": args.without_source,
+        "shards": {
+            f"{split}-{bucket}": stats for (split, bucket), stats in sorted(writer.stats.items())
+        },
+    }
+    with open(os.path.join(args.output, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+        f.write("\n")
+    return manifest
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Build fine-tuning data from stored flashcards")
+    parser.add_argument("database", nargs="?", default="database.db")
+    parser.add_argument("--output", default="data", help="shard directory (default: data)")
+    parser.add_argument("--batch-id", help="only the cards of this batch")
+    parser.add_argument(
+        "--valid-fraction", type=float, default=0.05, help="share of cards in valid (default: 0.05)"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="changes which cards go to valid")
+    parser.add_argument(
+        "--buckets",
+        default=",".join(str(b) for b in DEFAULT_BUCKETS),
+        help="token bounds of the length buckets, longer examples are skipped "
+        "(default: %(default)s)",
+    )
+    parser.add_argument("--shard-size", type=int, default=10000, help="examples per shard")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="cards read per query")
+    parser.add_argument(
+        "--source-tokens",
+        type=int,
+        default=1024,
+        help="source token budget per question the cards were generated with, "
+        "0 sends the whole source (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--without-source",
+        action="store_true",
+        help="also write cards stored without their source, with only the question "
+        "in the user turn (unlike the prompts they are generated from)",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=2, help="prompt building processes, 0 builds in-process"
+    )
+    parser.add_argument("--backend", help="tokenizer backend (default: LFM_BACKEND or mlx)")
+    parser.add_argument("--repo", help="model repository whose tokenizer counts tokens")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
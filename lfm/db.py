@@ -0,0 +1,404 @@
+import re
+from datetime import datetime, timezone
+from typing import Iterator
+from uuid import UUID, uuid4
+
+from sqlalchemy import Engine, Row, event, inspect, text, update
+from sqlmodel import JSON, Column, Field, Integer, Session, SQLModel, create_engine, delete, select
+
+from . import dedupe
+from .llm import LlmOutput
+
+
+class Flashcard(SQLModel, table=True):
+    id: UUID | None = Field(default_factory=uuid4, primary_key=True)
+    # searched through the flashcard_fts table rather than B-tree indexes
+    front: str
+    back: str
+    references: list[str] = Field(default=[], sa_column=Column(JSON))
+    examples: list[str] = Field(default=[], sa_column=Column(JSON))
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    # MinHash of front and back, see lfm.dedupe
+    signature: bytes | None = Field(default=None)
+    # the generation request that first produced the card; every request
+    # that produced it is in FlashcardBatch
+    batch_id: str | None = Field(default=None, index=True)
+    # the source text the card was generated from, so fine-tuning data can
+    # use the same prompt; cards stored before it was kept have none
+    source: str | None = Field(default=None)
+    # insertion number, set by the insert trigger: keys the full-text index
+    # and keyset pagination, where the implicit rowid could be renumbered by
+    # VACUUM since the primary key is not an integer
+    seq: int | None = Field(default=None, sa_column=Column(Integer, index=True, unique=True))
+
+
+class FlashcardBand(SQLModel, table=True):
+    """
+    LSH lookup table: one row per (band bucket, flashcard).
+    """
+
+    bucket: int = Field(primary_key=True)
+    flashcard_id: UUID = Field(primary_key=True, foreign_key="flashcard.id")
+
+
+class FlashcardBatch(SQLModel, table=True):
+    """
+    Batch membership: one row per (batch, flashcard), so a card that a later
+    request merged into stays in the export of the batch that stored it.
+    """
+
+    batch_id: str = Field(primary_key=True)
+    flashcard_id: UUID = Field(primary_key=True, foreign_key="flashcard.id")
+
+
+# full-text index over front and back, stored in the flashcard table itself
+# (external content, keyed by seq) and kept in sync by triggers
+_FTS_SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS flashcard_fts USING fts5(
+        front, back, content='flashcard', content_rowid='seq'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS flashcard_fts_insert AFTER INSERT ON flashcard BEGIN
+        UPDATE flashcard SET seq = (SELECT IFNULL(MAX(seq), 0) + 1 FROM flashcard)
+        WHERE rowid = new.rowid AND seq IS NULL;
+        INSERT INTO flashcard_fts(rowid, front, back)
+        SELECT seq, front, back FROM flashcard WHERE rowid = new.rowid;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS flashcard_fts_delete AFTER DELETE ON flashcard BEGIN
+        INSERT INTO flashcard_fts(flashcard_fts, rowid, front, back)
+        VALUES ('delete', old.seq, old.front, old.back);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS flashcard_fts_update AFTER UPDATE OF front, back ON flashcard
+    BEGIN
+        INSERT INTO flashcard_fts(flashcard_fts, rowid, front, back)
+        VALUES ('delete', old.seq, old.front, old.back);
+        INSERT INTO flashcard_fts(rowid, front, back) VALUES (new.seq, new.front, new.back);
+    END
+    """,
+]
+_FTS_TRIGGERS = ("flashcard_fts_insert", "flashcard_fts_delete", "flashcard_fts_update")
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    # readers no longer block the generators' writes, and the other way round
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+def make_engine(path: str) -> Engine:
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    return engine
+
+
+sqlite_file_name = "database.db"
+engine = make_engine(sqlite_file_name)
+
+
+def create_db_and_tables(engine: Engine = engine) -> None:
+    new_membership = not inspect(engine).has_table(FlashcardBatch.__tablename__)
+    SQLModel.metadata.create_all(engine)
+    with engine.begin() as conn:
+        # databases created before signatures existed
+        columns = {row[1] for row in conn.execute(text("PRAGMA table_info(flashcard)"))}
+        if "signature" not in columns:
+            conn.execute(text("ALTER TABLE flashcard ADD COLUMN signature BLOB"))
+        if "batch_id" not in columns:
+            conn.execute(text("ALTER TABLE flashcard ADD COLUMN batch_id VARCHAR"))
+            conn.execute(text("CREATE INDEX ix_flashcard_batch_id ON flashcard (batch_id)"))
+        if "source" not in columns:
+            conn.execute(text("ALTER TABLE flashcard ADD COLUMN source VARCHAR"))
+        if "seq" not in columns:
+            # numbered in the current rowid order, before anything renumbers it
+            conn.execute(text("ALTER TABLE flashcard ADD COLUMN seq INTEGER"))
+            conn.execute(text("UPDATE flashcard SET seq = rowid"))
+            conn.execute(text("CREATE UNIQUE INDEX ix_flashcard_seq ON flashcard (seq)"))
+        if new_membership:
+            # each card was in the one batch it last moved to
+            conn.execute(
+                text(
+                    "INSERT INTO flashcardbatch (batch_id, flashcard_id) "
+                    "SELECT batch_id, id FROM flashcard WHERE batch_id IS NOT NULL"
+                )
+            )
+
+        # the old B-tree indexes on the full text are replaced by flashcard_fts
+        conn.execute(text("DROP INDEX IF EXISTS ix_flashcard_front"))
+        conn.execute(text("DROP INDEX IF EXISTS ix_flashcard_back"))
+        fts_sql = conn.execute(
+            text("SELECT sql FROM sqlite_master WHERE name = 'flashcard_fts'")
+        ).scalar()
+        if fts_sql is not None and "content_rowid='seq'" not in fts_sql:
+            # an index keyed by the implicit rowid is built again on seq
+            for trigger in _FTS_TRIGGERS:
+                conn.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+            conn.execute(text("DROP TABLE flashcard_fts"))
+            fts_sql = None
+        for statement in _FTS_SCHEMA:
+            conn.execute(text(statement))
+        if fts_sql is None:
+            conn.execute(text("INSERT INTO flashcard_fts(flashcard_fts) VALUES ('rebuild')"))
+
+
+def fts_query(query: str) -> str:
+    """
+    Turns free text into an FTS5 query matching every word, the last one as
+    a prefix so results show up while typing. Shorter prefixes match too
+    much of the vocabulary to rank quickly.
+    """
+    words = re.findall(r"\w+", query)
+    if not words:
+        return ""
+    match = " ".join(f'"{w}"' for w in words)
+    return match + "*" if len(words[-1]) >= 3 else match
+
+
+def search_flashcards(
+    session: Session, query: str, limit: int = 20, after: str | None = None
+) -> tuple[list[Flashcard], str | None]:
+    """
+    Flashcards matching `query`, best first by BM25. Pages are keyset
+    paginated: pass the returned cursor as `after` to get the next page,
+    which is None after the last one.
+    """
+    match = fts_query(query)
+    if not match:
+        return [], None
+
+    rank, seq = float("-inf"), 0
+    if after:
+        try:
+            rank_text, _, seq_text = after.partition(":")
+            rank, seq = float(rank_text), int(seq_text)
+        except ValueError:
+            raise ValueError(f"Invalid search cursor: {after}")
+
+    # the rowid of flashcard_fts is the card's seq
+    rows = session.execute(
+        text(
+            """
+            SELECT rowid, rank FROM flashcard_fts
+            WHERE flashcard_fts MATCH :match
+              AND (rank > :rank OR (rank = :rank AND rowid > :seq))
+            ORDER BY rank, rowid
+            LIMIT :limit
+            """
+        ).bindparams(match=match, rank=rank, seq=seq, limit=limit + 1)
+    ).all()
+    page = rows[:limit]
+    if not page:
+        return [], None
+
+    by_seq = {
+        flashcard.seq: flashcard
+        for flashcard in session.exec(
+            select(Flashcard).where(Flashcard.seq.in_([r[0] for r in page]))
+        )
+    }
+    cursor = f"{page[-1][1]!r}:{page[-1][0]}" if len(rows) > limit else None
+    return [by_seq[r[0]] for r in page if r[0] in by_seq], cursor
+
+
+# run on every insert, straight on the driver: building them through the ORM
+# took longer than running them
+_CANDIDATES_SQL = (
+    "SELECT DISTINCT flashcard.id, flashcard.signature, flashcard.front FROM flashcard "
+    "JOIN flashcardband ON flashcardband.flashcard_id = flashcard.id "
+    f"WHERE flashcardband.bucket IN ({', '.join('?' * dedupe.BANDS)}) "
+    # equally similar candidates go to the oldest card, which comes last
+    "ORDER BY flashcard.seq DESC"
+)
+_INSERT_BANDS_SQL = "INSERT OR IGNORE INTO flashcardband (bucket, flashcard_id) VALUES (?, ?)"
+
+
+def find_near_duplicate(
+    session: Session, signature: list[int], front: str, bands: list[int] | None = None
+) -> Flashcard | None:
+    """
+    The stored card `signature` and `front` are a near-duplicate of, if
+    any. `bands` are the signature's band buckets when already computed.
+    """
+    if session.new:
+        session.flush()
+    # only ids, fronts and signatures are read until a match is found
+    candidates = session.connection().exec_driver_sql(
+        _CANDIDATES_SQL, tuple(bands or dedupe.buckets(signature))
+    )
+    best, best_similarity = None, dedupe.THRESHOLD
+    for candidate_id, candidate_signature, candidate_front in candidates:
+        score = dedupe.similarity(signature, dedupe.unpack(candidate_signature))
+        if (
+            score >= best_similarity
+            and dedupe.word_similarity(front, candidate_front) >= dedupe.FRONT_THRESHOLD
+        ):
+            best, best_similarity = candidate_id, score
+    return session.get(Flashcard, UUID(best)) if best is not None else None
+
+
+def _merge(existing: Flashcard, references: list[str], examples: list[str]) -> None:
+    # lists are replaced rather than appended to so the JSON columns are marked dirty
+    existing.references = existing.references + [
+        r for r in references if r not in existing.references
+    ]
+    existing.examples = existing.examples + [e for e in examples if e not in existing.examples]
+
+
+def _index_bands(session: Session, flashcard_id: UUID, bands: list[int]) -> None:
+    session.connection().exec_driver_sql(
+        _INSERT_BANDS_SQL, [(bucket, flashcard_id.hex) for bucket in bands]
+    )
+
+
+def _index(
+    session: Session, flashcard: Flashcard, signature: list[int], bands: list[int]
+) -> None:
+    flashcard.signature = dedupe.pack(signature)
+    session.add(flashcard)
+    session.flush()
+    _index_bands(session, flashcard.id, bands)
+
+
+def add_flashcard(
+    session: Session,
+    output: LlmOutput,
+    batch_id: str | None = None,
+    source: str | None = None,
+) -> tuple[Flashcard, bool]:
+    """
+    Stores a generated flashcard and the `source` it was generated from
+    unless a near-duplicate is already stored, in which case its references
+    and examples are merged into that one, which keeps its own source. The
+    stored card joins `batch_id` either way, without leaving the batches it
+    is already in. Returns the stored flashcard and whether it is new. Does
+    not commit.
+    """
+    signature = dedupe.minhash(dedupe.card_text(output.front, output.back))
+    bands = dedupe.buckets(signature)
+    existing = find_near_duplicate(session, signature, output.front, bands)
+    if existing is not None:
+        _merge(existing, output.references, output.examples)
+        session.add(existing)
+        if batch_id is not None and session.get(FlashcardBatch, (batch_id, existing.id)) is None:
+            session.add(FlashcardBatch(batch_id=batch_id, flashcard_id=existing.id))
+        return existing, False
+
+    flashcard = Flashcard.model_validate(output.model_dump())
+    flashcard.batch_id = batch_id
+    flashcard.source = source
+    _index(session, flashcard, signature, bands)
+    if batch_id is not None:
+        session.add(FlashcardBatch(batch_id=batch_id, flashcard_id=flashcard.id))
+    return flashcard, True
+
+
+def dedupe_flashcards(session: Session, commit_every: int = 1000) -> dict:
+    """
+    Rebuilds signatures and the band table for every stored flashcard,
+    oldest first, merging each near-duplicate into the earliest copy. Cards
+    are paged through with `iter_flashcards`, so memory stays flat.
+    """
+    session.exec(delete(FlashcardBand))
+    kept = merged = 0
+    for n, row in enumerate(iter_flashcards(session, chunk_size=commit_every), 1):
+        signature = dedupe.minhash(dedupe.card_text(row.front, row.back))
+        bands = dedupe.buckets(signature)
+        existing = find_near_duplicate(session, signature, row.front, bands)
+        if existing is not None:
+            _merge(existing, row.references, row.examples)
+            session.add(existing)
+            # the copy that is kept takes over the batches of this one
+            session.exec(
+                update(FlashcardBatch)
+                .where(FlashcardBatch.flashcard_id == row.id)
+                .values(flashcard_id=existing.id)
+                .prefix_with("OR IGNORE")
+            )
+            session.exec(delete(FlashcardBatch).where(FlashcardBatch.flashcard_id == row.id))
+            session.exec(delete(Flashcard).where(Flashcard.id == row.id))
+            merged += 1
+        else:
+            session.exec(
+                update(Flashcard)
+                .where(Flashcard.id == row.id)
+                .values(signature=dedupe.pack(signature))
+            )
+            _index_bands(session, row.id, bands)
+            kept += 1
+        if n % commit_every == 0:
+            session.commit()
+    session.commit()
+    return {"kept": kept, "merged": merged}
+
+
+def iter_flashcards(
+    session: Session,
+    batch_id: str | None = None,
+    query: str | None = None,
+    chunk_size: int = 500,
+    with_source: bool = False,
+) -> Iterator[Row]:
+    """
+    Yields stored flashcards in insertion order, optionally only one batch
+    or only cards matching a full-text query. Rows are read `chunk_size` at
+    a time by seq, so memory stays flat; with a query, each chunk takes the
+    next slice of matches from the full-text index rather than matching
+    the whole index again. They carry the `Flashcard` columns as attributes
+    but are plain rows, not ORM objects, which keeps large exports cheap;
+    the source text is left out unless `with_source`.
+    """
+    seq_column = Flashcard.__table__.c.seq
+    statement = select(
+        *(c for c in Flashcard.__table__.columns if with_source or c.name != "source")
+    )
+    if batch_id is not None:
+        statement = statement.where(
+            select(FlashcardBatch)
+            .where(FlashcardBatch.batch_id == batch_id, FlashcardBatch.flashcard_id == Flashcard.id)
+            .exists()
+        )
+    match = None
+    if query is not None:
+        match = fts_query(query)
+        if not match:
+            return
+
+    last = 0
+    while True:
+        if match is None:
+            rows = session.exec(
+                statement.where(seq_column > last).order_by(seq_column).limit(chunk_size)
+            ).all()
+            if not rows:
+                return
+            last = rows[-1].seq
+        else:
+            # the rowid of flashcard_fts is the card's seq
+            seqs = session.execute(
+                text(
+                    """
+                    SELECT rowid FROM flashcard_fts
+                    WHERE flashcard_fts MATCH :match AND rowid > :last
+                    ORDER BY rowid
+                    LIMIT :limit
+                    """
+                ).bindparams(match=match, last=last, limit=chunk_size)
+            ).scalars().all()
+            if not seqs:
+                return
+            rows = session.exec(
+                statement.where(seq_column.in_(seqs)).order_by(seq_column)
+            ).all()
+            last = seqs[-1]
+        yield from rows
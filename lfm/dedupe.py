@@ -0,0 +1,131 @@
+"""
+MinHash signatures and LSH band buckets for near-duplicate flashcards.
+
+Run as a module to deduplicate an existing database:
+
+    python -m lfm.dedupe database.db
+"""
+
+import hashlib
+import random
+import re
+import struct
+
+import numpy as np
+
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+# estimated Jaccard similarity of word shingles above which two cards are duplicates
+THRESHOLD = 0.8
+# two questions answered by the same sentence are still different cards
+FRONT_THRESHOLD = 0.6
+
+_PRIME = (1 << 61) - 1
+_rng = random.Random(1331)
+_PERMUTATIONS = [
+    (_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)
+]
+# the permutations as columns, and their multipliers split into 30 and 31 bits
+_A = np.array([a for a, _ in _PERMUTATIONS], dtype=np.uint64)[:, None]
+_B = np.array([b for _, b in _PERMUTATIONS], dtype=np.uint64)[:, None]
+_A_HI, _A_LO = _A >> np.uint64(31), _A & np.uint64((1 << 31) - 1)
+_P = np.uint64(_PRIME)
+_U30 = np.uint64((1 << 30) - 1)
+_U31 = np.uint64((1 << 31) - 1)
+
+
+def _hash64(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+
+def shingles(text: str, size: int = 3) -> set[str]:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= size:
+        return {" ".join(words)}
+    return {" ".join(words[i : i + size]) for i in range(len(words) - size + 1)}
+
+
+def _mod_prime(x: np.ndarray) -> np.ndarray:
+    # 2**61 = 1 (mod 2**61 - 1), so the bits above 61 fold back onto the low ones
+    x = (x & _P) + (x >> np.uint64(61))
+    x = (x & _P) + (x >> np.uint64(61))
+    return np.where(x >= _P, x - _P, x)
+
+
+def minhash(text: str) -> list[int]:
+    """
+    `min((a * h + b) % _PRIME)` over the shingle hashes for every
+    permutation, computed for all of them at once in 64-bit integers: the
+    products are split into 30/31-bit halves so that nothing overflows.
+    """
+    hashes = np.array([_hash64(s.encode("utf-8")) for s in shingles(text)], dtype=np.uint64)
+    h = _mod_prime(hashes)[None, :]
+    h_hi, h_lo = h >> np.uint64(31), h & _U31
+    high = _A_HI * h_hi * np.uint64(2)  # times 2**62
+    middle = _A_HI * h_lo + _A_LO * h_hi  # times 2**31
+    middle = (middle >> np.uint64(30)) + ((middle & _U30) << np.uint64(31))
+    product = _mod_prime(high + middle + _A_LO * h_lo)
+    return _mod_prime(product + _B).min(axis=1).tolist()
+
+
+def pack(signature: list[int]) -> bytes:
+    return struct.pack(f">{NUM_PERM}Q", *signature)
+
+
+def unpack(data: bytes) -> list[int]:
+    return list(struct.unpack(f">{NUM_PERM}Q", data))
+
+
+def buckets(signature: list[int]) -> list[int]:
+    """
+    One bucket id per band. Cards sharing any bucket are candidates.
+    """
+    return [
+        int.from_bytes(
+            hashlib.blake2b(
+                struct.pack(f">B{ROWS}Q", band, *signature[band * ROWS : (band + 1) * ROWS]),
+                digest_size=8,
+            ).digest(),
+            "big",
+            signed=True,
+        )
+        for band in range(BANDS)
+    ]
+
+
+def similarity(a: list[int], b: list[int]) -> float:
+    return sum(x == y for x, y in zip(a, b)) / NUM_PERM
+
+
+def word_similarity(a: str, b: str) -> float:
+    """
+    Jaccard similarity of the word sets of two short texts.
+    """
+    words_a = set(re.findall(r"\w+", a.lower()))
+    words_b = set(re.findall(r"\w+", b.lower()))
+    if not words_a or not words_b:
+        return float(words_a == words_b)
+    return len(words_a & words_b) / len(words_a | words_b)
+
+
+def card_text(front: str, back: str) -> str:
+    return f"{front} {back}"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from sqlmodel import Session
+
+    from .db import create_db_and_tables, dedupe_flashcards, make_engine
+
+    parser = argparse.ArgumentParser(description="Remove near-duplicate flashcards")
+    parser.add_argument("database", nargs="?", default="database.db")
+    args = parser.parse_args()
+
+    engine = make_engine(args.database)
+    create_db_and_tables(engine)
+    with Session(engine) as session:
+        stats = dedupe_flashcards(session)
+    print(f"kept {stats['kept']} flashcard(s), merged {stats['merged']} duplicate(s)")
@@ -1,5 +1,21 @@
-import jsonpickle
-from pydantic import BaseModel
+import logging
+import re
+import threading
+import time
+from collections import deque
+from contextlib import closing
+from typing import Callable, Iterator
+
+from pydantic import BaseModel, ValidationError
+
+from . import metrics
+from .backend import END_OF_TURN, Backend, get_backend
+from .cache import GenerationCache
+from .dedupe import THRESHOLD, word_similarity
+from .constrain import CardConstraint
+from .parsing import JsonStreamParser
+from .retrieval import Bm25Index, Passage, chunk_source, format_passages, resolve_references
+from .speculative import PromptLookup
 
 SYSTEM_PROMPT = """
 Create an Anki flashcard JSON from user-provided text (the "source"), using only the information in that input to generate the back side (answer) based on textbook, article, or similar content. Always reason step by step about what is needed to create a high-quality, educationally useful answer before producing a clear, concise backside. Add references (e.g., citation to section or page if provided in source), and examples if relevant for the concept.
@@ -9,7 +25,7 @@ Proceed as follows:
 - Analyze the provided "source" text and determine the essential information necessary to answer or explain it.
 - Think through and document the logical steps or key points needed for an accurate response. Do not include information not present or infer extra content not directly supported by the source.
 - Next, formulate the backside of the Anki card, ensuring clarity, completeness, and alignment with educational goals.
-- Add references (such as "as stated in source, section X") if available, and add at least one relevant example in the "examples" field if doing so helps clarify.
+- Add references (such as "as stated in source, section X") if available; when the source is split into passages labelled like "[3]", cite the passage label. Add at least one relevant example in the "examples" field if doing so helps clarify.
 - Output must be a JSON object as described below.
 - Output order must always be: first, go through all reasoning steps; finally, present the JSON output.
 
@@ -85,6 +101,17 @@ Edit the definition so that it become more concise, digestible, and clearly pres
 """
 
 
+DEFAULT_REPO = "mlx-community/gemma-3-1b-it-bf16"
+
+logger = logging.getLogger(__name__)
+
+# a flashcard reply is the first object with these keys, see JsonStreamParser
+CARD_KEYS = ("back",)
+
+# an item of the numbered list SYSTEM_PROMPT_QUESTION asks for (or a bullet)
+_QUESTION_PATTERN = re.compile(r"^\s*(?:\d+[.)]|[-*])\s+(.*\S)")
+
+
 class LlmOutput(BaseModel):
     front: str
     back: str
@@ -92,14 +119,115 @@ class LlmOutput(BaseModel):
     examples: list[str]
 
 
+def _bullets(summary: str) -> list[str]:
+    """
+    The points of a bulleted (or numbered) summary, without their markers.
+    """
+    bullets = []
+    for line in summary.split("\n"):
+        line = re.sub(r"^\s*(?:[-*\u2022]|\d+[.)])\s*", "", line).strip()
+        if line:
+            bullets.append(line)
+    return bullets
+
+
+def _merge_bullets(merged: list[str], bullets: list[str]) -> list[str]:
+    """
+    Appends to `merged` the bullets that do not nearly repeat one already
+    in it, and returns those.
+    """
+    new = []
+    for bullet in bullets:
+        if all(word_similarity(bullet, other) < THRESHOLD for other in merged):
+            merged.append(bullet)
+            new.append(bullet)
+    return new
+
+
+def _bullet_list(bullets: list[str]) -> str:
+    return "\n".join(f"- {b}" for b in bullets)
+
+
+def _group_bullets(
+    bullets: list[str], count_tokens: Callable[[str], int], budget: int
+) -> list[list[str]]:
+    """
+    Splits bullets, in order, into groups of at most `budget` tokens.
+    """
+    groups: list[list[str]] = []
+    tokens = 0
+    for bullet in bullets:
+        size = count_tokens(bullet) + 2
+        if not groups or tokens + size > budget:
+            groups.append([])
+            tokens = 0
+        groups[-1].append(bullet)
+        tokens += size
+    return groups
+
+
 class Llm:
-    def __init__(self, repo: str | None = None):
+    def __init__(
+        self,
+        repo: str | None = None,
+        backend: Backend | None = None,
+        max_batch_size: int = 8,
+        constrained: bool = False,
+        cache: GenerationCache | None = None,
+        source_token_budget: int | None = 1024,
+        speculative: bool = False,
+    ):
         self._repo = repo
         self._check_repo()
 
-        self._model = None
-        self._tokenizer = None
-        self._is_loaded = False
+        self._backend = backend if backend is not None else get_backend()
+        self._max_batch_size = max_batch_size
+
+        # with constrained decoding the card JSON is masked against the LlmOutput schema
+        self._constraint = (
+            CardConstraint.from_model(LlmOutput, exclude={"front"}) if constrained else None
+        )
+        self._cache = cache
+        # running count of decoded tokens, for throughput reporting
+        self.generated_tokens = 0
+        # longer sources are cut down to the passages relevant to each question
+        self._source_token_budget = source_token_budget
+        # several workers may ask for the model before it is loaded
+        self._load_lock = threading.Lock()
+        # drafts copied from the prompt are verified several tokens per step
+        self._speculative = speculative
+        self.drafted_tokens = 0
+        self.accepted_tokens = 0
+        # flashcards saved by JSON repair or resumed decoding instead of a rerun
+        self.repaired_cards = 0
+        self.resumed_cards = 0
+        self.saved_tokens = 0
+
+    def _cache_key(
+        self, system_prompt: str, source: str, question: str | None, max_tokens: int
+    ) -> str:
+        return GenerationCache.make_key(
+            repo=f"{self._backend.name}:{self._repo}",
+            system_prompt=system_prompt,
+            source=source,
+            question=question,
+            max_tokens=max_tokens,
+            sampling={
+                "temperature": 0.0,
+                "constrained": self.constrained,
+                "source_tokens": self._source_token_budget,
+            },
+        )
+
+    def _new_constraint(self) -> CardConstraint | None:
+        return self._constraint.copy() if self._constraint is not None else None
+
+    def _new_lookup(self, formatted_prompt: list[int]) -> PromptLookup | None:
+        # backends decode constrained cards one token at a time regardless
+        return PromptLookup(formatted_prompt) if self._speculative else None
+
+    def _count_tokens(self, text: str) -> int:
+        return len(self._backend.encode(text))
 
     def _check_prompt(self, prompt: str) -> None:
         if not prompt or not prompt.strip():
@@ -107,30 +235,99 @@ class Llm:
 
     def _check_repo(self) -> None:
         if self._repo is None:
-            self._repo = "mlx-community/gemma-3-1b-it-bf16"
+            self._repo = DEFAULT_REPO
 
     def _load_model(self) -> None:
-        try:
-            if self._repo and not self._is_loaded:
-                # lazy import
-                from mlx_lm import load, stream_generate  # type: ignore
+        if self._backend.is_loaded:
+            return
+        with self._load_lock:
+            try:
+                if self._repo and not self._backend.is_loaded:
+                    self._backend.load(self._repo)
 
-                self._stream_generate = stream_generate  # cache function ref
-                self._model, self._tokenizer = load(
-                    self._repo, tokenizer_config={"eos_token": "<end_of_turn>"}
-                )
-                # self._model, self._tokenizer = load(self._repo, adapter_path="../data_anomaly_adapters")
-                self._is_loaded = True
+            except Exception as e:
+                raise RuntimeError(f"Failed to load model from {self._repo}: {str(e)}")
 
+    def warm_up(self, max_tokens: int = 8) -> None:
+        """
+        Loads the model and decodes a few tokens, single and batched, so the
+        first real request does not pay for loading and kernel compilation.
+        """
+        self._load_model()
+        try:
+            prompt = self._backend.apply_chat_template(
+                [{"role": "user", "content": "Say hello."}], add_generation_prompt=True
+            )
+            for _ in self._backend.stream(prompt, max_tokens):
+                pass
+            if self._backend.supports_batch and self._max_batch_size > 1:
+                for _ in self._backend.stream_batch([prompt, prompt], max_tokens):
+                    pass
         except Exception as e:
-            raise RuntimeError(f"Failed to load model from {self._repo}: {str(e)}")
+            raise RuntimeError(f"Error warming up the model: {str(e)}")
+
+    def _card_messages(
+        self, system_prompt: str, source_input: str, prompt: str
+    ) -> list[dict]:
+        # the question goes last so that system prompt + source form a stable prefix
+        return [
+            {"role": "system", "content": system_prompt},
+            {
+                "role": "user",
+                "content": f"Source:\n{source_input}\n\nQuestion:\n{prompt}",
+            },
+        ]
+
+    def _card_sources(
+        self, source_input: str, prompts: list[str]
+    ) -> list[tuple[str, list[Passage]]]:
+        """
+        Source text to send with each prompt, and the passages it is made of.
+        A source over the token budget is split into passages once, and each
+        prompt gets the ones BM25 ranks highest for it.
+        """
+        budget = self._source_token_budget
+        if budget is None or self._count_tokens(source_input) <= budget:
+            return [(source_input, [])] * len(prompts)
+
+        index = Bm25Index(
+            chunk_source(source_input, self._count_tokens)
+        )
+        sources = []
+        for prompt in prompts:
+            passages = index.select(prompt or "", budget)
+            sources.append((format_passages(passages), passages))
+        return sources
+
+    def card_prompt(self, source_input: str, prompt: str) -> tuple[list[dict], list[Passage]]:
+        """
+        The messages a flashcard for `prompt` is generated from, and the
+        passages of the source they hold (none if the whole source fits the
+        budget). Needs only the tokenizer, not the model.
+        """
+        source_input = source_input.replace("\n", " ").strip()
+        [(source, passages)] = self._card_sources(source_input, [prompt])
+        return self._card_messages(SYSTEM_PROMPT, source, prompt), passages
+
+    def _shared_prefix(self, prompts: list[list[int]]) -> list[int]:
+        """
+        Longest token prefix shared by every prompt, always leaving at least
+        one token per prompt to feed the model.
+        """
+        if len(prompts) < 2:
+            return []
+        limit = min(len(p) for p in prompts) - 1
+        first = prompts[0]
+        length = 0
+        while length < limit and all(p[length] == first[length] for p in prompts):
+            length += 1
+        return first[:length]
 
     def generate(
         self,
         source_input: str,
         prompt: str,
-        # system_prompt: str | None = None,
-        # max_tokens: int = 512,
+        use_cache: bool = True,
     ) -> LlmOutput:
 
         system_prompt = SYSTEM_PROMPT
@@ -138,141 +335,888 @@ class Llm:
 
         try:
             self._check_prompt(prompt)
+
+            cache = self._cache if use_cache else None
+            if cache is not None:
+                key = self._cache_key(system_prompt, source_input, prompt, max_tokens)
+                cached = cache.get(key)
+                if cached is not None:
+                    return LlmOutput.model_validate_json(cached)
+
             self._load_model()
-            if self._model is None or self._tokenizer is None:
+            if not self._backend.is_loaded:
                 raise RuntimeError("Model or tokenizer not properly loaded")
 
-            if system_prompt is None:
-                system_prompt = SYSTEM_PROMPT
-
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt},
-                {"role": "source", "content": source_input},
-            ]
+            [(source, passages)] = self._card_sources(source_input, [prompt])
+            with metrics.span("template"):
+                formatted_prompt = self._backend.apply_chat_template(
+                    self._card_messages(system_prompt, source, prompt),
+                    add_generation_prompt=True,
+                )
 
-            formatted_prompt = self._tokenizer.apply_chat_template(
-                messages, add_generation_prompt=True
+            result = self._generate_card(
+                prompt,
+                formatted_prompt,
+                max_tokens,
+                passages=passages,
+                lookup=self._new_lookup(formatted_prompt),
             )
+            if cache is not None:
+                cache.put(key, result.model_dump_json())
+            return result
+        except ValueError as e:
+            raise
+        except RuntimeError as e:
+            raise
+        except Exception as e:
+            raise RuntimeError(f"Unexpected error during text generation: {str(e)}")
 
-            result = []
-            generate_kwargs = {
-                "model": self._model,
-                "tokenizer": self._tokenizer,
-                "prompt": formatted_prompt,
-                "max_tokens": max_tokens,
-            }
-
-            for response in self._stream_generate(**generate_kwargs):
-                if response.text == "<end_of_turn>":
-                    break
-                if "\n" in response.text:
-                    response.text = response.text.replace("\n", " ")
-                result.append(response.text)
+    def _generate_card(
+        self,
+        prompt: str,
+        formatted_prompt: list[int],
+        max_tokens: int,
+        prompt_cache: object | None = None,
+        passages: list[Passage] | None = None,
+        lookup: PromptLookup | None = None,
+    ) -> LlmOutput:
+        for card in self._card_steps(
+            prompt, formatted_prompt, max_tokens, prompt_cache, passages, lookup, "parse"
+        ):
+            pass
+        return card
+
+    def _card_steps(
+        self,
+        prompt: str,
+        formatted_prompt: list[int],
+        max_tokens: int,
+        prompt_cache: object | None = None,
+        passages: list[Passage] | None = None,
+        lookup: PromptLookup | None = None,
+        between: str | None = None,
+    ) -> Iterator[LlmOutput | None]:
+        """
+        Decodes one flashcard, yielding None after every token and the
+        flashcard last, so several can be interleaved. `prompt_cache`, if
+        given, holds the model state after a prefix of `formatted_prompt`.
 
-            positions_to_remove = []
-            for i in range(len(result)):
-                if i > 0 and result[i] == "json" and result[i - 1] == "```":
-                    positions_to_remove.append(i - 1)
-                    positions_to_remove.append(i)
-                elif i > 0 and result[i] == "```":
-                    positions_to_remove.append(i)
-                elif i > 0 and (result[i] == "\n" or result[i] == "<end_of_turn>"):
-                    positions_to_remove.append(i)
+        A reply cut off at `max_tokens` whose JSON cannot be repaired is
+        decoded further, from the state it left in the cache, for up to
+        `max_tokens` more tokens.
+        """
+        if prompt_cache is None:
+            # a cache of our own keeps the state a cut-off reply resumes from
+            prompt_cache = self._backend.make_prompt_cache([])
+        cached = self._backend.cached_tokens(prompt_cache)
+        constraint = self._new_constraint()
+        parser = JsonStreamParser(CARD_KEYS)
+        reply: list[int] = []
+        finish_reason = None
+        responses = self._timed(
+            self._backend.stream(
+                formatted_prompt[cached:],
+                max_tokens,
+                prompt_cache=prompt_cache,
+                constraint=constraint,
+                lookup=lookup,
+            ),
+            between=between,
+            lookup=lookup,
+        )
+        with closing(responses):
+            for response in responses:
+                finish_reason = response.finish_reason
+                if finish_reason != "stop":
+                    reply.append(response.token)
+                # stop decoding as soon as the object closes or cannot be valid
+                if response.text == END_OF_TURN or parser.feed(response.text):
+                    break
+                yield None
+
+        resumed = (
+            finish_reason == "length"
+            and not parser.finished
+            and not self._repairable(prompt, parser, passages)
+        )
+        if resumed:
+            yield from self._resume_card(
+                parser, formatted_prompt + reply, max_tokens, prompt_cache, constraint, between
+            )
+        with metrics.span("parse"):
+            parser.finish()
+            card = self._parse_card(prompt, parser, passages, len(reply), resumed)
+        yield card
 
-            for i in reversed(positions_to_remove):
-                del result[i]
+    def _resume_card(
+        self,
+        parser: JsonStreamParser,
+        context: list[int],
+        max_tokens: int,
+        prompt_cache: object | None = None,
+        constraint: CardConstraint | None = None,
+        between: str | None = None,
+    ) -> Iterator[None]:
+        """
+        Feeds `parser` up to `max_tokens` more tokens of a reply that stopped
+        at its token limit; `context` is the prompt and the reply so far.
+        """
+        responses = self._timed(
+            self._backend.resume(context, max_tokens, prompt_cache, constraint),
+            between=between,
+        )
+        with closing(responses):
+            for response in responses:
+                if response.text == END_OF_TURN or parser.feed(response.text):
+                    break
+                yield None
 
-            result = "".join(result)
+    def _timed(
+        self,
+        responses: Iterator,
+        batched: bool = False,
+        between: str | None = None,
+        lookup: PromptLookup | None = None,
+    ) -> Iterator:
+        """
+        Passes backend responses through while timing prefill (up to the
+        first response) and decode (the rest, minus the time the caller
+        spends between responses, recorded as the `between` stage if given),
+        and counting tokens, including the drafted ones of `lookup`.
+        """
+        start = time.perf_counter()
+        first = None
+        paused = 0.0
+        prompt_tokens: dict[int, int] = {}
+        generated = 0
+        last = None
+        try:
+            for item in responses:
+                if first is None:
+                    first = time.perf_counter()
+                    metrics.record("prefill", first - start)
+                row, response = item if batched else (0, item)
+                prompt_tokens.setdefault(row, response.prompt_tokens)
+                generated += 1
+                self.generated_tokens += 1
+                last = response
+
+                before = time.perf_counter()
+                yield item
+                paused += time.perf_counter() - before
+        finally:
+            if first is not None:
+                metrics.record("decode", time.perf_counter() - first - paused)
+                if between is not None:
+                    metrics.record(between, paused)
+            metrics.TOKENS.inc(sum(prompt_tokens.values()), kind="prompt")
+            metrics.TOKENS.inc(generated, kind="generation")
+            if lookup is not None:
+                self.drafted_tokens += lookup.drafted
+                self.accepted_tokens += lookup.accepted
+                metrics.DRAFT_TOKENS.inc(lookup.accepted, result="accepted")
+                metrics.DRAFT_TOKENS.inc(lookup.drafted - lookup.accepted, result="rejected")
+            if last is not None and last.peak_memory:
+                metrics.PEAK_MEMORY.set(last.peak_memory)
+
+    def _iter_cards_batched(
+        self,
+        prompts: list[str],
+        formatted_prompts: list[list[int]],
+        max_tokens: int,
+        prefix: list[int],
+        passages: list[list[Passage]],
+        incoming: Callable[[int], list[tuple[str, list[int], list[Passage]]]] | None = None,
+    ) -> Iterator[tuple[int, LlmOutput | Exception | None]]:
+        """
+        Decodes flashcards in one batch, yielding (row, None) after every
+        token, so the caller can work in between, and (row, flashcard or
+        exception) when a row finishes. `incoming`, if given, is called
+        between steps with the number of rows still decoding; the (question,
+        formatted prompt, passages) rows it returns join the batch, numbered
+        on from `prompts`.
+        """
+        prompts, formatted_prompts = list(prompts), list(formatted_prompts)
+        passages = list(passages)
+        parsers = [JsonStreamParser(CARD_KEYS) for _ in prompts]
+        replies: list[list[int]] = [[] for _ in prompts]
+        constraints = (
+            [self._new_constraint() for _ in prompts] if self._constraint is not None else None
+        )
+        finished = set()
+        # rows cut off at max_tokens, resumed one by one after the batch
+        truncated = []
+
+        def join() -> list[list[int]]:
+            new = incoming(len(prompts) - len(finished))
+            for prompt, formatted_prompt, row_passages in new:
+                prompts.append(prompt)
+                formatted_prompts.append(formatted_prompt)
+                passages.append(row_passages)
+                parsers.append(JsonStreamParser(CARD_KEYS))
+                replies.append([])
+                if constraints is not None:
+                    constraints.append(self._new_constraint())
+            return [formatted_prompt[len(prefix) :] for _, formatted_prompt, _ in new]
+
+        responses = self._timed(
+            self._backend.stream_batch(
+                [p[len(prefix) :] for p in formatted_prompts],
+                max_tokens,
+                prefix=prefix,
+                stop=finished,
+                constraints=constraints,
+                incoming=join if incoming is not None else None,
+            ),
+            batched=True,
+            between="parse",
+        )
+        try:
+            with closing(responses):
+                for row, response in responses:
+                    if row in finished:
+                        continue
+                    parser = parsers[row]
+                    if response.finish_reason is None:
+                        replies[row].append(response.token)
+                    if not (
+                        response.text == END_OF_TURN
+                        or parser.feed(response.text)
+                        or response.finish_reason is not None
+                    ):
+                        yield row, None
+                    else:
+                        # rows in `finished` stop decoding at the next step
+                        finished.add(row)
+                        if (
+                            response.finish_reason == "length"
+                            and not parser.finished
+                            and not self._repairable(prompts[row], parser, passages[row])
+                        ):
+                            truncated.append(row)
+                            continue
+                        parser.finish()
+                        try:
+                            yield row, self._parse_card(
+                                prompts[row], parser, passages[row], len(replies[row])
+                            )
+                        except Exception as e:
+                            yield row, e
+        except Exception as e:
+            for row in range(len(prompts)):
+                if row not in finished:
+                    yield row, e
 
+        for row in truncated:
+            parser = parsers[row]
             try:
-                result_data = jsonpickle.decode(result)
-            except Exception as json_error:
-                raise RuntimeError(f"Error decoding JSON: {str(json_error)}")
+                for _ in self._resume_card(
+                    parser,
+                    formatted_prompts[row] + replies[row],
+                    max_tokens,
+                    constraint=constraints[row] if constraints is not None else None,
+                    between="parse",
+                ):
+                    pass
+                parser.finish()
+                yield row, self._parse_card(
+                    prompts[row], parser, passages[row], len(replies[row]), resumed=True
+                )
+            except Exception as e:
+                yield row, e
 
-            result_data["front"] = prompt
-            return LlmOutput.model_validate(result_data)
-        except ValueError as e:
-            raise
-        except RuntimeError as e:
-            raise
-        except Exception as e:
-            raise RuntimeError(f"Unexpected error during text generation: {str(e)}")
+    def _parse_card(
+        self,
+        prompt: str,
+        parser: JsonStreamParser,
+        passages: list[Passage] | None = None,
+        reply_tokens: int = 0,
+        resumed: bool = False,
+    ) -> LlmOutput:
+        """
+        The flashcard in `parser`, repaired if it does not parse or validate
+        as it is. Repairs and resumed decoding are counted, together with the
+        `reply_tokens` decoded before them that a rerun would have repeated.
+        """
+        try:
+            output = self._card_output(prompt, parser, passages)
+        except (RuntimeError, ValidationError) as e:
+            repaired = parser.repaired()
+            try:
+                if repaired is None:
+                    raise
+                output = self._card_output(prompt, repaired, passages)
+            except (RuntimeError, ValidationError):
+                if isinstance(e, ValidationError):
+                    reason = "schema"
+                elif not parser.started:
+                    reason = "no_json"
+                elif not parser.done and parser.error == "JSON object is incomplete":
+                    reason = "truncated"
+                else:
+                    reason = "invalid_json"
+                metrics.FAILURES.inc(reason=reason)
+                if resumed:
+                    metrics.CARD_RESUMES.inc(result="failed")
+                raise e
+            parser = repaired
+
+        for kind in dict.fromkeys(parser.repairs):
+            metrics.CARD_REPAIRS.inc(kind=kind)
+        if parser.repairs:
+            self.repaired_cards += 1
+        if resumed:
+            metrics.CARD_RESUMES.inc(result="ok")
+            self.resumed_cards += 1
+        if parser.repairs or resumed:
+            metrics.SAVED_TOKENS.inc(reply_tokens)
+            self.saved_tokens += reply_tokens
+        metrics.REQUESTS.inc(kind="card")
+        return output
+
+    def _card_output(
+        self,
+        prompt: str,
+        parser: JsonStreamParser,
+        passages: list[Passage] | None = None,
+    ) -> LlmOutput:
+        result_data = parser.result()
+        result_data["front"] = prompt
+        # a reply cut off before its lists is still a card
+        result_data.setdefault("references", [])
+        result_data.setdefault("examples", [])
+        output = LlmOutput.model_validate(result_data)
+        if passages:
+            output.references = resolve_references(output.references, passages)
+        return output
+
+    def _repairable(
+        self,
+        prompt: str,
+        parser: JsonStreamParser,
+        passages: list[Passage] | None = None,
+    ) -> bool:
+        """
+        Whether an unfinished reply already holds a valid flashcard once
+        closed, so that decoding it further is not needed. Only a reply cut
+        off right after the `back` answer is: anywhere else, closing it
+        would drop text the model was still writing.
+        """
+        if parser.in_string or parser.last_value_key != "back":
+            return False
+        repaired = parser.repaired()
+        if repaired is None:
+            return False
+        try:
+            self._card_output(prompt, repaired, passages)
+        except (RuntimeError, ValidationError):
+            return False
+        return True
 
-    def generate_batch(
+    def iter_batch(
         self,
         source_input: str,
         prompts: list[str],
-        # system_prompt: str | None = None,
-        # max_tokens: int = 512,
-    ) -> list[LlmOutput]:
-        results = []
-        # if system_prompt == "":
-        #      system_prompt = None
+        batch_size: int | None = None,
+        use_cache: bool = True,
+    ) -> Iterator[tuple[int, LlmOutput | Exception]]:
+        """
+        Yields (index, flashcard) pairs as soon as each flashcard is done.
+        A prompt that fails yields its exception instead of a flashcard.
 
+        Cached flashcards are yielded first and only the misses reach the
+        model. Backends that support it decode up to `batch_size` questions
+        together (defaults to `max_batch_size`), so pairs may arrive out of
+        order.
+        """
         source_input = source_input.replace("\n", " ").strip()
+        cache = self._cache if use_cache else None
 
+        keys = {}
+        misses = []
         for i, prompt in enumerate(prompts):
-            try:
-                result = self.generate(
-                    source_input=source_input,
-                    prompt=prompt,
-                    # system_prompt=system_prompt,
-                    # max_tokens=max_tokens,
-                )
+            if cache is not None and prompt and prompt.strip():
+                keys[i] = self._cache_key(SYSTEM_PROMPT, source_input, prompt, 512)
+                cached = cache.get(keys[i])
+                if cached is not None:
+                    yield i, LlmOutput.model_validate_json(cached)
+                    continue
+            misses.append(i)
+
+        if not misses:
+            return
+
+        for j, output in self._iter_batch_model(
+            source_input, [prompts[i] for i in misses], batch_size
+        ):
+            i = misses[j]
+            if i in keys and not isinstance(output, Exception):
+                cache.put(keys[i], output.model_dump_json())
+            yield i, output
+
+    def _iter_batch_model(
+        self,
+        source_input: str,
+        prompts: list[str],
+        batch_size: int | None = None,
+    ) -> Iterator[tuple[int, LlmOutput | Exception]]:
+        """
+        The system prompt and source are prefilled once into a prompt cache
+        and every question decodes from a copy of it. With a source over the
+        token budget only the system prompt is shared, and each question sees
+        its own passages.
+        """
+        system_prompt = SYSTEM_PROMPT
+        max_tokens = 512
 
-                result = LlmOutput(
-                    front=result.front,
-                    back=result.back,
-                    references=result.references,
-                    examples=result.examples,
+        try:
+            self._load_model()
+            if not self._backend.is_loaded:
+                raise RuntimeError("Model or tokenizer not properly loaded")
+
+            sources = self._card_sources(source_input, prompts)
+            formatted_prompts = {}
+            for i, prompt in enumerate(prompts):
+                try:
+                    self._check_prompt(prompt)
+                except ValueError as e:
+                    yield i, e
+                    continue
+                with metrics.span("template"):
+                    formatted_prompts[i] = self._backend.apply_chat_template(
+                        self._card_messages(system_prompt, sources[i][0], prompt),
+                        add_generation_prompt=True,
+                    )
+
+            batch_size = batch_size or self._max_batch_size
+            batched = self._backend.supports_batch and batch_size > 1
+
+            prefix = self._shared_prefix(list(formatted_prompts.values()))
+            prefix_cache = None
+            if prefix and not batched:
+                prefix_cache = self._backend.make_prompt_cache(prefix)
+        except Exception as e:
+            raise RuntimeError(f"Error preparing batch: {str(e)}")
+
+        if batched:
+            indices = list(formatted_prompts)
+            for start in range(0, len(indices), batch_size):
+                chunk = indices[start : start + batch_size]
+                for row, output in self._iter_cards_batched(
+                    [prompts[i] for i in chunk],
+                    [formatted_prompts[i] for i in chunk],
+                    max_tokens,
+                    prefix,
+                    [sources[i][1] for i in chunk],
+                ):
+                    if output is not None:
+                        yield chunk[row], output
+            return
+
+        for i, formatted_prompt in formatted_prompts.items():
+            try:
+                prompt_cache = None
+                if prefix_cache is not None:
+                    prompt_cache = self._backend.copy_prompt_cache(prefix_cache)
+                result = self._generate_card(
+                    prompts[i],
+                    formatted_prompt,
+                    max_tokens,
+                    prompt_cache=prompt_cache,
+                    passages=sources[i][1],
+                    lookup=self._new_lookup(formatted_prompt),
                 )
-                results.append(result)
+                yield i, result
             except Exception as e:
-                print(f"Error generating flashcard {i + 1}: {e}")
-                continue
-        return results
+                yield i, e
 
-    def summarize(self, text_to_summarize: str) -> str:
+    def iter_deck(
+        self,
+        source_text: str,
+        max_active: int | None = None,
+        use_cache: bool = True,
+    ) -> Iterator[tuple[str, int, str | LlmOutput | Exception]]:
         """
-        Summarizes a given text into concise, bulleted points.
-        This method uses the SYSTEM_PROMPT_BULLET to guide the summarization.
+        Writes study questions for `source_text` and a flashcard for each in
+        one pass. A question goes to card generation as soon as its line of
+        the numbered list is complete: its card joins the running batch at
+        the next step, up to `max_active` cards (defaults to
+        `max_batch_size`) at once, while the question list decodes a token
+        per step next to it. Without batching, cards are decoded one at a
+        time as their questions appear. Yields ("question", index, text) as
+        questions appear and ("card", index, flashcard or exception) as
+        cards finish.
         """
-        system_prompt = SYSTEM_PROMPT_BULLET
+        card_source = source_text.replace("\n", " ").strip()
+        cache = self._cache if use_cache else None
+        max_active = max_active or self._max_batch_size
+        batched = self._backend.supports_batch and max_active > 1
 
         try:
             self._load_model()
-            if self._model is None or self._tokenizer is None:
+            if not self._backend.is_loaded:
                 raise RuntimeError("Model or tokenizer not properly loaded")
+            questions = self._question_lines(source_text, cache)
+        except Exception as e:
+            raise RuntimeError(f"Error creating questions: {str(e)}")
 
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": text_to_summarize},
+        prefix: list[int] | None = None
+        waiting: deque[tuple[int, str]] = deque()
+        # what is ready to be yielded, in order
+        events: deque[tuple[str, int, str | LlmOutput | Exception]] = deque()
+        failure: Exception | None = None
+        count = 0
+
+        def read_questions() -> None:
+            # one token of the question list
+            nonlocal questions, failure, count
+            try:
+                lines = next(questions)
+            except StopIteration:
+                questions, lines = None, []
+            except Exception as e:
+                questions, lines = None, []
+                failure = RuntimeError(f"Error creating questions: {str(e)}")
+            for question in lines:
+                events.append(("question", count, question))
+                key = self._cache_key(SYSTEM_PROMPT, card_source, question, 512)
+                cached = cache.get(key) if cache is not None else None
+                if cached is not None:
+                    events.append(("card", count, LlmOutput.model_validate_json(cached)))
+                else:
+                    waiting.append((count, question))
+                count += 1
+
+        def take(limit: int, rows: list[tuple[int, str]]) -> list:
+            # (question, formatted prompt, passages) of up to `limit` waiting questions
+            nonlocal prefix
+            taken = []
+            while waiting and len(taken) < limit:
+                i, question = waiting.popleft()
+                try:
+                    [(source, passages)] = self._card_sources(card_source, [question])
+                    with metrics.span("template"):
+                        formatted_prompt = self._backend.apply_chat_template(
+                            self._card_messages(SYSTEM_PROMPT, source, question),
+                            add_generation_prompt=True,
+                        )
+                    if prefix is None:
+                        # system prompt and source, prefilled once for every card
+                        prefix = self._shared_prefix(
+                            [self._deck_prefix(card_source, passages), formatted_prompt]
+                        )
+                    if formatted_prompt[: len(prefix)] != prefix:
+                        raise RuntimeError("Card prompt does not start with the deck prefix")
+                except Exception as e:
+                    events.append(("card", i, e))
+                    continue
+                rows.append((i, question))
+                taken.append((question, formatted_prompt, passages))
+            return taken
+
+        def finish(i: int, question: str, card: LlmOutput | Exception) -> None:
+            if cache is not None and not isinstance(card, Exception):
+                key = self._cache_key(SYSTEM_PROMPT, card_source, question, 512)
+                cache.put(key, card.model_dump_json())
+            events.append(("card", i, card))
+
+        prefix_cache = None
+        while questions is not None or waiting or events:
+            while events:
+                yield events.popleft()
+            if failure is not None:
+                raise failure
+            if not waiting:
+                if questions is not None:
+                    read_questions()
+                continue
+
+            rows: list[tuple[int, str]] = []
+            if not batched:
+                for question, formatted_prompt, passages in take(1, rows):
+                    if prefix and prefix_cache is None:
+                        prefix_cache = self._backend.make_prompt_cache(prefix)
+                    try:
+                        card = self._generate_card(
+                            question,
+                            formatted_prompt,
+                            512,
+                            self._backend.copy_prompt_cache(prefix_cache) if prefix else None,
+                            passages,
+                            self._new_lookup(formatted_prompt),
+                        )
+                    except Exception as e:
+                        card = e
+                    finish(*rows[0], card)
+                continue
+
+            def join(decoding: int) -> list:
+                if questions is not None:
+                    read_questions()
+                return take(max_active - decoding, rows) if failure is None else []
+
+            first = take(max_active, rows)
+            if not first:
+                continue
+            cards = self._iter_cards_batched(
+                [question for question, _, _ in first],
+                [formatted_prompt for _, formatted_prompt, _ in first],
+                512,
+                prefix,
+                [passages for _, _, passages in first],
+                incoming=join,
+            )
+            with closing(cards):
+                for row, card in cards:
+                    if card is not None:
+                        finish(*rows[row], card)
+                    while events:
+                        yield events.popleft()
+                    if failure is not None:
+                        raise failure
+
+    def _question_lines(
+        self, source_text: str, cache: GenerationCache | None
+    ) -> Iterator[list[str]]:
+        """
+        Decodes the question list, yielding after every token the questions
+        whose line it completed (usually none).
+        """
+        key = None
+        if cache is not None:
+            key = self._cache_key(SYSTEM_PROMPT_QUESTION, source_text, None, 512)
+            cached = cache.get(key)
+            if cached is not None:
+                yield self._questions(cached.split("\n"))
+                return
+
+        with metrics.span("template"):
+            formatted_prompt = self._backend.apply_chat_template(
+                [
+                    {"role": "system", "content": SYSTEM_PROMPT_QUESTION},
+                    {"role": "user", "content": source_text},
+                ],
+                add_generation_prompt=True,
+            )
+        text = []
+        line = ""
+        with closing(self._timed(self._backend.stream(formatted_prompt, 512))) as responses:
+            for response in responses:
+                if response.text == END_OF_TURN:
+                    break
+                text.append(response.text)
+                *lines, line = (line + response.text).split("\n")
+                yield self._questions(lines)
+        yield self._questions([line])
+
+        if cache is not None:
+            cache.put(key, "".join(text).strip())
+        metrics.REQUESTS.inc(kind="questions")
+
+    @staticmethod
+    def _questions(lines: list[str]) -> list[str]:
+        return [m.group(1) for m in map(_QUESTION_PATTERN.match, lines) if m]
+
+    def _deck_prefix(self, card_source: str, passages: list[Passage]) -> list[int]:
+        """
+        The tokens every card prompt of a deck starts with: system prompt
+        and source, or only the system prompt when each question gets its
+        own passages.
+        """
+        source = "" if passages else card_source
+        return self._shared_prefix(
+            [
+                self._backend.apply_chat_template(
+                    self._card_messages(SYSTEM_PROMPT, source, question),
+                    add_generation_prompt=True,
+                )
+                for question in ("What?", "Why?")
             ]
+        )
 
-            formatted_prompt = self._tokenizer.apply_chat_template(
-                messages, add_generation_prompt=True
+    def generate_batch(
+        self,
+        source_input: str,
+        prompts: list[str],
+        batch_size: int | None = None,
+        use_cache: bool = True,
+    ) -> list[LlmOutput]:
+        """
+        Generates one flashcard per prompt over the same source, in the order
+        of `prompts`. Prompts that fail are logged and skipped.
+        """
+        results = {}
+        for i, result in self.iter_batch(source_input, prompts, batch_size, use_cache):
+            if isinstance(result, Exception):
+                logger.warning("Error generating flashcard %d: %s", i + 1, result)
+                continue
+            results[i] = LlmOutput(
+                front=result.front,
+                back=result.back,
+                references=result.references,
+                examples=result.examples,
             )
+        return [results[i] for i in sorted(results)]
 
-            result = []
-            generate_kwargs = {
-                "model": self._model,
-                "tokenizer": self._tokenizer,
-                "prompt": formatted_prompt,
-                "max_tokens": 512,
-            }
-
-            for response in self._stream_generate(**generate_kwargs):
-                if response.text == "<end_of_turn>":
-                    break
-                result.append(response.text)
+    def summarize(self, text_to_summarize: str, use_cache: bool = True) -> str:
+        """
+        Summarizes a given text into concise, bulleted points.
+        This method uses the SYSTEM_PROMPT_BULLET to guide the summarization.
+        """
+        summary = ""
+        for kind, value in self.iter_summary(text_to_summarize, use_cache):
+            if kind == "summary":
+                summary = value
+        return summary
+
+    def iter_summary(
+        self, text_to_summarize: str, use_cache: bool = True
+    ) -> Iterator[tuple[str, list[str] | str]]:
+        """
+        Summarizes a text in one prompt or, over the source token budget,
+        map-reduce style: the text is split into chunks of up to the budget,
+        the chunks are summarized in batches, and their bullets are merged
+        with near-duplicates dropped. Merged bullets still over the budget
+        are summarized again in groups until they fit. Yields ("bullets",
+        new bullets) as each chunk is done and ("summary", text) last.
+
+        Chunk summaries are cached by chunk text, and chunks end where the
+        text says so rather than at a running token count (see
+        `chunk_source`), so after editing one section of a long text only
+        the chunk holding the edit is summarized again.
+        """
+        system_prompt = SYSTEM_PROMPT_BULLET
+
+        try:
+            cache = self._cache if use_cache else None
+            if cache is not None:
+                key = self._cache_key(system_prompt, text_to_summarize, None, 512)
+                cached = cache.get(key)
+                if cached is not None:
+                    yield "summary", cached
+                    return
+
+            self._load_model()
+            if not self._backend.is_loaded:
+                raise RuntimeError("Model or tokenizer not properly loaded")
 
-            return "".join(result).strip()
+            budget = self._source_token_budget
+            if budget is None or self._count_tokens(text_to_summarize) <= budget:
+                [(_, result)] = self._summarize_texts([text_to_summarize], cache)
+            else:
+                chunks = [
+                    p.text for p in chunk_source(text_to_summarize, self._count_tokens, budget)
+                ]
+                parts: list[list[str]] = [[] for _ in chunks]
+                streamed: list[str] = []
+                for i, summary in self._summarize_texts(chunks, cache):
+                    parts[i] = _bullets(summary)
+                    new = _merge_bullets(streamed, parts[i])
+                    if new:
+                        yield "bullets", new
+
+                # chunk order, not the order the chunks finished in
+                bullets: list[str] = []
+                _merge_bullets(bullets, [b for part in parts for b in part])
+                tokens = self._count_tokens(_bullet_list(bullets))
+                while tokens > budget:
+                    groups = _group_bullets(bullets, self._count_tokens, budget)
+                    if len(groups) < 2:
+                        break
+                    merged: list[list[str]] = [[] for _ in groups]
+                    for i, summary in self._summarize_texts(
+                        [_bullet_list(g) for g in groups], cache
+                    ):
+                        merged[i] = _bullets(summary)
+                    reduced: list[str] = []
+                    _merge_bullets(reduced, [b for part in merged for b in part])
+                    reduced_tokens = self._count_tokens(_bullet_list(reduced))
+                    if reduced_tokens >= tokens:
+                        break
+                    bullets, tokens = reduced, reduced_tokens
+                result = _bullet_list(bullets)
+
+            if cache is not None:
+                cache.put(key, result)
+            metrics.REQUESTS.inc(kind="summary")
+            yield "summary", result
 
         except Exception as e:
             raise RuntimeError(f"Error summarizing text: {str(e)}")
 
-    def create_question(self, source_text: str) -> str:
+    def _summarize_texts(
+        self, texts: list[str], cache: GenerationCache | None
+    ) -> Iterator[tuple[int, str]]:
+        """
+        Yields (index, bullet summary) for each text as it is done: cached
+        ones first, the rest decoded together on backends that batch.
+        """
+        system_prompt = SYSTEM_PROMPT_BULLET
+        keys = {}
+        formatted_prompts = {}
+        for i, text in enumerate(texts):
+            if cache is not None:
+                keys[i] = self._cache_key(system_prompt, text, None, 512)
+                cached = cache.get(keys[i])
+                if cached is not None:
+                    yield i, cached
+                    continue
+            with metrics.span("template"):
+                formatted_prompts[i] = self._backend.apply_chat_template(
+                    [
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": text},
+                    ],
+                    add_generation_prompt=True,
+                )
+
+        def finish(i: int, parts: list[str]) -> tuple[int, str]:
+            result = "".join(parts).strip()
+            if i in keys:
+                cache.put(keys[i], result)
+            return i, result
+
+        indices = list(formatted_prompts)
+        batch_size = self._max_batch_size
+        if self._backend.supports_batch and batch_size > 1 and len(indices) > 1:
+            for start in range(0, len(indices), batch_size):
+                chunk = indices[start : start + batch_size]
+                prompts = [formatted_prompts[i] for i in chunk]
+                # the system prompt is prefilled once for the whole batch
+                prefix = self._shared_prefix(prompts)
+                parts: list[list[str]] = [[] for _ in chunk]
+                finished: set[int] = set()
+                responses = self._timed(
+                    self._backend.stream_batch(
+                        [p[len(prefix) :] for p in prompts], 512, prefix=prefix, stop=finished
+                    ),
+                    batched=True,
+                )
+                with closing(responses):
+                    for row, response in responses:
+                        if row in finished:
+                            continue
+                        if response.text != END_OF_TURN:
+                            parts[row].append(response.text)
+                        if response.text == END_OF_TURN or response.finish_reason is not None:
+                            finished.add(row)
+                            yield finish(chunk[row], parts[row])
+            return
+
+        for i in indices:
+            parts = []
+            lookup = self._new_lookup(formatted_prompts[i])
+            responses = self._timed(
+                self._backend.stream(formatted_prompts[i], 512, lookup=lookup), lookup=lookup
+            )
+            with closing(responses):
+                for response in responses:
+                    if response.text == END_OF_TURN:
+                        break
+                    parts.append(response.text)
+            yield finish(i, parts)
+
+    def create_question(self, source_text: str, use_cache: bool = True) -> str:
         """
         Creates a numbered list of study questions based on the provided source text.
         This method uses the SYSTEM_PROMPT_QUESTION to guide the question generation.
@@ -280,8 +1224,15 @@ class Llm:
         system_prompt = SYSTEM_PROMPT_QUESTION
 
         try:
+            cache = self._cache if use_cache else None
+            if cache is not None:
+                key = self._cache_key(system_prompt, source_text, None, 512)
+                cached = cache.get(key)
+                if cached is not None:
+                    return cached
+
             self._load_model()
-            if self._model is None or self._tokenizer is None:
+            if not self._backend.is_loaded:
                 raise RuntimeError("Model or tokenizer not properly loaded")
 
             messages = [
@@ -289,31 +1240,46 @@ class Llm:
                 {"role": "user", "content": source_text},
             ]
 
-            formatted_prompt = self._tokenizer.apply_chat_template(
-                messages, add_generation_prompt=True
-            )
+            with metrics.span("template"):
+                formatted_prompt = self._backend.apply_chat_template(
+                    messages, add_generation_prompt=True
+                )
 
             result = []
-            generate_kwargs = {
-                "model": self._model,
-                "tokenizer": self._tokenizer,
-                "prompt": formatted_prompt,
-                "max_tokens": 512,
-            }
-
-            for response in self._stream_generate(**generate_kwargs):
-                if response.text == "<end_of_turn>":
-                    break
-                result.append(response.text)
-
-            return "".join(result).strip()
+            with closing(self._timed(self._backend.stream(formatted_prompt, 512))) as responses:
+                for response in responses:
+                    if response.text == END_OF_TURN:
+                        break
+                    result.append(response.text)
+
+            result = "".join(result).strip()
+            if cache is not None:
+                cache.put(key, result)
+            metrics.REQUESTS.inc(kind="questions")
+            return result
 
         except Exception as e:
             raise RuntimeError(f"Error creating questions: {str(e)}")
 
     @property
     def is_loaded(self) -> bool:
-        return self._is_loaded
+        return self._backend.is_loaded
+
+    @property
+    def backend(self) -> Backend:
+        return self._backend
+
+    @property
+    def speculative(self) -> bool:
+        return self._speculative
+
+    @property
+    def constrained(self) -> bool:
+        return self._constraint is not None
+
+    @property
+    def cache(self) -> GenerationCache | None:
+        return self._cache
 
     @property
     def repo(self) -> str:
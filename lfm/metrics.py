@@ -0,0 +1,258 @@
+"""
+In-process metrics in the Prometheus text format, and per-request timings.
+
+Stages are timed with `span`, which feeds the `lfm_stage_seconds` histogram
+and, inside `collect_timings`, the timings of the current request:
+
+    with collect_timings() as timings:
+        with span("decode"):
+            ...
+    server_timing_header(timings)  # "decode;dur=12.3"
+"""
+
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple[str, ...]:
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def snapshot(self) -> dict[tuple[str, ...], float]:
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(
+                    f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                )
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: counts per bucket (the last one is +Inf), sum
+        self._series: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._series.setdefault(
+                key, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[index] += 1
+            total[0] += value
+
+    def count(self, **labels) -> int:
+        series = self._series.get(self._key(labels))
+        return sum(series[0]) if series else 0
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        with self._lock:
+            for key, (counts, total) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = f'le="{_format_value(bound)}"'
+                    labels = _format_labels(self.labelnames, key, le)
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {_format_value(total[0])}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+STAGE_SECONDS: Histogram = registry.register(
+    Histogram(
+        "lfm_stage_seconds",
+        "Time spent per request stage (queue, template, prefill, decode, parse, db, render).",
+        ("stage",),
+    )
+)
+TOKENS: Counter = registry.register(
+    Counter("lfm_tokens_total", "Tokens processed by the model.", ("kind",))
+)
+FAILURES: Counter = registry.register(
+    Counter("lfm_failures_total", "Failed generations and requests by reason.", ("reason",))
+)
+REQUESTS: Counter = registry.register(
+    Counter("lfm_requests_total", "Finished generations by kind.", ("kind",))
+)
+CACHE_LOOKUPS: Counter = registry.register(
+    Counter("lfm_cache_lookups_total", "Generation cache lookups by result.", ("result",))
+)
+QUEUE_JOBS: Gauge = registry.register(
+    Gauge("lfm_queue_jobs", "Scheduler jobs by state.", ("state",))
+)
+DRAFT_TOKENS: Counter = registry.register(
+    Counter(
+        "lfm_draft_tokens_total",
+        "Speculative draft tokens by whether the model accepted them.",
+        ("result",),
+    )
+)
+CARD_REPAIRS: Counter = registry.register(
+    Counter(
+        "lfm_card_repairs_total", "Flashcards whose JSON was repaired, by repair.", ("kind",)
+    )
+)
+CARD_RESUMES: Counter = registry.register(
+    Counter(
+        "lfm_card_resumes_total",
+        "Flashcards cut off at max_tokens and decoded further, by result.",
+        ("result",),
+    )
+)
+SAVED_TOKENS: Counter = registry.register(
+    Counter(
+        "lfm_saved_tokens_total",
+        "Decode tokens of repaired or resumed flashcards that a rerun would repeat.",
+    )
+)
+WORKER_CALLS: Gauge = registry.register(
+    Gauge("lfm_worker_calls", "Calls in flight per model worker process.", ("worker",))
+)
+WORKER_RESTARTS: Counter = registry.register(
+    Counter("lfm_worker_restarts_total", "Model worker processes restarted after exiting.")
+)
+PEAK_MEMORY: Gauge = registry.register(
+    Gauge("lfm_peak_memory_gigabytes", "Peak model memory reported by the backend.")
+)
+
+# counted inside model worker processes and added to the parent's, see lfm.pool
+WORKER_COUNTERS = {
+    c.name: c
+    for c in (
+        TOKENS,
+        FAILURES,
+        REQUESTS,
+        CACHE_LOOKUPS,
+        DRAFT_TOKENS,
+        CARD_REPAIRS,
+        CARD_RESUMES,
+        SAVED_TOKENS,
+    )
+}
+
+# stage -> seconds of the request being handled, see `collect_timings`
+_timings: contextvars.ContextVar[dict[str, float] | None] = contextvars.ContextVar(
+    "lfm_timings", default=None
+)
+
+
+def record(stage: str, seconds: float) -> None:
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timings = _timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+@contextmanager
+def collect_timings() -> Iterator[dict[str, float]]:
+    timings: dict[str, float] = {}
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+def server_timing_header(timings: dict[str, float]) -> str:
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
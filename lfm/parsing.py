@@ -0,0 +1,346 @@
+import re
+
+_NUMBER_PATTERN = re.compile(r"-?(0|[1-9]\d*)(\.\d+)?([eE][+-]?\d+)?")
+_NUMBER_CHARS = set("0123456789+-.eE")
+_LITERALS = ("true", "false", "null")
+_WHITESPACE = " \t\r\n"
+_CLOSERS = {"{": "}", "[": "]"}
+_CONTROL_ESCAPES = {"\n": "\\n", "\t": "\\t", "\r": "\\r", "\b": "\\b", "\f": "\\f"}
+# what may follow a quote that closes its string: whitespace, then possibly
+# the start of a `"key":` that is missing the comma before it
+_AFTER_QUOTE_PREFIX = re.compile(r'[ \t\r\n]*(?:"[^"\\\n]*(?:"[ \t\r\n]*)?)?')
+_KEY_AFTER_QUOTE = re.compile(r'[ \t\r\n]*"[^"\\\n]*"[ \t\r\n]*:')
+
+
+class JsonStreamParser:
+    """
+    Incremental scanner for the first top-level JSON object in a token stream.
+
+    Text before the opening brace (reasoning, code fences) is skipped. Once
+    the object starts every character is validated, so `done` is set the
+    moment the object closes and `error` as soon as the output can no
+    longer be valid JSON. An object that closes empty or without all of
+    `required_keys` at the top level is taken for a brace in the reasoning
+    (`{}` or code in the source) and scanning goes on after it.
+
+    Common model slips are fixed on the way and listed in `repairs`:
+    trailing commas are dropped, single-quoted strings and escaped single
+    quotes are rewritten, and raw control characters inside strings are
+    escaped, as are double quotes inside strings: a quote only closes its
+    string if `,`, `]`, `}` (or `:` after a key) comes next, or a `"key":`
+    that lacks the comma before it, which is an error. `repaired` closes an
+    object that was cut off.
+    """
+
+    def __init__(self, required_keys: tuple[str, ...] = ()):
+        self.required_keys = required_keys
+        self._chars: list[str] = []
+        self._stack: list[str] = []
+        self._expect = "start"
+        self._in_string = False
+        self._is_key = False
+        self._escape = False
+        self._hex = 0
+        self._literal = ""
+        self._quote = '"'
+        # text seen after a quote that may close its string, while it can
+        # still tell whether it does
+        self._pending_quote: str | None = None
+        # length of the text and the open containers after the last complete value
+        self._safe: tuple[int, tuple[str, ...]] | None = None
+        # keys of the top-level object, and where the key being read starts
+        self._keys: set[str] = set()
+        self._key_start = 0
+        self._key: str | None = None
+        # the top-level key whose value was the last one to complete
+        self.last_value_key: str | None = None
+        self.repairs: list[str] = []
+        self.done = False
+        self.error: str | None = None
+
+    @property
+    def finished(self) -> bool:
+        return self.done or self.error is not None
+
+    @property
+    def started(self) -> bool:
+        return self._expect != "start"
+
+    @property
+    def in_string(self) -> bool:
+        """
+        Whether the text so far breaks off inside a string value.
+        """
+        if not self._in_string or self._is_key:
+            return False
+        return self._pending_quote is None or self._pending_quote.strip(_WHITESPACE) != ""
+
+    @property
+    def text(self) -> str:
+        return "".join(self._chars)
+
+    def feed(self, text: str) -> bool:
+        """
+        Consumes the next chunk of model output. Returns True once the
+        object is complete or invalid; the rest of the chunk is ignored.
+        """
+        for ch in text:
+            if self.finished:
+                break
+            self._feed_char(ch)
+        return self.finished
+
+    def finish(self) -> None:
+        """
+        Marks the end of the stream; an unfinished object becomes an error.
+        """
+        if self.finished:
+            return
+        if not self.started:
+            self.error = "no JSON object in output"
+        else:
+            self.error = "JSON object is incomplete"
+
+    def repaired(self) -> "JsonStreamParser | None":
+        """
+        A finished copy of an object that was cut off: anything after the
+        last complete value, including a string that breaks off, is dropped
+        and the open brackets are closed. None if the object never started,
+        is already done, or is invalid rather than incomplete.
+        """
+        if self.done or not self.started or self._safe is None:
+            return None
+        if self.error not in (None, "JSON object is incomplete"):
+            return None
+        chars = list(self._chars)
+        length, stack = self._safe
+        if self._in_string and not self.in_string and not self._is_key:
+            # the string was closed, only what follows it is missing
+            chars.append('"')
+            length, stack = len(chars), tuple(self._stack)
+
+        repaired = JsonStreamParser(self.required_keys)
+        repaired._chars = chars[:length] + [_CLOSERS[c] for c in reversed(stack)]
+        repaired._expect = "end"
+        repaired.repairs = self.repairs + ["truncated"]
+        repaired.done = True
+        return repaired
+
+    def result(self) -> dict:
+        if not self.done:
+            raise RuntimeError(f"Error decoding JSON: {self.error or 'not finished'}")
+        # lazy import, only finished objects need decoding
+        import jsonpickle
+
+        try:
+            return jsonpickle.decode(self.text)
+        except Exception as json_error:
+            raise RuntimeError(f"Error decoding JSON: {str(json_error)}")
+
+    def _fail(self, ch: str) -> None:
+        if self._expect == "key_or_close" and len(self._stack) == 1:
+            # a stray brace in the reasoning text, keep looking for the object
+            self._restart()
+            return
+        self.error = f"unexpected {ch!r} after {self.text[-40:]!r}"
+
+    def _feed_char(self, ch: str) -> None:
+        if self._pending_quote is not None:
+            ahead = self._pending_quote + ch
+            if ch in _WHITESPACE or (
+                not self._is_key and _AFTER_QUOTE_PREFIX.fullmatch(ahead)
+            ):
+                self._pending_quote = ahead
+                return
+            self._pending_quote = None
+            if ahead.lstrip(_WHITESPACE)[0] in (":" if self._is_key else ",}]") or (
+                not self._is_key and _KEY_AFTER_QUOTE.fullmatch(ahead)
+            ):
+                # the quote closed the string; before a key the missing
+                # comma fails the object below
+                self._end_string()
+            elif self._quote == "'":
+                # it was an apostrophe
+                self._chars.append("'")
+            else:
+                # a double quote the model did not escape
+                self._chars.append('\\"')
+                self.repairs.append("unescaped_quotes")
+            for c in ahead:
+                if self.finished:
+                    break
+                self._feed_char(c)
+            return
+
+        if self._in_string:
+            self._feed_string(ch)
+            return
+
+        if self._literal:
+            if ch in _NUMBER_CHARS or ch.isalpha():
+                self._literal += ch
+                self._chars.append(ch)
+                if not self._literal_prefix_ok():
+                    self._fail(ch)
+                return
+            if not self._literal_complete():
+                self._fail(ch)
+                return
+            self._literal = ""
+            self._expect = "comma_or_close"
+            self._end_value()
+
+        expect = self._expect
+        if expect == "start":
+            if ch == "{":
+                self._open(ch)
+            return
+
+        if ch in _WHITESPACE:
+            self._chars.append(ch)
+            return
+
+        if expect in ("value", "value_or_close"):
+            if ch == "]" and expect == "value_or_close":
+                self._close(ch)
+            elif ch == "]" and self._stack[-1] == "[":
+                self._drop_trailing_comma()
+                self._close(ch)
+            elif ch in "\"'":
+                self._start_string(is_key=False, quote=ch)
+            elif ch in "{[":
+                self._open(ch)
+            elif ch == "-" or ch.isdigit() or ch in "tfn":
+                self._literal = ch
+                self._chars.append(ch)
+            else:
+                self._fail(ch)
+        elif expect in ("key", "key_or_close"):
+            if ch == "}" and expect == "key_or_close":
+                self._close(ch)
+            elif ch == "}":
+                self._drop_trailing_comma()
+                self._close(ch)
+            elif ch in "\"'":
+                self._start_string(is_key=True, quote=ch)
+            else:
+                self._fail(ch)
+        elif expect == "colon":
+            if ch == ":":
+                self._chars.append(ch)
+                self._expect = "value"
+            else:
+                self._fail(ch)
+        elif expect == "comma_or_close":
+            if ch == ",":
+                self._chars.append(ch)
+                self._expect = "key" if self._stack[-1] == "{" else "value"
+            elif ch in "}]":
+                self._close(ch)
+            else:
+                self._fail(ch)
+
+    def _feed_string(self, ch: str) -> None:
+        if self._hex:
+            if ch not in "0123456789abcdefABCDEF":
+                self._fail(ch)
+                return
+            self._hex -= 1
+        elif self._escape:
+            if ch == "'":
+                # \' is not a JSON escape, the quote needs none
+                self._chars.pop()
+                self._escape = False
+                self.repairs.append("single_quotes")
+            elif ch not in '"\\/bfnrtu':
+                self._fail(ch)
+                return
+            self._escape = False
+            self._hex = 4 if ch == "u" else 0
+        elif ch == "\\":
+            self._escape = True
+        elif ch == self._quote:
+            # closes the string only if what follows says so
+            self._pending_quote = ""
+            return
+        elif ch == '"':
+            # a double quote inside a single-quoted string
+            ch = '\\"'
+        elif ch < " ":
+            ch = _CONTROL_ESCAPES.get(ch) or f"\\u{ord(ch):04x}"
+        self._chars.append(ch)
+
+    def _restart(self) -> None:
+        self._chars.clear()
+        self._stack.clear()
+        self._expect = "start"
+        self._safe = None
+        self._keys.clear()
+        self.last_value_key = None
+        self.repairs.clear()
+
+    def _start_string(self, is_key: bool, quote: str = '"') -> None:
+        self._in_string = True
+        self._is_key = is_key
+        self._key_start = len(self._chars) + 1
+        self._quote = quote
+        if quote == "'":
+            self.repairs.append("single_quotes")
+        self._chars.append('"')
+
+    def _end_string(self) -> None:
+        self._in_string = False
+        if self._is_key and len(self._stack) == 1:
+            self._key = "".join(self._chars[self._key_start :])
+            self._keys.add(self._key)
+        self._chars.append('"')
+        if self._is_key:
+            self._expect = "colon"
+        else:
+            self._expect = "comma_or_close"
+            self._end_value()
+
+    def _drop_trailing_comma(self) -> None:
+        i = len(self._chars) - 1
+        while self._chars[i] in _WHITESPACE:
+            i -= 1
+        del self._chars[i]
+        self.repairs.append("trailing_comma")
+
+    def _mark_safe(self) -> None:
+        self._safe = (len(self._chars), tuple(self._stack))
+
+    def _end_value(self) -> None:
+        self.last_value_key = self._key if len(self._stack) == 1 else None
+        self._mark_safe()
+
+    def _open(self, ch: str) -> None:
+        self._stack.append(ch)
+        self._chars.append(ch)
+        self._expect = "key_or_close" if ch == "{" else "value_or_close"
+        self._mark_safe()
+
+    def _close(self, ch: str) -> None:
+        if not self._stack or {"}": "{", "]": "["}[ch] != self._stack[-1]:
+            self._fail(ch)
+            return
+        self._stack.pop()
+        self._chars.append(ch)
+        if self._stack:
+            self._expect = "comma_or_close"
+            self._end_value()
+        elif not self._keys or not self._keys.issuperset(self.required_keys):
+            # `{}` or some other object in the reasoning, not the answer
+            self._restart()
+        else:
+            self.done = True
+
+    def _literal_prefix_ok(self) -> bool:
+        if self._literal[0] in "tfn":
+            return any(word.startswith(self._literal) for word in _LITERALS)
+        return all(c in _NUMBER_CHARS for c in self._literal)
+
+    def _literal_complete(self) -> bool:
+        if self._literal[0] in "tfn":
+            return self._literal in _LITERALS
+        return _NUMBER_PATTERN.fullmatch(self._literal) is not None
@@ -0,0 +1,329 @@
+"""
+Model replicas in worker processes, for serving from more than one core.
+
+`WorkerPool` has the generation methods of `Llm` (`generate_batch`,
+`iter_batch`, `iter_deck`, `summarize`, `iter_summary`, `create_question`,
+`warm_up`) and forwards each call over a pipe to the worker process with the
+fewest calls in flight.
+Every worker loads its own model; a worker that dies is started again and
+the calls it was running fail with a RuntimeError.
+"""
+
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+from multiprocessing.connection import Connection, wait
+from typing import Any, Iterator
+
+from . import metrics
+
+
+def prefetch_weights(repo: str) -> None:
+    """
+    Downloads `repo` into the Hugging Face cache once, before the workers
+    start, so they all load the same on-disk snapshot instead of racing to
+    fetch it.
+    """
+    if os.path.isdir(repo):
+        return
+    try:
+        # lazy import
+        from huggingface_hub import snapshot_download  # type: ignore
+    except ImportError:
+        return
+    snapshot_download(repo)
+
+
+def _counter_values() -> dict[str, dict]:
+    return {name: counter.snapshot() for name, counter in metrics.WORKER_COUNTERS.items()}
+
+
+def _worker_main(conn: Connection, options: dict) -> None:
+    # lazy import, keeps the parent's import of this module light
+    from .backend import get_backend
+    from .cache import GenerationCache
+    from .llm import Llm
+
+    cache = GenerationCache(options["cache"]) if options["cache"] else None
+    llm = Llm(
+        repo=options["repo"],
+        backend=get_backend(options["backend"]),
+        max_batch_size=options["max_batch_size"],
+        constrained=options["constrained"],
+        cache=cache,
+        source_token_budget=options["source_token_budget"],
+        speculative=options.get("speculative", False),
+    )
+    try:
+        if options["warm_up"]:
+            llm.warm_up()
+        else:
+            llm._load_model()
+        conn.send((None, "loaded", None))
+    except Exception as e:
+        conn.send((None, "failed", str(e)))
+        return
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if message is None:
+            return
+        call_id, method, args = message
+
+        # stage timings and counters are sent back with the result, so the
+        # parent's /metrics covers the work done here
+        before = _counter_values()
+        with metrics.collect_timings() as timings:
+            try:
+                result = getattr(llm, method)(*args)
+                if hasattr(result, "__next__"):
+                    for item in result:
+                        conn.send((call_id, "item", item))
+                    result = None
+                kind = "result"
+            except Exception as e:
+                kind, result = "error", RuntimeError(str(e))
+        after = _counter_values()
+        counters = {
+            name: {k: v - before[name].get(k, 0) for k, v in values.items()}
+            for name, values in after.items()
+        }
+        conn.send((call_id, kind, (result, timings, counters)))
+
+
+class _Worker:
+    def __init__(self, index: int, options: dict, context):
+        self.index = index
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(child_conn, options),
+            name=f"lfm-model-{index}",
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.loaded = False
+        # set when the model failed to load; such a worker is not restarted
+        self.error: str | None = None
+        # call id -> queue of the caller waiting for its messages
+        self.calls: dict[int, queue.Queue] = {}
+        self.send_lock = threading.Lock()
+
+
+class WorkerPool:
+    """
+    `workers` model processes behind one `Llm`-like front. `options` are
+    the `Llm` arguments each worker is built with: repo, backend,
+    max_batch_size, constrained, cache (a file path or None),
+    source_token_budget, speculative and warm_up.
+    """
+
+    def __init__(self, workers: int, options: dict):
+        if workers < 1:
+            raise ValueError("A worker pool needs at least one worker")
+        self.size = workers
+        self.options = options
+        self.restarts = 0
+
+        self._context = multiprocessing.get_context("spawn")
+        self._workers: list[_Worker] = []
+        self._ids = itertools.count()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._reader: threading.Thread | None = None
+
+    def start(self) -> None:
+        if self.options.get("backend") == "mlx":
+            prefetch_weights(self.options["repo"])
+        self._workers = [_Worker(i, self.options, self._context) for i in range(self.size)]
+        self._reader = threading.Thread(target=self._read, name="lfm-pool-reader", daemon=True)
+        self._reader.start()
+
+    def shutdown(self, timeout: float = 5.0) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for worker in self._workers:
+            try:
+                with worker.send_lock:
+                    worker.conn.send(None)
+            except OSError:
+                pass
+        for worker in self._workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.terminate()
+
+    def stats(self) -> list[dict]:
+        with self._condition:
+            return [
+                {
+                    "worker": w.index,
+                    "pid": w.process.pid,
+                    "loaded": w.loaded,
+                    "in_flight": len(w.calls),
+                }
+                for w in self._workers
+            ]
+
+    @property
+    def is_loaded(self) -> bool:
+        with self._condition:
+            return bool(self._workers) and all(w.loaded for w in self._workers)
+
+    def warm_up(self) -> None:
+        """
+        Waits until every worker has loaded (and, with the warm_up option,
+        warmed up) its model.
+        """
+        with self._condition:
+            while not self._closed and not (
+                self._workers and all(w.loaded or w.error for w in self._workers)
+            ):
+                self._condition.wait()
+            errors = [w.error for w in self._workers if w.error]
+        if errors:
+            raise RuntimeError(f"Model worker failed to load: {errors[0]}")
+
+    def generate_batch(self, source_input: str, prompts: list[str]) -> list:
+        return self._call("generate_batch", source_input, prompts)
+
+    def iter_batch(self, source_input: str, prompts: list[str]) -> Iterator:
+        return self._stream("iter_batch", source_input, prompts)
+
+    def iter_deck(self, source_text: str) -> Iterator:
+        return self._stream("iter_deck", source_text)
+
+    def summarize(self, text_to_summarize: str) -> str:
+        return self._call("summarize", text_to_summarize)
+
+    def iter_summary(self, text_to_summarize: str) -> Iterator:
+        return self._stream("iter_summary", text_to_summarize)
+
+    def create_question(self, source_text: str) -> str:
+        return self._call("create_question", source_text)
+
+    def _submit(self, method: str, args: tuple) -> tuple[_Worker, int, queue.Queue]:
+        call_id = next(self._ids)
+        replies: queue.Queue = queue.Queue()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Worker pool is shut down")
+            candidates = [w for w in self._workers if w.error is None]
+            if not candidates:
+                raise RuntimeError(f"No model worker is available: {self._workers[0].error}")
+            # least loaded first, loaded workers before ones still starting
+            worker = min(candidates, key=lambda w: (not w.loaded, len(w.calls), w.index))
+            worker.calls[call_id] = replies
+        try:
+            with worker.send_lock:
+                worker.conn.send((call_id, method, args))
+        except OSError as e:
+            with self._condition:
+                worker.calls.pop(call_id, None)
+            raise RuntimeError(f"Model worker {worker.index} is unavailable: {str(e)}")
+        return worker, call_id, replies
+
+    def _stream(self, method: str, *args) -> Iterator[Any]:
+        worker, call_id, replies = self._submit(method, args)
+        try:
+            while True:
+                kind, payload = replies.get()
+                if kind == "item":
+                    yield payload
+                    continue
+                result, timings, counters = payload
+                self._merge_metrics(timings, counters)
+                if kind == "error":
+                    raise result
+                return result
+        finally:
+            with self._condition:
+                worker.calls.pop(call_id, None)
+
+    def _call(self, method: str, *args) -> Any:
+        stream = self._stream(method, *args)
+        try:
+            while True:
+                next(stream)
+        except StopIteration as stop:
+            return stop.value
+
+    @staticmethod
+    def _merge_metrics(timings: dict, counters: dict) -> None:
+        for stage, seconds in timings.items():
+            metrics.record(stage, seconds)
+        for name, values in counters.items():
+            counter = metrics.WORKER_COUNTERS[name]
+            for key, delta in values.items():
+                if delta:
+                    counter.inc(delta, **dict(zip(counter.labelnames, key)))
+
+    def _read(self) -> None:
+        while True:
+            with self._condition:
+                if self._closed:
+                    return
+                workers = list(self._workers)
+            by_handle = {}
+            for worker in workers:
+                if worker.error is not None:
+                    continue
+                by_handle[worker.conn] = worker
+                by_handle[worker.process.sentinel] = worker
+
+            if not by_handle:
+                with self._condition:
+                    self._condition.wait(1.0)
+                continue
+            for ready in wait(list(by_handle), timeout=1.0):
+                worker = by_handle[ready]
+                if ready is worker.conn:
+                    self._receive(worker)
+                elif worker.conn.poll() is False:
+                    self._restart(worker)
+
+    def _receive(self, worker: _Worker) -> None:
+        try:
+            call_id, kind, payload = worker.conn.recv()
+        except (EOFError, OSError):
+            self._restart(worker)
+            return
+        with self._condition:
+            if call_id is None:
+                worker.loaded = kind == "loaded"
+                worker.error = payload if kind == "failed" else None
+                self._condition.notify_all()
+                return
+            replies = worker.calls.get(call_id)
+        # calls whose caller stopped listening are dropped
+        if replies is not None:
+            replies.put((kind, payload))
+
+    def _restart(self, worker: _Worker) -> None:
+        with self._condition:
+            if self._closed or worker not in self._workers:
+                return
+            worker.process.join(1)
+            exit_code = worker.process.exitcode
+            error = RuntimeError(f"Model worker {worker.index} exited with code {exit_code}")
+            for replies in worker.calls.values():
+                replies.put(("error", (error, {}, {})))
+            worker.calls.clear()
+            if not worker.loaded:
+                # a model that cannot load would only crash again
+                worker.error = worker.error or f"exited with code {exit_code} while loading"
+                self._condition.notify_all()
+                return
+
+            self.restarts += 1
+            metrics.WORKER_RESTARTS.inc()
+            replacement = _Worker(worker.index, self.options, self._context)
+            self._workers[self._workers.index(worker)] = replacement
+            worker.conn.close()
@@ -0,0 +1,181 @@
+import hashlib
+import math
+import re
+from collections import Counter
+from dataclasses import dataclass
+from typing import Callable
+
+_SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+")
+_PARAGRAPH_PATTERN = re.compile(r"\n\s*\n")
+# words at the end of a paragraph or sentence that decide whether a chunk ends there
+_ANCHOR_WORDS = 8
+_WORD_PATTERN = re.compile(r"\w+")
+_LABEL_PATTERN = re.compile(r"\[(\d+)\]|\bpassages?\s+(\d+)", re.IGNORECASE)
+_POSITION_PATTERN = re.compile(r"source, sentences? \d+(?:-\d+)?")
+
+
+def terms(text: str) -> list[str]:
+    return [w.lower() for w in _WORD_PATTERN.findall(text)]
+
+
+@dataclass
+class Passage:
+    """
+    A window of consecutive source sentences. `id` is the label the model
+    sees; sentence numbers are 1-based and inclusive.
+    """
+
+    id: int
+    text: str
+    first_sentence: int
+    last_sentence: int
+    tokens: int
+
+    @property
+    def label(self) -> str:
+        if self.first_sentence == self.last_sentence:
+            return f"source, sentence {self.first_sentence}"
+        return f"source, sentences {self.first_sentence}-{self.last_sentence}"
+
+
+def _is_cut(text: str, tokens: int, target: int) -> bool:
+    # a chance of tokens / target, decided by the closing words alone so
+    # that editing the rest of the text keeps the decision
+    anchor = " ".join(text.split()[-_ANCHOR_WORDS:])
+    digest = hashlib.blake2b(anchor.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") < tokens / target * 2**64
+
+
+def chunk_source(
+    text: str, count_tokens: Callable[[str], int], chunk_tokens: int = 128
+) -> list[Passage]:
+    """
+    Splits text into passages of whole sentences, at most `chunk_tokens`
+    tokens each unless a single sentence is longer.
+
+    Passages end at paragraph breaks, or between the sentences of
+    paragraphs too long for one passage, wherever a hash of the last words
+    before says so (past a quarter of `chunk_tokens`, about every half on
+    average). Where they end depends on the text there, not on its
+    position, so an edit changes the passage it falls in and the others
+    keep their text.
+    """
+    target = max(chunk_tokens // 2, 1)
+    # whole paragraphs, or the sentences of those too long for one passage
+    units: list[tuple[list[str], int]] = []
+    for paragraph in _PARAGRAPH_PATTERN.split(text):
+        sentences = [s.strip() for s in _SENTENCE_PATTERN.split(paragraph) if s.strip()]
+        sizes = [count_tokens(s) + 1 for s in sentences]
+        if sum(sizes) <= chunk_tokens:
+            if sentences:
+                units.append((sentences, sum(sizes)))
+        else:
+            units.extend(([s], size) for s, size in zip(sentences, sizes))
+
+    passages: list[Passage] = []
+    current: list[str] = []
+    tokens = 0
+    first = 1
+
+    def close() -> None:
+        nonlocal current, tokens, first
+        last = first + len(current) - 1
+        passages.append(Passage(len(passages) + 1, " ".join(current), first, last, tokens))
+        current, tokens, first = [], 0, last + 1
+
+    for sentences, size in units:
+        if current and tokens + size > chunk_tokens:
+            close()
+        current.extend(sentences)
+        tokens += size
+        if tokens >= chunk_tokens // 4 and _is_cut(sentences[-1], size, target):
+            close()
+    if current:
+        close()
+    return passages
+
+
+class Bm25Index:
+    """
+    Okapi BM25 over a fixed list of passages.
+    """
+
+    def __init__(self, passages: list[Passage], k1: float = 1.5, b: float = 0.75):
+        self.passages = passages
+        self.k1 = k1
+        self.b = b
+        self._counts = [Counter(terms(p.text)) for p in passages]
+        self._lengths = [sum(c.values()) for c in self._counts]
+        self._average_length = sum(self._lengths) / len(passages) if passages else 0.0
+
+        document_frequency: Counter = Counter()
+        for counts in self._counts:
+            document_frequency.update(counts.keys())
+        n = len(passages)
+        self._idf = {
+            term: math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for term, df in document_frequency.items()
+        }
+
+    def scores(self, query: str) -> list[float]:
+        query_terms = set(terms(query))
+        scores = []
+        for counts, length in zip(self._counts, self._lengths):
+            norm = self.k1 * (1 - self.b + self.b * length / (self._average_length or 1))
+            score = 0.0
+            for term in query_terms:
+                tf = counts.get(term)
+                if tf:
+                    score += self._idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            scores.append(score)
+        return scores
+
+    def select(self, query: str, token_budget: int, top_k: int = 4) -> list[Passage]:
+        """
+        The best-scoring passages for `query` that fit in `token_budget`,
+        at most `top_k`, in source order. The best passage is always kept.
+        """
+        scores = self.scores(query)
+        ranked = sorted(range(len(self.passages)), key=lambda i: (-scores[i], i))
+        chosen = []
+        used = 0
+        for i in ranked:
+            if len(chosen) == top_k:
+                break
+            passage = self.passages[i]
+            if chosen and used + passage.tokens > token_budget:
+                continue
+            chosen.append(i)
+            used += passage.tokens
+        return [self.passages[i] for i in sorted(chosen)]
+
+
+def format_passages(passages: list[Passage]) -> str:
+    return "\n".join(f"[{p.id}] {p.text}" for p in passages)
+
+
+def resolve_references(references: list[str], passages: list[Passage]) -> list[str]:
+    """
+    Rewrites passage labels such as "[3]" in the model's references into
+    the sentence positions they stand for.
+    """
+    by_id = {p.id: p for p in passages}
+
+    def replace(match: re.Match) -> str:
+        passage = by_id.get(int(match.group(1) or match.group(2)))
+        return passage.label if passage is not None else match.group(0)
+
+    return [_LABEL_PATTERN.sub(replace, reference) for reference in references]
+
+
+def cite_passages(references: list[str], passages: list[Passage]) -> list[str]:
+    """
+    The inverse of `resolve_references`: sentence positions of `passages`
+    go back to the "[n]" labels they have in the prompt.
+    """
+    by_label = {p.label: f"[{p.id}]" for p in passages}
+
+    def replace(match: re.Match) -> str:
+        return by_label.get(match.group(0), match.group(0))
+
+    return [_POSITION_PATTERN.sub(replace, reference) for reference in references]
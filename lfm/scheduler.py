@@ -0,0 +1,252 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import math
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from typing import Any, AsyncIterator, Callable, Hashable
+
+from . import metrics
+
+INTERACTIVE = 0
+BULK = 1
+
+_DONE = object()
+
+
+class QueueFull(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"Inference queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class SchedulerClosed(RuntimeError):
+    def __init__(self):
+        super().__init__("Inference scheduler is shutting down")
+
+
+class Job:
+    """
+    One unit of inference work. A job whose function returns an iterator
+    records every item in `partial` as it arrives; its result is the list
+    of all items.
+    """
+
+    def __init__(self, fn: Callable, args: tuple, key: Hashable | None, priority: int):
+        self.id = uuid.uuid4().hex
+        self.fn = fn
+        self.args = args
+        self.key = key
+        self.priority = priority
+        self.status = "queued"
+        self.partial: list[Any] = []
+        self.result: Any = None
+        self.error: str | None = None
+        self.created_at = time.time()
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        self.future: Future = Future()
+        # the submitter's context, so per-request timings follow the job
+        self.context = contextvars.copy_context()
+
+        self._lock = threading.Lock()
+        self._subscribers: list[tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = []
+
+    @property
+    def queue_wait(self) -> float | None:
+        if self.started_at is None:
+            return None
+        return self.started_at - self.created_at
+
+    def _fail(self, error: Exception) -> None:
+        self.error = str(error)
+        self.status = "failed"
+        self.finished_at = time.time()
+        self.future.set_exception(error)
+        self._publish(_DONE)
+
+    def _publish(self, item: Any) -> None:
+        with self._lock:
+            if item is not _DONE:
+                self.partial.append(item)
+            subscribers = list(self._subscribers)
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+
+    def subscribe(self) -> asyncio.Queue:
+        """
+        Returns a queue that receives every partial item, past and future,
+        followed by a sentinel once the job ends. Call from the event loop.
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        with self._lock:
+            for item in self.partial:
+                queue.put_nowait(item)
+            if self.finished_at is not None:
+                queue.put_nowait(_DONE)
+            else:
+                self._subscribers.append((asyncio.get_running_loop(), queue))
+        return queue
+
+
+class Scheduler:
+    """
+    Runs inference jobs on a fixed number of worker threads.
+
+    The queue is bounded: `submit` raises `QueueFull` with a Retry-After
+    estimate once `max_queue` jobs are waiting. Interactive jobs run before
+    bulk ones, and a job submitted with the same `key` as one that is still
+    queued or running shares that job instead of running again. After
+    `shutdown`, `submit` raises `SchedulerClosed`.
+    """
+
+    def __init__(self, workers: int = 1, max_queue: int = 32, job_ttl: float = 3600):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.job_ttl = job_ttl
+
+        self._heap: list[tuple[int, int, Job]] = []
+        self._counter = itertools.count()
+        self._jobs: dict[str, Job] = {}
+        self._inflight: dict[Hashable, Job] = {}
+        self._running = 0
+        self._durations: list[float] = []
+        self._condition = threading.Condition()
+        self._closed = False
+
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"lfm-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(
+        self,
+        fn: Callable,
+        *args,
+        key: Hashable | None = None,
+        priority: int = INTERACTIVE,
+    ) -> Job:
+        with self._condition:
+            if self._closed:
+                raise SchedulerClosed()
+            if key is not None and key in self._inflight:
+                return self._inflight[key]
+            if len(self._heap) >= self.max_queue:
+                raise QueueFull(self._retry_after())
+
+            self._forget_old_jobs()
+            job = Job(fn, args, key, priority)
+            self._jobs[job.id] = job
+            if key is not None:
+                self._inflight[key] = job
+            heapq.heappush(self._heap, (priority, next(self._counter), job))
+            self._condition.notify()
+            return job
+
+    async def run(
+        self,
+        fn: Callable,
+        *args,
+        key: Hashable | None = None,
+        priority: int = INTERACTIVE,
+    ) -> Any:
+        job = self.submit(fn, *args, key=key, priority=priority)
+        return await asyncio.wrap_future(job.future)
+
+    async def stream(self, job: Job) -> AsyncIterator[Any]:
+        """
+        Yields a job's partial items as they are produced.
+        """
+        queue = job.subscribe()
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                break
+            yield item
+        if job.status == "failed":
+            raise RuntimeError(job.error)
+
+    def get(self, job_id: str) -> Job | None:
+        return self._jobs.get(job_id)
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "workers": self.workers,
+                "queued": len(self._heap),
+                "running": self._running,
+                "max_queue": self.max_queue,
+            }
+
+    def shutdown(self) -> None:
+        """
+        Stops taking jobs. Running jobs finish; queued ones fail right away,
+        so nothing waiting on them hangs.
+        """
+        with self._condition:
+            self._closed = True
+            queued = [job for _, _, job in self._heap]
+            self._heap.clear()
+            for job in queued:
+                if job.key is not None and self._inflight.get(job.key) is job:
+                    del self._inflight[job.key]
+            self._condition.notify_all()
+        for job in queued:
+            job._fail(SchedulerClosed())
+
+    def _retry_after(self) -> int:
+        durations = self._durations[-20:]
+        average = sum(durations) / len(durations) if durations else 5.0
+        return max(1, math.ceil(average * (len(self._heap) + 1) / self.workers))
+
+    def _forget_old_jobs(self) -> None:
+        cutoff = time.time() - self.job_ttl
+        for job_id in [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.finished_at is not None and job.finished_at < cutoff
+        ]:
+            del self._jobs[job_id]
+
+    def _worker(self) -> None:
+        while True:
+            with self._condition:
+                while not self._heap and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                _, _, job = heapq.heappop(self._heap)
+                self._running += 1
+            self._run(job)
+            with self._condition:
+                self._running -= 1
+                if job.key is not None and self._inflight.get(job.key) is job:
+                    del self._inflight[job.key]
+                self._durations = self._durations[-99:] + [job.finished_at - job.started_at]
+
+    def _run(self, job: Job) -> None:
+        job.context.run(self._execute, job)
+
+    def _execute(self, job: Job) -> None:
+        job.started_at = time.time()
+        job.status = "running"
+        metrics.record("queue", job.queue_wait)
+        try:
+            result = job.fn(*job.args)
+            if hasattr(result, "__next__"):
+                for item in result:
+                    job._publish(item)
+                result = list(job.partial)
+            job.result = result
+            job.status = "done"
+            job.finished_at = time.time()
+            job.future.set_result(result)
+        except Exception as e:
+            job._fail(e)
+            return
+        job._publish(_DONE)
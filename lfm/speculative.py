@@ -0,0 +1,58 @@
+"""
+Prompt lookup drafting for speculative decoding.
+
+Answers copy long runs of the source, so the tokens after the latest
+generated n-gram's occurrence in the prompt are a good guess for what the
+model writes next. The backend feeds such a draft together with the current
+token in one forward pass and keeps the longest prefix the model agrees
+with, which under greedy decoding gives the same output as decoding one
+token at a time.
+"""
+
+
+class PromptLookup:
+    """
+    Drafts continuations from `tokens` (usually the prompt) by matching the
+    last `max_ngram` down to `min_ngram` generated tokens against it, and
+    counts how many drafted tokens the model accepted.
+    """
+
+    def __init__(
+        self,
+        tokens: list[int],
+        max_ngram: int = 3,
+        min_ngram: int = 2,
+        max_draft: int = 8,
+    ):
+        self.tokens = list(tokens)
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+        self.max_draft = max_draft
+        self.drafted = 0
+        self.accepted = 0
+
+        # n-gram -> position right after its first occurrence
+        self._index: dict[tuple[int, ...], int] = {}
+        for n in range(min_ngram, max_ngram + 1):
+            for end in range(n, len(self.tokens)):
+                self._index.setdefault(tuple(self.tokens[end - n : end]), end)
+
+    def draft(self, generated: list[int], limit: int | None = None) -> list[int]:
+        limit = self.max_draft if limit is None else min(limit, self.max_draft)
+        if limit <= 0:
+            return []
+        for n in range(self.max_ngram, self.min_ngram - 1, -1):
+            if len(generated) < n:
+                continue
+            end = self._index.get(tuple(generated[-n:]))
+            if end is not None:
+                return self.tokens[end : end + limit]
+        return []
+
+    def record(self, drafted: int, accepted: int) -> None:
+        self.drafted += drafted
+        self.accepted += accepted
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.drafted if self.drafted else 0.0
@@ -1,42 +1,35 @@
 from typing import Annotated
 from contextlib import asynccontextmanager
+from functools import cache
 from fastapi import Depends, FastAPI, HTTPException, Query
-from sqlmodel import Field, Session, SQLModel, create_engine, select
+from sqlmodel import Session
 
+import os
+import json
+import tempfile
+import time
 import uuid
-import jsonpickle
 from fastapi import FastAPI, Request, Form
-from fastapi.responses import HTMLResponse
-from fastapi.templating import Jinja2Templates
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-import asyncio
-from concurrent.futures import ThreadPoolExecutor
 import html
-from datetime import datetime, timezone
-from lfm import Llm, LlmOutput
-from uuid import UUID, uuid4
-
-from sqlmodel import Field, SQLModel, Column, JSON
-
-
-class Flashcard(SQLModel, table=True):
-    id: UUID | None = Field(default_factory=uuid4, primary_key=True)
-    front: str = Field(index=True)
-    back: str = Field(index=True)
-    references: list[str] = Field(default=[], sa_column=Column(JSON))
-    examples: list[str] = Field(default=[], sa_column=Column(JSON))
-    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
-
-
-sqlite_file_name = "database.db"
-sqlite_url = f"sqlite:///{sqlite_file_name}"
-
-connect_args = {"check_same_thread": False}
-engine = create_engine(sqlite_url, connect_args=connect_args)
-
-
-def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+from typing import Iterator, Literal
+from urllib.parse import urlencode
+from lfm import Llm, LlmOutput, metrics
+from lfm.anki_export import write_apkg
+from lfm.cache import GenerationCache
+from lfm.llm import DEFAULT_REPO
+from lfm.pool import WorkerPool
+from lfm.db import (
+    Flashcard,
+    add_flashcard,
+    create_db_and_tables,
+    engine,
+    iter_flashcards,
+    search_flashcards,
+)
+from lfm.scheduler import BULK, INTERACTIVE, Job, QueueFull, Scheduler, SchedulerClosed
 
 
 def get_session():
@@ -49,17 +42,71 @@ SessionDep = Annotated[Session, Depends(get_session)]
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global warmup_job
     create_db_and_tables()
+    if pool_workers:
+        llm.start()
+    if warmup or pool_workers:
+        # runs on a scheduler worker, so requests arriving meanwhile queue behind it
+        warmup_job = scheduler.submit(llm.warm_up, priority=INTERACTIVE)
     yield
     print("shutting down")
+    scheduler.shutdown()
+    if pool_workers:
+        llm.shutdown()
 
 
 app = FastAPI(lifespan=lifespan)
-templates = Jinja2Templates(directory="templates")
 
-llm = Llm()
 
-executor = ThreadPoolExecutor(max_workers=2)
+@cache
+def get_templates():
+    # lazy import, only the index page renders a template
+    from fastapi.templating import Jinja2Templates
+
+    return Jinja2Templates(directory="templates")
+
+
+# LFM_WARMUP=1 loads the model and runs a short generation at startup, and
+# /readyz fails until that is done; otherwise the first request loads it
+warmup = os.environ.get("LFM_WARMUP") == "1"
+warmup_job: Job | None = None
+
+# LFM_SERVER_TIMING=1 reports the stages of each request in a Server-Timing header
+server_timing = os.environ.get("LFM_SERVER_TIMING") == "1"
+
+# finished generations are cached next to the flashcard database; LFM_CACHE=0 disables it
+cache_path = "generation_cache.db" if os.environ.get("LFM_CACHE") != "0" else None
+
+# LFM_POOL_WORKERS=N serves from N model processes instead of one in-process model
+pool_workers = int(os.environ.get("LFM_POOL_WORKERS", "0"))
+llm_options = {
+    "max_batch_size": int(os.environ.get("LFM_MAX_BATCH_SIZE", "8")),
+    "constrained": os.environ.get("LFM_CONSTRAINED") == "1",
+    "source_token_budget": int(os.environ.get("LFM_SOURCE_TOKENS", "1024")) or None,
+    "speculative": os.environ.get("LFM_SPECULATIVE") == "1",
+}
+if pool_workers:
+    llm = WorkerPool(
+        pool_workers,
+        {
+            **llm_options,
+            "repo": DEFAULT_REPO,
+            "backend": os.environ.get("LFM_BACKEND", "mlx"),
+            "cache": cache_path,
+            "warm_up": warmup,
+        },
+    )
+else:
+    llm = Llm(cache=GenerationCache(cache_path) if cache_path else None, **llm_options)
+
+# one worker per model instance that can decode at the same time (two per pool
+# process, so each always has its next call waiting); requests past
+# LFM_MAX_QUEUE waiting jobs are turned away with 429
+scheduler = Scheduler(
+    workers=int(os.environ.get("LFM_WORKERS", str(2 * pool_workers or 1))),
+    max_queue=int(os.environ.get("LFM_MAX_QUEUE", "32")),
+)
 
 
 class FlashcardRequest(BaseModel):
@@ -69,9 +116,133 @@ class FlashcardRequest(BaseModel):
     max_tokens: int = 512
 
 
+class JobRequest(BaseModel):
+    kind: Literal["generate_batch", "summarize", "create_questions"]
+    source_text: str
+    questions: list[str] = []
+    priority: Literal["interactive", "bulk"] = "bulk"
+
+
+def flashcard_html(i: int, flashcard: LlmOutput) -> str:
+    escaped_front = html.escape(flashcard.front)
+    escaped_back = html.escape(flashcard.back)
+    return f"""
+                <div style="border: 1px solid #ccc; padding: 10px; margin-bottom: 10px; border-radius: 5px;">
+                    <h4>Flashcard {i + 1}</h4>
+                    <p><strong>Question:</strong> {escaped_front}</p>
+                    <p><strong>Answer:</strong> {escaped_back}</p>
+                </div>
+            """
+
+
+def export_links_html(batch_id: str) -> str:
+    return f"""
+            <p>
+                Export:
+                <a href="/export?batch_id={batch_id}&format=json" download>json</a>
+                <a href="/export?batch_id={batch_id}&format=jsonl" download>jsonl</a>
+                <a href="/export?batch_id={batch_id}&format=apkg" download>Anki deck</a>
+            </p>
+        """
+
+
+def sse_event(event: str, data: str) -> str:
+    lines = "".join(f"data: {line}\n" for line in data.splitlines() or [""])
+    return f"event: {event}\n{lines}\n"
+
+
+def queue_full_html(e: QueueFull) -> HTMLResponse:
+    metrics.FAILURES.inc(reason="queue_full")
+    return HTMLResponse(
+        content=f"<div style='color: red;'>The server is busy, please retry in {e.retry_after}s.</div>",
+        status_code=429,
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+
+def store_flashcards(
+    session: Session, outputs: list[LlmOutput], batch_id: str, source: str
+) -> int:
+    """
+    Stores generated flashcards under `batch_id` and commits. Returns how
+    many were merged into near-duplicates. Blocks on MinHash and SQLite, so
+    endpoints run it in the thread pool.
+    """
+    duplicates = 0
+    with metrics.span("db"):
+        for output in outputs:
+            _, created = add_flashcard(session, output, batch_id=batch_id, source=source)
+            duplicates += not created
+        session.commit()
+    return duplicates
+
+
+def job_item_json(item):
+    if isinstance(item, tuple):
+        i, output = item
+        if isinstance(output, Exception):
+            return {"index": i, "error": str(output)}
+        return {"index": i, "flashcard": output.model_dump()}
+    if isinstance(item, LlmOutput):
+        return item.model_dump()
+    return item
+
+
+@app.middleware("http")
+async def collect_request_timings(request: Request, call_next):
+    start = time.perf_counter()
+    with metrics.collect_timings() as timings:
+        response = await call_next(request)
+    if server_timing:
+        timings["total"] = time.perf_counter() - start
+        response.headers["Server-Timing"] = metrics.server_timing_header(timings)
+    return response
+
+
+@app.get("/healthz")
+async def healthz():
+    """
+    Liveness: the process is up and serving requests.
+    """
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    """
+    Readiness: the model is loaded and warmed up. Without LFM_WARMUP the
+    model loads on the first request, so the server is always ready.
+    """
+    if warmup_job is None:
+        return {"status": "ready", "model_loaded": llm.is_loaded}
+    if warmup_job.status == "done":
+        return {"status": "ready", "model_loaded": True}
+    if warmup_job.status == "failed":
+        return JSONResponse(
+            {"status": "failed", "error": warmup_job.error}, status_code=503
+        )
+    return JSONResponse({"status": "loading"}, status_code=503)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    Counters and stage timings in the Prometheus text format.
+    """
+    stats = scheduler.stats()
+    metrics.QUEUE_JOBS.set(stats["queued"], state="queued")
+    metrics.QUEUE_JOBS.set(stats["running"], state="running")
+    if pool_workers:
+        for worker in llm.stats():
+            metrics.WORKER_CALLS.set(worker["in_flight"], worker=worker["worker"])
+    return PlainTextResponse(
+        metrics.registry.render(), media_type="text/plain; version=0.0.4"
+    )
+
+
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
-    return templates.TemplateResponse(request=request, name="index.html")
+    return get_templates().TemplateResponse(request=request, name="index.html")
 
 
 @app.post("/generate-batch", response_class=HTMLResponse)
@@ -87,64 +258,36 @@ async def generate_batch(
         if not question_list:
             raise ValueError("No valid questions provided")
 
-        loop = asyncio.get_running_loop()
-        results = await loop.run_in_executor(
-            executor,
+        results = await scheduler.run(
             llm.generate_batch,
             source_text,
             question_list,
+            key=("generate_batch", source_text, tuple(question_list)),
         )
 
         if not results:
             raise ValueError("No flashcards generated")
 
-        flashcards_data = []
-        for r in results:
-            data = r.model_dump()
-            data["id"] = uuid.uuid4()
-            flashcards_data.append(data)
-            db_flashcard = Flashcard.model_validate(data)
-            session.add(db_flashcard)
-
-        session.commit()
-
-        flashcards_json = jsonpickle.dumps(
-            [
-                {
-                    "front": f.front,
-                    "back": f.back,
-                    "references": f.references,
-                    "examples": f.examples,
-                }
-                for f in results
-            ]
+        batch_id = uuid.uuid4().hex
+        duplicates = await run_in_threadpool(
+            store_flashcards, session, results, batch_id, source_text
         )
-        flashcards_json_escaped = html.escape(flashcards_json)
-
-        html_content = "<h3>Generated Flashcards</h3>"
-        html_content += f"<p>Successfully generated {len(results)} flashcard(s).</p>"
-        html_content += "<div>"
-        for i, flashcard in enumerate(results):
-            escaped_front = html.escape(flashcard.front)
-            escaped_back = html.escape(flashcard.back)
-            html_content += f"""
-                <div style="border: 1px solid #ccc; padding: 10px; margin-bottom: 10px; border-radius: 5px;">
-                    <h4>Flashcard {i + 1}</h4>
-                    <p><strong>Question:</strong> {escaped_front}</p>
-                    <p><strong>Answer:</strong> {escaped_back}</p>
-                </div>
-            """
-        html_content += "</div>"
-        html_content += f"""
-            <form hx-post="/export-flashcards" hx-target="#export-container" hx-swap="outerHTML">
-                <input type="hidden" name="flashcards_json" value="{flashcards_json_escaped}">
-                <button type="submit">Export to json</button>
-            </form>
-            <div id="export-container"></div>
-        """
+
+        with metrics.span("render"):
+            html_content = "<h3>Generated Flashcards</h3>"
+            html_content += f"<p>Successfully generated {len(results)} flashcard(s).</p>"
+            if duplicates:
+                html_content += f"<p>{duplicates} near-duplicate(s) merged into existing flashcards.</p>"
+            html_content += "<div>"
+            for i, flashcard in enumerate(results):
+                html_content += flashcard_html(i, flashcard)
+            html_content += "</div>"
+            html_content += export_links_html(batch_id)
 
         return HTMLResponse(content=html_content)
 
+    except QueueFull as e:
+        return queue_full_html(e)
     except ValueError as e:
         return HTMLResponse(content=f"<div style='color: red;'>Error: {str(e)}</div>")
     except Exception as e:
@@ -153,26 +296,270 @@ async def generate_batch(
         )
 
 
-@app.post("/export-flashcards", response_class=HTMLResponse)
-async def export_flashcards(request: Request, flashcards_json: str = Form(...)):
+@app.post("/generate-batch/stream", response_class=HTMLResponse)
+async def generate_batch_stream(
+    request: Request,
+    source_text: str = Form(...),
+    questions: str = Form(...),
+):
+    """
+    Starts a streamed batch: the returned fragment connects to the SSE
+    endpoint below and appends each flashcard as soon as it is done.
+    """
+    question_list = [q.strip() for q in questions.split("\n") if q.strip()]
+    if not question_list:
+        return HTMLResponse(
+            content="<div style='color: red;'>Error: No valid questions provided</div>"
+        )
+
     try:
-        flashcards = jsonpickle.loads(flashcards_json)
-        export_data = {"flashcards": flashcards, "total": len(flashcards)}
-
-        return templates.TemplateResponse(
-            "export_result.html",
-            {
-                "request": request,
-                "export_data": jsonpickle.dumps(export_data, indent=2),
-                "count": len(flashcards),
-            },
+        job = scheduler.submit(
+            llm.iter_batch,
+            source_text,
+            question_list,
+            key=("iter_batch", source_text, tuple(question_list)),
         )
-    except jsonpickle.JSONDecodeError as e:
-        return HTMLResponse(
-            f"<div class='text-red-500'>Export failed: Invalid JSON data.</div>"
+    except QueueFull as e:
+        return queue_full_html(e)
+
+    return HTMLResponse(
+        content=f"""
+            <h3>Generated Flashcards</h3>
+            <div hx-ext="sse" sse-connect="/generate-batch/stream/{job.id}" sse-close="done">
+                <div sse-swap="card" hx-swap="beforeend"></div>
+                <div sse-swap="done" hx-swap="innerHTML"><p>Generating {len(question_list)} flashcard(s)...</p></div>
+            </div>
+        """
+    )
+
+
+@app.get("/generate-batch/stream/{job_id}")
+async def generate_batch_events(job_id: str):
+    job = scheduler.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired stream")
+    source_text, question_list = job.args
+
+    async def events():
+        results = []
+        failed = 0
+        duplicates = 0
+        error = None
+        with Session(engine) as session:
+            try:
+                async for i, result in scheduler.stream(job):
+                    if isinstance(result, Exception):
+                        failed += 1
+                        yield sse_event(
+                            "card",
+                            f"<div style='color: red;'>Flashcard {i + 1} "
+                            f"({html.escape(question_list[i])}) failed: "
+                            f"{html.escape(str(result))}</div>",
+                        )
+                        continue
+
+                    # the job id doubles as the batch id of the stored cards
+                    duplicates += await run_in_threadpool(
+                        store_flashcards, session, [result], job.id, source_text
+                    )
+
+                    results.append(result)
+                    yield sse_event("card", flashcard_html(i, result))
+            except RuntimeError as e:
+                error = e
+
+        summary = f"<p>Successfully generated {len(results)} flashcard(s)"
+        summary += f", {failed} failed.</p>" if failed else ".</p>"
+        if error is not None:
+            summary += f"<div style='color: red;'>Error: {html.escape(str(error))}</div>"
+        if duplicates:
+            summary += f"<p>{duplicates} near-duplicate(s) merged into existing flashcards.</p>"
+        if results:
+            summary += export_links_html(job.id)
+        yield sse_event("done", summary)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/generate-deck", response_class=HTMLResponse)
+async def generate_deck(request: Request, source_text: str = Form(...)):
+    """
+    Writes questions for the text and a flashcard for each in one job: the
+    returned fragment connects to the SSE endpoint below, which sends each
+    question as soon as its line is done and each flashcard as it finishes.
+    """
+    if not source_text.strip():
+        return HTMLResponse(content="<div style='color: red;'>Error: No source text provided</div>")
+
+    try:
+        job = scheduler.submit(llm.iter_deck, source_text, key=("iter_deck", source_text))
+    except QueueFull as e:
+        return queue_full_html(e)
+
+    return HTMLResponse(
+        content=f"""
+            <h3>Generated Deck</h3>
+            <div hx-ext="sse" sse-connect="/generate-deck/stream/{job.id}" sse-close="done">
+                <ol sse-swap="question" hx-swap="beforeend"></ol>
+                <div sse-swap="card" hx-swap="beforeend"></div>
+                <div sse-swap="done" hx-swap="innerHTML"><p>Writing questions...</p></div>
+            </div>
+        """
+    )
+
+
+@app.get("/generate-deck/stream/{job_id}")
+async def generate_deck_events(job_id: str):
+    job = scheduler.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired stream")
+    source_text = job.args[0]
+
+    async def events():
+        questions: dict[int, str] = {}
+        results = []
+        failed = 0
+        duplicates = 0
+        error = None
+        with Session(engine) as session:
+            try:
+                async for kind, i, result in scheduler.stream(job):
+                    if kind == "question":
+                        questions[i] = result
+                        yield sse_event("question", f"<li>{html.escape(result)}</li>")
+                        continue
+                    if isinstance(result, Exception):
+                        failed += 1
+                        yield sse_event(
+                            "card",
+                            f"<div style='color: red;'>Flashcard {i + 1} "
+                            f"({html.escape(questions.get(i, ''))}) failed: "
+                            f"{html.escape(str(result))}</div>",
+                        )
+                        continue
+
+                    # the job id doubles as the batch id of the stored cards
+                    duplicates += await run_in_threadpool(
+                        store_flashcards, session, [result], job.id, source_text
+                    )
+
+                    results.append(result)
+                    yield sse_event("card", flashcard_html(i, result))
+            except RuntimeError as e:
+                error = e
+
+        summary = f"<p>Successfully generated {len(results)} flashcard(s)"
+        summary += f", {failed} failed.</p>" if failed else ".</p>"
+        if error is not None:
+            summary += f"<div style='color: red;'>Error: {html.escape(str(error))}</div>"
+        if duplicates:
+            summary += f"<p>{duplicates} near-duplicate(s) merged into existing flashcards.</p>"
+        if results:
+            summary += export_links_html(job.id)
+        yield sse_event("done", summary)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def flashcard_export_json(flashcard: Flashcard) -> str:
+    return json.dumps(
+        {
+            "front": flashcard.front,
+            "back": flashcard.back,
+            "references": flashcard.references,
+            "examples": flashcard.examples,
+        },
+        ensure_ascii=False,
+    )
+
+
+def export_chunks(batch_id: str | None, q: str | None, format: str) -> Iterator[str]:
+    with Session(engine) as session:
+        flashcards = iter_flashcards(session, batch_id=batch_id, query=q)
+        if format == "jsonl":
+            for flashcard in flashcards:
+                yield flashcard_export_json(flashcard) + "\n"
+            return
+
+        yield '{"flashcards": ['
+        total = 0
+        for flashcard in flashcards:
+            yield ("," if total else "") + "\n  " + flashcard_export_json(flashcard)
+            total += 1
+        yield f'\n], "total": {total}}}\n'
+
+
+def build_apkg(batch_id: str | None, q: str | None) -> str:
+    fd, path = tempfile.mkstemp(prefix="flashcards-", suffix=".apkg")
+    os.close(fd)
+    try:
+        with Session(engine) as session:
+            write_apkg(iter_flashcards(session, batch_id=batch_id, query=q), path)
+    except Exception:
+        os.unlink(path)
+        raise
+    return path
+
+
+def file_chunks(path: str, chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
+    try:
+        with open(path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+    finally:
+        os.unlink(path)
+
+
+@app.get("/export")
+async def export_flashcards(
+    batch_id: str | None = Query(None),
+    q: str | None = Query(None),
+    format: Literal["json", "jsonl", "apkg"] = Query("json"),
+):
+    """
+    Streams stored flashcards as a download: one batch, the cards matching a
+    search query, or (with neither) every card. Anki packages are built in a
+    temporary file first and deleted once sent.
+    """
+    filename = f"flashcards-{batch_id or 'all'}.{format}"
+    if format == "apkg":
+        try:
+            path = await run_in_threadpool(build_apkg, batch_id, q)
+        except RuntimeError as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        return StreamingResponse(
+            file_chunks(path),
+            media_type="application/octet-stream",
+            headers={
+                "Content-Disposition": f'attachment; filename="{filename}"',
+                "Content-Length": str(os.path.getsize(path)),
+            },
         )
-    except Exception as e:
-        return HTMLResponse(f"<div class='text-red-500'>Export failed: {str(e)}</div>")
+
+    return StreamingResponse(
+        export_chunks(batch_id, q, format),
+        media_type="application/x-ndjson" if format == "jsonl" else "application/json",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+def bullet_html(line: str) -> str:
+    line = line.strip()
+    if line.startswith("-"):
+        line = line[1:].strip()
+    return f"<li>{html.escape(line)}</li>"
+
+
+def summary_html(summarized_text: str) -> str:
+    return "<ul>" + "".join(bullet_html(line) for line in summarized_text.split("\n")) + "</ul>"
 
 
 @app.post("/summarize", response_class=HTMLResponse)
@@ -182,30 +569,83 @@ async def summarize_text(request: Request, source_text: str = Form(...)):
             content="<div style='color: red;'>Error: Source text cannot be empty.</div>"
         )
 
-    loop = asyncio.get_running_loop()
     try:
-        summarized_text = await loop.run_in_executor(
-            executor, llm.summarize, source_text
+        summarized_text = await scheduler.run(
+            llm.summarize, source_text, key=("summarize", source_text)
         )
 
-        html_content = "<h3>Summarized Content</h3>"
-        html_content += "<ul>"
-        for line in summarized_text.split("\n"):
-            line = line.strip()
-            if line.startswith("-"):
-                html_content += f"<li>{html.escape(line[1:].strip())}</li>"
-            else:
-                html_content += f"<li>{html.escape(line)}</li>"
-        html_content += "</ul>"
+        with metrics.span("render"):
+            html_content = "<h3>Summarized Content</h3>"
+            html_content += summary_html(summarized_text)
 
         return HTMLResponse(content=html_content)
 
+    except QueueFull as e:
+        return queue_full_html(e)
     except Exception as e:
         return HTMLResponse(
             content=f"<div style='color: red;'>Error summarizing text: {str(e)}</div>"
         )
 
 
+@app.post("/summarize/stream", response_class=HTMLResponse)
+async def summarize_stream(request: Request, source_text: str = Form(...)):
+    """
+    Starts a streamed summary: the returned fragment connects to the SSE
+    endpoint below, which sends the bullets of each chunk of a long text as
+    soon as it is summarized and the merged summary last.
+    """
+    if not source_text or not source_text.strip():
+        return HTMLResponse(
+            content="<div style='color: red;'>Error: Source text cannot be empty.</div>"
+        )
+
+    try:
+        job = scheduler.submit(llm.iter_summary, source_text, key=("iter_summary", source_text))
+    except QueueFull as e:
+        return queue_full_html(e)
+
+    return HTMLResponse(
+        content=f"""
+            <h3>Summarized Content</h3>
+            <div hx-ext="sse" sse-connect="/summarize/stream/{job.id}" sse-close="done">
+                <div sse-swap="done" hx-swap="innerHTML">
+                    <ul sse-swap="bullets" hx-swap="beforeend"></ul>
+                    <p>Summarizing...</p>
+                </div>
+            </div>
+        """
+    )
+
+
+@app.get("/summarize/stream/{job_id}")
+async def summarize_events(job_id: str):
+    job = scheduler.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired stream")
+
+    async def events():
+        try:
+            async for kind, value in scheduler.stream(job):
+                if kind == "bullets":
+                    yield sse_event("bullets", "".join(bullet_html(b) for b in value))
+                else:
+                    with metrics.span("render"):
+                        content = summary_html(value)
+                    yield sse_event("done", content)
+        except RuntimeError as e:
+            yield sse_event(
+                "done",
+                f"<div style='color: red;'>Error summarizing text: {html.escape(str(e))}</div>",
+            )
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.post("/create-questions", response_class=HTMLResponse)
 async def create_questions(request: Request, source_text: str = Form(...)):
     if not source_text or not source_text.strip():
@@ -213,17 +653,16 @@ async def create_questions(request: Request, source_text: str = Form(...)):
             content="<div style='color: red;'>Error: Source text cannot be empty.</div>"
         )
 
-    loop = asyncio.get_running_loop()
     try:
-        questions_text = await loop.run_in_executor(
-            executor, llm.create_question, source_text
+        questions_text = await scheduler.run(
+            llm.create_question, source_text, key=("create_questions", source_text)
         )
 
         html_content = "<h3>Generated Questions</h3>"
         html_content += f"<pre>{html.escape(questions_text)}</pre>"
 
         html_content += f"""
-            <form hx-post="/generate-batch" hx-target="#flashcard-results-container" hx-swap="innerHTML">
+            <form hx-post="/generate-batch/stream" hx-target="#flashcard-results-container" hx-swap="innerHTML">
                 <input type="hidden" name="source_text" value="{html.escape(source_text)}">
                 <textarea name="questions" rows="10" cols="50" style="display:none;">{html.escape(questions_text)}</textarea>
                 <button type="submit">Create Flashcards from These Questions</button>
@@ -232,7 +671,104 @@ async def create_questions(request: Request, source_text: str = Form(...)):
 
         return HTMLResponse(content=html_content)
 
+    except QueueFull as e:
+        return queue_full_html(e)
     except Exception as e:
         return HTMLResponse(
             content=f"<div style='color: red;'>Error creating questions: {str(e)}</div>"
         )
+
+
+@app.get("/search", response_class=HTMLResponse)
+async def search(
+    session: SessionDep,
+    q: str = Query(""),
+    after: str | None = Query(None),
+    limit: int = Query(20, ge=1, le=100),
+):
+    """
+    Full-text search over stored flashcards, best matches first. Each page
+    ends with a button that loads the next one in its place.
+    """
+    try:
+        with metrics.span("db"):
+            flashcards, cursor = search_flashcards(session, q, limit=limit, after=after)
+    except ValueError as e:
+        return HTMLResponse(content=f"<div style='color: red;'>Error: {str(e)}</div>")
+
+    if not flashcards and after is None:
+        return HTMLResponse(content="<p>No matching flashcards.</p>" if q.strip() else "")
+
+    html_content = "".join(
+        f"""
+                <div style="border: 1px solid #ccc; padding: 10px; margin-bottom: 10px; border-radius: 5px;">
+                    <p><strong>Question:</strong> {html.escape(f.front)}</p>
+                    <p><strong>Answer:</strong> {html.escape(f.back)}</p>
+                </div>
+            """
+        for f in flashcards
+    )
+    if cursor is not None:
+        next_url = f"/search?{urlencode({'q': q, 'after': cursor, 'limit': limit})}"
+        html_content += f"""
+            <button hx-get="{html.escape(next_url)}" hx-target="this" hx-swap="outerHTML">More results</button>
+        """
+    return HTMLResponse(content=html_content)
+
+
+@app.post("/jobs", status_code=202)
+async def submit_job(job_request: JobRequest):
+    """
+    Queues a generation without waiting for it; poll `GET /jobs/{job_id}`.
+    """
+    source_text = job_request.source_text
+    if not source_text.strip():
+        raise HTTPException(status_code=422, detail="Source text cannot be empty")
+    priority = INTERACTIVE if job_request.priority == "interactive" else BULK
+
+    if job_request.kind == "generate_batch":
+        question_list = [q.strip() for q in job_request.questions if q.strip()]
+        if not question_list:
+            raise HTTPException(status_code=422, detail="No valid questions provided")
+        fn, args = llm.iter_batch, (source_text, question_list)
+        key = ("iter_batch", source_text, tuple(question_list))
+    elif job_request.kind == "summarize":
+        fn, args = llm.summarize, (source_text,)
+        key = ("summarize", source_text)
+    else:
+        fn, args = llm.create_question, (source_text,)
+        key = ("create_questions", source_text)
+
+    try:
+        job = scheduler.submit(fn, *args, key=key, priority=priority)
+    except QueueFull as e:
+        metrics.FAILURES.inc(reason="queue_full")
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    except SchedulerClosed as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return {"job_id": job.id, "status": job.status}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = scheduler.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job")
+
+    response = {
+        "job_id": job.id,
+        "status": job.status,
+        "queue_wait": job.queue_wait,
+        "error": job.error,
+        "partial": [job_item_json(item) for item in list(job.partial)],
+        "result": None,
+    }
+    if job.status == "done" and not isinstance(job.result, list):
+        response["result"] = job_item_json(job.result)
+    elif job.status == "done":
+        response["result"] = response["partial"]
+    return response